@@ -12,6 +12,7 @@ django.setup()
 
 from dicom_app.models import DicomFile, Experiment
 from dicom_app.bids_utils import detect_modality, convert_dicom_to_nifti
+from dicom_app.bids_export import get_uid_key
 import pydicom
 
 def diagnose():
@@ -64,7 +65,7 @@ def diagnose():
     output_dir.mkdir()
     
     try:
-        nifti, json_sidecar = convert_dicom_to_nifti(target_file.file.path, output_dir, "test_conversion")
+        nifti, json_sidecar = convert_dicom_to_nifti(target_file.file.path, output_dir, "test_conversion", uid_key=get_uid_key())
         
         if nifti:
             print(f"✅ Conversion successful: {nifti}")
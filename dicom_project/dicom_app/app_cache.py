@@ -0,0 +1,90 @@
+"""
+Application cache of query results, with versioned keys.
+
+Every cached value depends on one or more scopes: an object
+('experiment:12', 'participant:5', 'dicom:40') or a whole list
+('experiments', 'participants'). Each scope has a version token stored in the
+cache itself, and the key of a value includes the tokens of its scopes.
+Invalidating a scope (bump) just replaces its token: every value built on the
+old one becomes unreachable and expires on its own, without having to know
+which keys existed. The model signals (signals.py) bump exactly the scopes a
+change touches.
+
+Versions live in the same backend as the values, so with several server
+processes the cache must be shared between them (file based or Redis, see
+CACHES in settings); a local-memory cache is only right for one process.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .db_router import use_primary
+
+EXPERIMENTS = 'experiments'
+PARTICIPANTS = 'participants'
+
+_MISSING = object()
+
+
+def experiment_scope(experiment_id):
+    return f"experiment:{experiment_id}"
+
+def participant_scope(participant_id):
+    return f"participant:{participant_id}"
+
+def dicom_scope(dicom_file_id):
+    return f"dicom:{dicom_file_id}"
+
+def _version_key(scope):
+    return f"scope:{scope}"
+
+def _new_token():
+    # Random, not a counter: a token evicted from the cache and recreated
+    # must not match the one older values were built with
+    return uuid.uuid4().hex[:12]
+
+def versions(scopes):
+    """
+    Current version token of each scope, creating the missing ones.
+    """
+    keys = [_version_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    missing = {key: _new_token() for key in keys if key not in found}
+    for key, token in missing.items():
+        # add() keeps a token another process created in the meantime
+        if not cache.add(key, token, None):
+            token = cache.get(key, token)
+        found[key] = token
+    return [found[key] for key in keys]
+
+def bump(*scopes):
+    """
+    Invalidates every value cached under any of the scopes.
+    """
+    scopes = {scope for scope in scopes if scope}
+    if scopes:
+        cache.set_many({_version_key(scope): _new_token() for scope in scopes}, None)
+
+def make_key(name, scopes, *parts):
+    digest = hashlib.sha1(
+        '\x1f'.join(map(str, [*parts, *versions(scopes)])).encode()
+    ).hexdigest()
+    return f"{name}:{digest}"
+
+def cached(name, scopes, builder, *parts, timeout=None):
+    """
+    Value of builder() cached under name and parts until any of scopes is
+    bumped (or timeout, default APP_CACHE_TIMEOUT, expires). Exceptions
+    from builder propagate and nothing is cached. builder reads from the
+    primary database: a lagging replica right after a bump would leave a
+    stale value under the new version.
+    """
+    key = make_key(name, scopes, *parts)
+    value = cache.get(key, _MISSING)
+    if value is _MISSING:
+        with use_primary():
+            value = builder()
+        cache.set(key, value, settings.APP_CACHE_TIMEOUT if timeout is None else timeout)
+    return value
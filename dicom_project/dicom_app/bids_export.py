@@ -0,0 +1,382 @@
+"""
+Experiment-level BIDS export.
+
+The export is split in two stages: a plan that fixes every output path
+(subject labels, datatype folders and run/acq indices) from database
+metadata before anything is converted, and the conversion itself, fanned
+out over a process pool. Because the names never depend on what is
+already on disk, the parallel output is identical to the serial one.
+"""
+import os
+import re
+import shutil
+import tempfile
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.text import slugify
+
+from .bids_utils import (
+    normalize_subject_id, detect_modality, build_entities, build_output_basename, convert_task,
+    create_dataset_description, create_participants_tsv
+)
+from .deid import make_uid_key
+from .dicom_storage import stage, stored_sha256
+from .models import DicomFile
+from .nifti_cache import evict
+from .zip_stream import ZipStream
+
+DATASET_DIRNAME = "my_dataset"
+
+
+def get_export_workers():
+    """
+    Number of conversion processes. BIDS_EXPORT_WORKERS <= 0 means one per CPU.
+    """
+    workers = getattr(settings, 'BIDS_EXPORT_WORKERS', 0)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+def get_cache_dir():
+    """
+    Directory of the NIfTI conversion cache, or None when it is disabled.
+    """
+    cache_dir = getattr(settings, 'BIDS_CACHE_DIR', None)
+    return str(cache_dir) if cache_dir else None
+
+def archive_basename(experiment):
+    """
+    Experiment name as used in archive and download file names.
+    """
+    return slugify(experiment.name).replace('-', '_') or f"experiment_{experiment.pk}"
+
+def get_uid_key():
+    """
+    Key for the de-identification UID remapping (DEID_UID_SECRET).
+    """
+    return make_uid_key(settings.DEID_UID_SECRET)
+
+def ensure_content_hash(dicom_file):
+    """
+    Returns the file's content hash, computing and storing it for files
+    uploaded before hashes were recorded.
+    """
+    if not dicom_file.content_hash:
+        dicom_file.content_hash = stored_sha256(dicom_file.file.name)
+        dicom_file.save(update_fields=['content_hash'])
+    return dicom_file.content_hash
+
+def parse_export_filters(params):
+    """
+    Builds export filters from request parameters (a QueryDict or a dict of
+    lists). Raises ValueError with a user-facing message on bad input.
+
+    Supported parameters (list ones may repeat or be comma-separated):
+        participant  participant pks
+        datatype     anat, func, dwi
+        suffix       T1w, T2w, FLAIR, bold, dwi
+        series       regular expression matched against SeriesDescription
+        date_from, date_to  StudyDate range, YYYY-MM-DD (inclusive)
+    """
+    def getraw(name):
+        values = params.getlist(name) if hasattr(params, 'getlist') else params.get(name, [])
+        return [values] if isinstance(values, str) else list(values)
+
+    def getlist(name):
+        return [v.strip() for value in getraw(name) for v in str(value).split(',') if v.strip()]
+
+    def getvalue(name):
+        values = [str(v).strip() for v in getraw(name) if str(v).strip()]
+        return values[-1] if values else None
+
+    filters = {}
+    try:
+        participants = [int(pk) for pk in getlist('participant')]
+    except ValueError:
+        raise ValueError("Los participantes deben indicarse por su id numérico.")
+    if participants:
+        filters['participants'] = participants
+
+    for name, key in (('datatype', 'datatypes'), ('suffix', 'suffixes')):
+        values = getlist(name)
+        if values:
+            filters[key] = values
+
+    series = getvalue('series')
+    if series:
+        try:
+            re.compile(series)
+        except re.error as e:
+            raise ValueError(f"Patrón de serie inválido: {e}")
+        filters['series'] = series
+
+    for name in ('date_from', 'date_to'):
+        value = getvalue(name)
+        if value:
+            try:
+                date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Fecha inválida en {name}: use AAAA-MM-DD.")
+            filters[name] = value
+
+    return filters
+
+def plan_experiment_export(experiment, only_participants=None, filters=None):
+    """
+    Computes the BIDS layout of an experiment from database metadata alone:
+    no DICOM is opened, so even large experiments plan in milliseconds.
+
+    Returns (participants_data, tasks): participants_data feeds
+    create_participants_tsv and tasks is a list of dicts with
+    'dicom_id', 'dicom_name', 'content_hash', 'participant_pk',
+    'subject_id', 'modality_folder', 'suffix', 'entities' and
+    'output_basename', in deterministic (participant, file) order.
+
+    only_participants (participant pks) restricts the tasks to those
+    participants; subject labels are still numbered over the whole cohort.
+
+    filters (see parse_export_filters) select a partial export. Participant
+    and date filters are applied in the query; the series pattern (Python
+    regex syntax, as validated, not the database's) and datatype/suffix
+    are checked on each row, so excluded files are never read. Subject
+    labels stay the same as in a full export; run/acq indices are numbered
+    within the selection.
+    """
+    filters = filters or {}
+    participant_pks = list(experiment.participants.order_by('id').values_list('pk', flat=True))
+    labels = {pk: normalize_subject_id(idx) for idx, pk in enumerate(participant_pks, start=1)}
+    participants_data = [
+        {
+            'participant_id': labels[pk],
+            'participant_pk': pk,
+            'age': 'n/a',
+            'sex': 'n/a',
+            'group': 'control'
+        }
+        for pk in participant_pks
+    ]
+
+    if filters.get('participants'):
+        selected = set(filters['participants'])
+        participant_pks = [pk for pk in participant_pks if pk in selected]
+        participants_data = [p for p in participants_data if p['participant_pk'] in selected]
+    if only_participants is not None:
+        participant_pks = [pk for pk in participant_pks if pk in only_participants]
+    if not participant_pks:
+        return participants_data, []
+
+    dicom_files = DicomFile.objects.filter(
+        experiment=experiment,
+        participant_id__in=participant_pks
+    ).only(
+        'id', 'file', 'content_hash', 'participant_id', 'modality', 'series_description'
+    ).order_by('participant_id', 'id')
+    if filters.get('date_from'):
+        dicom_files = dicom_files.filter(study_date__gte=filters['date_from'])
+    if filters.get('date_to'):
+        dicom_files = dicom_files.filter(study_date__lte=filters['date_to'])
+
+    series = re.compile(filters['series'], re.IGNORECASE) if filters.get('series') else None
+
+    tasks = []
+    # Run/acq counters per (subject, datatype, kind), same numbering the serial export produced
+    counters = {}
+    for dicom_file in dicom_files:
+        if series and not series.search(dicom_file.series_description or ''):
+            continue
+        subject_id = labels[dicom_file.participant_id]
+        modality_folder, suffix = detect_modality({
+            'Modality': dicom_file.modality,
+            'SeriesDescription': dicom_file.series_description,
+        })
+        if filters.get('datatypes') and modality_folder not in filters['datatypes']:
+            continue
+        if filters.get('suffixes') and suffix.split('_')[-1] not in filters['suffixes']:
+            continue
+
+        counter_key = (subject_id, modality_folder, 'bold' if modality_folder == 'func' else suffix)
+        counters[counter_key] = counters.get(counter_key, 0) + 1
+        index = counters[counter_key]
+
+        tasks.append({
+            'dicom_id': dicom_file.id,
+            'dicom_name': dicom_file.file.name,
+            'content_hash': dicom_file.content_hash,
+            'participant_pk': dicom_file.participant_id,
+            'subject_id': subject_id,
+            'modality_folder': modality_folder,
+            'suffix': suffix.split('_')[-1],
+            'entities': build_entities(modality_folder, suffix, index),
+            'output_basename': build_output_basename(subject_id, modality_folder, suffix, index),
+        })
+
+    return participants_data, tasks
+
+def build_manifest(experiment, participants_data, tasks, filters=None):
+    """
+    Dry-run description of an export: the BIDS files each DICOM will become.
+    """
+    subjects = []
+    files_by_subject = {}
+    for task in tasks:
+        folder = f"{task['subject_id']}/{task['modality_folder']}"
+        files_by_subject.setdefault(task['subject_id'], []).append({
+            'dicom_id': task['dicom_id'],
+            'datatype': task['modality_folder'],
+            'suffix': task['suffix'],
+            'entities': task['entities'],
+            'nifti': f"{DATASET_DIRNAME}/{folder}/{task['output_basename']}.nii.gz",
+            'sidecar': f"{DATASET_DIRNAME}/{folder}/{task['output_basename']}.json",
+        })
+    for participant in participants_data:
+        subjects.append({
+            'subject_id': participant['participant_id'],
+            'participant_pk': participant['participant_pk'],
+            'sessions': [],
+            'files': files_by_subject.get(participant['participant_id'], []),
+        })
+
+    return {
+        'experiment_id': experiment.pk,
+        'experiment': experiment.name,
+        'dataset': DATASET_DIRNAME,
+        'filters': filters or {},
+        'files_total': len(tasks),
+        'subjects': subjects,
+    }
+
+def _record_content_hash(task):
+    """
+    Stores the hash a worker computed for a file uploaded before hashes
+    were recorded (the planner never reads files).
+    """
+    if task.get('computed_hash'):
+        DicomFile.objects.filter(pk=task['dicom_id'], content_hash='').update(content_hash=task['computed_hash'])
+
+def _convert_all(pending, workers):
+    # pending may be lazy: at most two tasks per worker are taken from it
+    # (and so staged) ahead of their conversion
+    if workers <= 1:
+        for task in pending:
+            yield convert_task(task)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        in_flight = set()
+        while True:
+            for task in islice(pending, workers * 2 - len(in_flight)):
+                in_flight.add(executor.submit(convert_task, task))
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # If the consumer stops early (client disconnected), drop queued work
+        executor.shutdown(cancel_futures=True)
+
+def run_conversions(tasks, bids_root, workers=None):
+    """
+    Converts planned tasks into bids_root, yielding (task, nifti_path, json_path)
+    as each conversion finishes (completion order, not plan order).
+    With a single worker everything runs in-process.
+
+    Files whose content was converted before are served from the NIfTI
+    cache; the cache is trimmed to BIDS_CACHE_MAX_BYTES afterwards.
+    """
+    if workers is None:
+        workers = get_export_workers()
+    cache_dir = get_cache_dir()
+    uid_key = get_uid_key()
+
+    staging = tempfile.mkdtemp()
+
+    def pending():
+        # Workers convert local files: remote objects are copied just before
+        # their conversion is submitted and removed once it finishes
+        for task in tasks:
+            dicom_path, is_copy = stage(task['dicom_name'], staging)
+            yield dict(
+                task,
+                dicom_path=dicom_path,
+                staged=is_copy,
+                output_dir=str(Path(bids_root) / task['subject_id'] / task['modality_folder']),
+                cache_dir=cache_dir,
+                uid_key=uid_key,
+            )
+
+    results = _convert_all(pending(), min(workers, len(tasks)))
+    try:
+        for task, nifti_path, json_path in results:
+            if task['staged']:
+                os.remove(task['dicom_path'])
+            _record_content_hash(task)
+            yield task, nifti_path, json_path
+    finally:
+        # Stops the pool before its remaining copies are removed
+        results.close()
+        shutil.rmtree(staging, ignore_errors=True)
+
+    if cache_dir:
+        evict(cache_dir, settings.BIDS_CACHE_MAX_BYTES)
+
+def stream_experiment_bids(experiment, workers=None, progress=None, validator=None, filters=None):
+    """
+    Generator of ZIP bytes for the BIDS export of an experiment.
+
+    dataset_description.json and participants.tsv go out first so the
+    download starts immediately; every converted file is then added to the
+    archive as soon as its conversion finishes and deleted from the staging
+    directory, so at most one copy of each file is ever on disk.
+
+    progress, if given, is called as progress(done, total, task) after each
+    file (task is None for the initial call, before any conversion).
+    validator, if given (a bids_validation.DatasetValidator), checks each
+    file just before it leaves the staging directory.
+    filters select a partial export (see plan_experiment_export).
+    """
+    temp_dir = tempfile.mkdtemp()
+    bids_root = Path(temp_dir) / DATASET_DIRNAME
+    bids_root.mkdir(parents=True, exist_ok=True)
+    archive = ZipStream()
+
+    try:
+        participants_data, tasks = plan_experiment_export(experiment, filters=filters)
+        if progress:
+            progress(0, len(tasks), None)
+
+        create_dataset_description(bids_root)
+        create_participants_tsv(bids_root, participants_data)
+        for name in ("dataset_description.json", "participants.tsv"):
+            yield from _stream_and_remove(archive, bids_root / name, temp_dir, bids_root, validator)
+
+        for done, (task, nifti_path, json_path) in enumerate(run_conversions(tasks, bids_root, workers), start=1):
+            if progress:
+                progress(done, len(tasks), task)
+            if not nifti_path:
+                print(f"⚠️ Conversion failed for DICOM {task['dicom_id']}, skipping...")
+                continue
+            for path in (nifti_path, json_path):
+                if path:
+                    yield from _stream_and_remove(archive, path, temp_dir, bids_root, validator)
+
+        yield from archive.close()
+    except Exception:
+        # Headers are already sent: the client gets a truncated archive
+        traceback.print_exc()
+        raise
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _stream_and_remove(archive, path, temp_dir, bids_root, validator=None):
+    if validator is not None:
+        validator.check(os.path.relpath(path, bids_root), path)
+    arcname = os.path.relpath(path, temp_dir).replace(os.sep, '/')
+    yield from archive.write_file(path, arcname)
+    os.remove(path)
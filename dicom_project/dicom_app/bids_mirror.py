@@ -0,0 +1,143 @@
+"""
+Persistent, incrementally synced BIDS mirror.
+
+When BIDS_MIRROR_ROOT is set every experiment gets a live BIDS tree at
+BIDS_MIRROR_ROOT/experiment-<id>/. Model signals append to the BidsChange
+journal and sync_pending_changes() replays it, rebuilding only the subject
+folders whose files or subject label changed, plus participants.tsv and
+dataset_description.json. Conversions go through the NIfTI cache, so
+rebuilding a subject mostly means linking cached files.
+
+Each subject folder is rebuilt in a staging directory and swapped in with
+a rename, so pipelines reading the mirror never see a half-written subject.
+"""
+import json
+import os
+import shutil
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+
+from .bids_export import plan_experiment_export, run_conversions
+from .bids_utils import create_dataset_description, create_participants_tsv
+from .models import BidsChange, Experiment
+
+STATE_FILENAME = ".dicomhub_mirror.json"
+STAGING_DIRNAME = ".staging"
+
+
+def mirror_dir(experiment_id):
+    return Path(settings.BIDS_MIRROR_ROOT) / f"experiment-{experiment_id}"
+
+def _load_state(root):
+    try:
+        with open(root / STATE_FILENAME) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _save_state(root, state):
+    tmp_path = root / (STATE_FILENAME + ".tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, root / STATE_FILENAME)
+
+def _swap_in(source, dest):
+    """
+    Replaces dest with source using renames only.
+    """
+    old = dest.with_name(dest.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if dest.exists():
+        os.rename(dest, old)
+    os.rename(source, dest)
+    shutil.rmtree(old, ignore_errors=True)
+
+def sync_experiment(experiment, participant_pks=None, full=False):
+    """
+    Brings the mirror of one experiment up to date.
+
+    Subject folders are rebuilt when full is set, when their participant is
+    in participant_pks, or when their label now maps to another participant
+    (labels are positional, so removing a participant renumbers later ones).
+
+    Returns {'updated': [...], 'removed': [...]} with subject labels.
+    """
+    root = mirror_dir(experiment.pk)
+    root.mkdir(parents=True, exist_ok=True)
+    staging = root / STAGING_DIRNAME
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+
+    state = _load_state(root).get('subjects', {})
+    participants_data, _ = plan_experiment_export(experiment, only_participants=set())
+    labels = {p['participant_id']: p['participant_pk'] for p in participants_data}
+    participant_pks = participant_pks or set()
+
+    stale = sorted(
+        label for label, pk in labels.items()
+        if full or state.get(label) != pk or pk in participant_pks
+    )
+    removed = sorted(set(state) - set(labels))
+
+    try:
+        if stale:
+            _, tasks = plan_experiment_export(experiment, only_participants={labels[label] for label in stale})
+            for task, nifti_path, json_path in run_conversions(tasks, staging):
+                if not nifti_path:
+                    print(f"⚠️ Conversion failed for DICOM {task['dicom_id']}, skipping...")
+            for label in stale:
+                if (staging / label).exists():
+                    _swap_in(staging / label, root / label)
+                else:
+                    # Participant without files: no subject folder
+                    shutil.rmtree(root / label, ignore_errors=True)
+
+        for label in removed:
+            shutil.rmtree(root / label, ignore_errors=True)
+
+        create_participants_tsv(staging, participants_data)
+        create_dataset_description(staging)
+        for name in ("participants.tsv", "dataset_description.json"):
+            os.replace(staging / name, root / name)
+
+        _save_state(root, {'subjects': labels})
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return {'updated': stale, 'removed': removed}
+
+def remove_mirror(experiment_id):
+    shutil.rmtree(mirror_dir(experiment_id), ignore_errors=True)
+
+def sync_pending_changes():
+    """
+    Replays the BidsChange journal. Returns {experiment_id: result} where
+    result is sync_experiment's summary, or None for removed mirrors.
+    """
+    changes = list(BidsChange.objects.order_by('id'))
+    if not changes:
+        return {}
+
+    pending = defaultdict(lambda: {'participants': set(), 'deleted': False})
+    for change in changes:
+        entry = pending[change.experiment_id]
+        if change.kind == BidsChange.KIND_DELETED:
+            entry['deleted'] = True
+        elif change.participant_id:
+            entry['participants'].add(change.participant_id)
+
+    experiments = Experiment.objects.in_bulk(list(pending))
+    results = {}
+    for experiment_id, entry in pending.items():
+        experiment = experiments.get(experiment_id)
+        if entry['deleted'] or experiment is None:
+            remove_mirror(experiment_id)
+            results[experiment_id] = None
+        else:
+            results[experiment_id] = sync_experiment(experiment, participant_pks=entry['participants'])
+
+    # Only what was replayed: changes journaled meanwhile wait for the next run
+    BidsChange.objects.filter(id__lte=changes[-1].id).delete()
+    return results
@@ -1,11 +1,13 @@
 import os
 import json
-import shutil
-import tempfile
 import pydicom
 import dicom2nifti
+import dicom2nifti.convert_dicom
 from pathlib import Path
 
+from . import deid, nifti_cache
+
+
 def normalize_subject_id(index):
     """
     Generates a BIDS-compliant subject ID: sub-01, sub-02, etc.
@@ -48,108 +50,106 @@ def detect_modality(ds):
 
     return modality_folder, suffix
 
-def anonymize_dicom(ds):
+def parse_dicom_date(value):
     """
-    Anonymizes a DICOM dataset in place.
+    Parses a DICOM DA value (YYYYMMDD) into a datetime.date, or None.
     """
-    sensitive_tags = [
-        "PatientName", "PatientID", "PatientBirthDate", "PatientSex",
-        "InstitutionName", "ReferringPhysicianName", "StudyInstanceUID",
-        "SeriesInstanceUID", "AccessionNumber"
-    ]
-
-    for tag in sensitive_tags:
-        if tag in ds:
-            ds.data_element(tag).value = ""
+    import datetime
 
-    # Generate new UIDs to ensure anonymity while keeping relationship if needed (though here we just random)
-    # For strict BIDS within a session, we might want to keep consistency, but for now random is safer for anonymization.
-    ds.StudyInstanceUID = pydicom.uid.generate_uid()
-    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
-    ds.SOPInstanceUID = pydicom.uid.generate_uid()
+    value = str(value or "").strip()
+    try:
+        return datetime.datetime.strptime(value[:8], "%Y%m%d").date()
+    except ValueError:
+        return None
 
-    def person_names_callback(ds, elem):
-        if elem.VR == "PN":
-            elem.value = "anonymous"
+def extract_series_metadata(ds):
+    """
+    Header fields stored on DicomFile so the BIDS layout can be planned
+    (and filtered) from the database without opening the file.
+    """
+    try:
+        series_number = int(ds.get("SeriesNumber", None))
+    except (TypeError, ValueError):
+        series_number = None
 
-    ds.walk(person_names_callback)
+    return {
+        'modality': str(ds.get("Modality", "") or "")[:16],
+        'series_description': str(ds.get("SeriesDescription", "") or "")[:255],
+        'study_instance_uid': str(ds.get("StudyInstanceUID", "") or "")[:64],
+        'series_instance_uid': str(ds.get("SeriesInstanceUID", "") or "")[:64],
+        'series_number': series_number,
+        'study_date': parse_dicom_date(ds.get("StudyDate", "")),
+    }
 
-    try:
-        ds.remove_private_tags()
-    except:
-        pass
+def anonymize_dicom(ds, uid_key):
+    """
+    Anonymizes a DICOM dataset in place with the PS3.15 Basic Profile (see deid).
+    UIDs are remapped with uid_key (deid.make_uid_key), so every process
+    given the same key maps a UID to the same value.
+    """
+    return deid.Deidentifier(uid_key).deidentify(ds)
 
-    return ds
+def write_minimal_sidecar(ds, dest_json):
+    """
+    Writes the minimal JSON sidecar used when the converter provides none.
+    """
+    with open(dest_json, 'w') as f:
+        json.dump({
+            "Modality": ds.get("Modality", "MR"),
+            "PatientName": "anonymous"
+        }, f, indent=4)
+    return dest_json
 
-def convert_dicom_to_nifti(dicom_path, output_dir, output_basename):
+def convert_dicom_to_nifti(dicom_path, output_dir, output_basename, ds=None, *, uid_key):
     """
-    Converts a single DICOM file (or series) to NIfTI.
+    Converts a single DICOM file to NIfTI.
+
+    The file is read once, anonymized in memory and handed to dicom2nifti
+    as a pydicom dataset, which writes straight to the destination: no
+    anonymized copy and no intermediate conversion directory on disk.
     
     Args:
         dicom_path: Path to the original DICOM file.
         output_dir: Pathlib Path to the output directory (e.g., .../sub-01/anat).
         output_basename: Base name for the output file (e.g., sub-01_T1w).
+        ds: Dataset already read from dicom_path (e.g. for detect_modality),
+            to avoid reading the file again. It is anonymized in place.
+        uid_key: UID remapping key for anonymize_dicom.
         
     Returns:
         Tuple of (nifti_path, json_path) or (None, None) if failed.
     """
-    temp_convert_dir = tempfile.mkdtemp()
-    temp_dicom_dir = tempfile.mkdtemp()
-    
     generated_nifti = None
     generated_json = None
+    dest_nifti = output_dir / f"{output_basename}.nii.gz"
+    dest_json = output_dir / f"{output_basename}.json"
     
     try:
-        # 1. Read and Anonymize
-        ds = pydicom.dcmread(dicom_path)
-        ds = anonymize_dicom(ds)
+        # 1. Read (once) and Anonymize in memory
+        if ds is None:
+            ds = pydicom.dcmread(dicom_path)
+        ds = anonymize_dicom(ds, uid_key)
         
-        # 2. Save to temp directory
-        temp_dicom_path = os.path.join(temp_dicom_dir, 'image.dcm')
-        ds.save_as(temp_dicom_path)
+        # dicom2nifti expects uncompressed datasets
+        if ds.file_meta.get("TransferSyntaxUID") and ds.file_meta.TransferSyntaxUID.is_compressed:
+            ds.decompress()
         
-        # 3. Try Convert using dicom2nifti first
+        # 2. Try Convert using dicom2nifti first
         print(f"Converting {dicom_path} to NIfTI...")
         try:
-            dicom2nifti.convert_directory(temp_dicom_dir, temp_convert_dir, compression=True, reorient=True)
+            dicom2nifti.convert_dicom.dicom_array_to_nifti([ds], str(dest_nifti), reorient_nifti=True)
         except Exception as e:
             print(f"⚠️ dicom2nifti failed: {e}, trying fallback method...")
         
-        # 4. Find generated files
-        nifti_files = list(Path(temp_convert_dir).glob("*.nii.gz"))
-        json_files = list(Path(temp_convert_dir).glob("*.json"))
-        
-        if nifti_files:
-            # Move NIfTI file
-            source_nifti = nifti_files[0]
-            dest_nifti = output_dir / f"{output_basename}.nii.gz"
-            shutil.move(str(source_nifti), str(dest_nifti))
+        if dest_nifti.exists():
             generated_nifti = dest_nifti
             print(f"✅ Generated NIfTI: {dest_nifti}")
-            
-            # Handle JSON sidecar
-            if json_files:
-                source_json = json_files[0]
-                dest_json = output_dir / f"{output_basename}.json"
-                shutil.move(str(source_json), str(dest_json))
-                generated_json = dest_json
-            else:
-                # Create minimal JSON if missing
-                dest_json = output_dir / f"{output_basename}.json"
-                with open(dest_json, 'w') as f:
-                    json.dump({
-                        "Modality": ds.get("Modality", "MR"),
-                        "PatientName": "anonymous"
-                    }, f, indent=4)
-                generated_json = dest_json
-            
+            generated_json = write_minimal_sidecar(ds, dest_json)
             print(f"✅ Generated JSON: {generated_json}")
         else:
             # Fallback: Use nibabel for single-slice DICOMs
             print(f"⚠️ dicom2nifti produced no output, using fallback conversion...")
-            dest_nifti = output_dir / f"{output_basename}.nii.gz"
             
-            # Use the existing convert_single_dicom_to_nifti function
             import numpy as np
             import nibabel as nib
             
@@ -162,14 +162,7 @@ def convert_dicom_to_nifti(dicom_path, output_dir, output_basename):
                     generated_nifti = dest_nifti
                     print(f"✅ Fallback conversion successful: {dest_nifti}")
                     
-                    # Create JSON
-                    dest_json = output_dir / f"{output_basename}.json"
-                    with open(dest_json, 'w') as f:
-                        json.dump({
-                            "Modality": ds.get("Modality", "MR"),
-                            "PatientName": "anonymous"
-                        }, f, indent=4)
-                    generated_json = dest_json
+                    generated_json = write_minimal_sidecar(ds, dest_json)
                 else:
                     print(f"❌ Image has invalid dimensions: {image.ndim}")
             else:
@@ -179,9 +172,6 @@ def convert_dicom_to_nifti(dicom_path, output_dir, output_basename):
         print(f"❌ Conversion error for {dicom_path}: {e}")
         import traceback
         traceback.print_exc()
-    finally:
-        shutil.rmtree(temp_convert_dir, ignore_errors=True)
-        shutil.rmtree(temp_dicom_dir, ignore_errors=True)
         
     return generated_nifti, generated_json
 
@@ -209,3 +199,76 @@ def create_participants_tsv(base_dir, participants_data):
         f.write("participant_id\tage\tsex\tgroup\n")
         for p in participants_data:
             f.write(f"{p['participant_id']}\t{p.get('age', 'n/a')}\t{p.get('sex', 'n/a')}\t{p.get('group', 'control')}\n")
+
+def build_output_basename(subject_id, modality_folder, suffix, index):
+    """
+    Builds the BIDS basename for the index-th file of a given kind.
+    func files get a run entity (sub-01_task-rest_run-01_bold),
+    anat and dwi files get an acq entity (sub-01_acq-01_T1w).
+    """
+    if modality_folder == 'func':
+        run_entity = f"run-{index:02d}"
+        if "task-rest" in suffix:
+            return f"{subject_id}_task-rest_{run_entity}_bold"
+        return f"{subject_id}_{run_entity}_{suffix}"
+
+    acq_entity = f"acq-{index:02d}"
+    return f"{subject_id}_{acq_entity}_{suffix}"
+
+def convert_dicom_to_nifti_cached(dicom_path, output_dir, output_basename, content_hash=None, cache_dir=None, ds=None, *, uid_key):
+    """
+    convert_dicom_to_nifti through the content-keyed conversion cache.
+    Without a content_hash or cache_dir it simply converts.
+    """
+    if not (content_hash and cache_dir):
+        return convert_dicom_to_nifti(dicom_path, output_dir, output_basename, ds=ds, uid_key=uid_key)
+
+    key = nifti_cache.cache_key(content_hash)
+    entry = nifti_cache.lookup(cache_dir, key)
+    if entry is not None:
+        return nifti_cache.materialize(entry, output_dir, output_basename)
+
+    nifti_path, json_path = convert_dicom_to_nifti(dicom_path, output_dir, output_basename, ds=ds, uid_key=uid_key)
+    if nifti_path:
+        nifti_cache.store(cache_dir, key, nifti_path, json_path)
+    return nifti_path, json_path
+
+def build_entities(modality_folder, suffix, index):
+    """
+    BIDS entities encoded by build_output_basename, as a dict.
+    """
+    if modality_folder == 'func':
+        if "task-rest" in suffix:
+            return {'task': 'rest', 'run': f"{index:02d}"}
+        return {'run': f"{index:02d}"}
+    return {'acq': f"{index:02d}"}
+
+def convert_task(task):
+    """
+    Process pool entry point: converts one planned export task.
+    task: dict with 'dicom_path', 'output_dir', 'output_basename' and
+    'uid_key' (for anonymization), and optionally 'content_hash' and
+    'cache_dir' to go through the cache.
+    Returns (task, nifti_path, json_path), with (None, None) if the file
+    could not be converted: a failure only skips that file, it never aborts
+    the export. When the cache is enabled and the task has no content_hash,
+    the hash is computed here and reported back as task['computed_hash'].
+
+    Lives here rather than next to the views so that worker processes
+    only need pydicom/dicom2nifti, not a configured Django.
+    """
+    try:
+        output_dir = Path(task['output_dir'])
+        output_dir.mkdir(parents=True, exist_ok=True)
+        if task.get('cache_dir') and not task.get('content_hash') and os.path.exists(task['dicom_path']):
+            task = dict(task, content_hash=nifti_cache.file_sha256(task['dicom_path']))
+            task['computed_hash'] = task['content_hash']
+        nifti_path, json_path = convert_dicom_to_nifti_cached(
+            task['dicom_path'], output_dir, task['output_basename'],
+            content_hash=task.get('content_hash'), cache_dir=task.get('cache_dir'),
+            uid_key=task['uid_key']
+        )
+    except Exception as e:
+        print(f"❌ Conversion error for {task['dicom_path']}: {e}")
+        return task, None, None
+    return task, nifti_path, json_path
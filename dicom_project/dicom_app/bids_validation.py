@@ -0,0 +1,170 @@
+"""
+Incremental BIDS validation.
+
+Each file is checked on its own (BIDS filename rules via bids-validator,
+JSON/TSV well-formedness, readable NIfTI header) and the result is stored
+in BidsValidationResult keyed by (path, content hash, validator version).
+Re-validating a dataset after a small change therefore only re-checks the
+files that changed; dataset-level rules (required files, sidecars) are
+cheap and evaluated every time from the list of paths.
+"""
+import json
+import os
+from importlib import metadata
+
+from bids_validator import BIDSValidator
+
+from .models import BidsValidationResult
+from .nifti_cache import file_sha256
+
+# Bump when check_file's rules change so cached results are ignored
+RULES_VERSION = 1
+
+
+def _validator_version():
+    try:
+        return f"bids-validator-{metadata.version('bids-validator')}+{RULES_VERSION}"
+    except metadata.PackageNotFoundError:
+        return f"bids-validator-unknown+{RULES_VERSION}"
+
+VALIDATOR_VERSION = _validator_version()
+
+_bids_validator = BIDSValidator()
+
+
+def _issue(severity, code, message):
+    return {'severity': severity, 'code': code, 'message': message}
+
+def check_file(relative_path, full_path):
+    """
+    Validates a single file of a dataset. relative_path is relative to the
+    dataset root, with forward slashes. Returns a list of issues.
+    """
+    issues = []
+    name = relative_path.rsplit('/', 1)[-1]
+
+    if not _bids_validator.is_bids('/' + relative_path):
+        issues.append(_issue('error', 'INVALID_FILENAME', f"{relative_path} does not follow BIDS naming"))
+
+    if name.endswith('.json'):
+        try:
+            with open(full_path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            issues.append(_issue('error', 'JSON_INVALID', f"Invalid JSON: {e}"))
+        else:
+            if not isinstance(data, dict):
+                issues.append(_issue('error', 'JSON_NOT_OBJECT', "JSON files must contain an object"))
+            elif relative_path == 'dataset_description.json':
+                for key in ('Name', 'BIDSVersion'):
+                    if not data.get(key):
+                        issues.append(_issue('error', 'DATASET_DESCRIPTION_FIELD_MISSING', f"Missing required field {key}"))
+
+    elif name.endswith('.tsv'):
+        try:
+            with open(full_path, encoding='utf-8') as f:
+                rows = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+        except (OSError, UnicodeDecodeError) as e:
+            issues.append(_issue('error', 'TSV_INVALID', f"Unreadable TSV: {e}"))
+        else:
+            if not rows:
+                issues.append(_issue('error', 'TSV_EMPTY', "TSV file has no header"))
+            else:
+                if name == 'participants.tsv' and rows[0][0] != 'participant_id':
+                    issues.append(_issue('error', 'PARTICIPANT_ID_COLUMN', "First column must be participant_id"))
+                if any(len(row) != len(rows[0]) for row in rows[1:]):
+                    issues.append(_issue('error', 'TSV_EQUAL_ROWS', "All rows must have as many columns as the header"))
+
+    elif name.endswith(('.nii', '.nii.gz')):
+        import nibabel as nib
+
+        try:
+            image = nib.load(full_path)
+        except Exception as e:
+            issues.append(_issue('error', 'NIFTI_UNREADABLE', f"Unreadable NIfTI: {e}"))
+        else:
+            if len(image.shape) < 3:
+                issues.append(_issue('warning', 'NIFTI_DIMENSIONS', f"Image has {len(image.shape)} dimensions, expected at least 3"))
+
+    return issues
+
+
+class DatasetValidator:
+    """
+    Collects per-file results while a dataset is being written (or walked)
+    and produces the final report. Usage: check() every file, then report().
+    """
+
+    def __init__(self):
+        self.paths = []
+        self.file_issues = {}
+        self.cached = 0
+
+    def check(self, relative_path, full_path):
+        relative_path = relative_path.replace('\\', '/')
+        content_hash = file_sha256(full_path)
+
+        result = BidsValidationResult.objects.filter(
+            path=relative_path,
+            content_hash=content_hash,
+            validator_version=VALIDATOR_VERSION
+        ).first()
+        if result is not None:
+            self.cached += 1
+            issues = result.issues
+        else:
+            issues = check_file(relative_path, full_path)
+            BidsValidationResult.objects.get_or_create(
+                path=relative_path,
+                content_hash=content_hash,
+                validator_version=VALIDATOR_VERSION,
+                defaults={'issues': issues}
+            )
+
+        self.paths.append(relative_path)
+        if issues:
+            self.file_issues[relative_path] = issues
+        return issues
+
+    def dataset_issues(self):
+        issues = []
+        paths = set(self.paths)
+        for required in ('dataset_description.json', 'participants.tsv'):
+            if required not in paths:
+                issues.append(_issue('error', 'MISSING_REQUIRED_FILE', f"{required} is missing"))
+        for path in sorted(paths):
+            if path.endswith('.nii.gz') and path[:-len('.nii.gz')] + '.json' not in paths:
+                issues.append(_issue('warning', 'SIDECAR_MISSING', f"{path} has no JSON sidecar"))
+        return issues
+
+    def report(self):
+        dataset_issues = self.dataset_issues()
+        all_issues = dataset_issues + [i for issues in self.file_issues.values() for i in issues]
+        return {
+            'validator': VALIDATOR_VERSION,
+            'valid': not any(i['severity'] == 'error' for i in all_issues),
+            'files_checked': len(self.paths),
+            'files_cached': self.cached,
+            'errors': sum(1 for i in all_issues if i['severity'] == 'error'),
+            'warnings': sum(1 for i in all_issues if i['severity'] == 'warning'),
+            'dataset_issues': dataset_issues,
+            'files': [
+                {'path': path, 'issues': issues}
+                for path, issues in sorted(self.file_issues.items())
+            ],
+        }
+
+def validate_directory(root):
+    """
+    Validates a BIDS dataset on disk (e.g. a mirror). Dot-directories such
+    as the mirror's staging area are skipped.
+    """
+    validator = DatasetValidator()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.startswith('.'):
+                continue
+            full_path = os.path.join(dirpath, filename)
+            validator.check(os.path.relpath(full_path, root), full_path)
+    return validator.report()
@@ -0,0 +1,158 @@
+"""
+Garbage collection of stored files.
+
+Deleting a DicomFile, ConsentFile or ExportJob row (directly or through a
+cascade) leaves its file in the storage. The post_delete signals record the
+name in the DeletedBlob table instead of deleting it: sharded DICOM files
+are shared by identical uploads, so a file may only go once no row uses it,
+and that check belongs outside the request. reclaim_deleted (run by the
+export worker) processes the tombstones older than BLOB_GC_GRACE_SECONDS;
+the grace period covers an upload that found the file already stored just
+before its last row went away.
+
+Files that never had a row (an upload that failed after storing its file,
+an interrupted export) are found by manage.py sweep_orphan_blobs, which
+lists the storage and deletes what no row references.
+
+Every reference check reads from the primary (db_router.use_primary), even
+inside a request: a lagging replica that has not seen a new row would get a
+live file deleted. Each file is checked on its own right before it is
+deleted, after the rate limiter's wait, and files modified after the
+cutoff are kept: an upload that reuses a stored file touches it
+(dicom_storage._store) before its row exists.
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+
+from .db_router import use_primary
+from .dicom_storage import recorded_names
+from .models import ConsentFile, DeletedBlob, DicomFile, ExportJob
+
+# Storage directories that only hold files owned by rows
+SWEEP_ROOTS = ('dicoms', 'consent_notes', 'exports')
+
+RECLAIM_BATCH_SIZE = 500
+
+
+class RateLimiter:
+    """
+    Spaces calls to wait() so they happen at most rate times per second
+    (unlimited when rate <= 0). Safe to share between threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_at = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def record_deleted(names):
+    """
+    Records tombstones for the stored files names (empty names are ignored).
+    """
+    DeletedBlob.objects.bulk_create([DeletedBlob(name=name) for name in set(names) if name])
+
+def referenced_names(names):
+    """
+    The subset of names that some row still uses. DicomFile rows match under
+    any of dicom_storage.recorded_names, other rows by name or with a stray
+    'media/' prefix; all of them are exact lookups on the name indexes.
+    """
+    names = set(names)
+    if not names:
+        return set()
+    found = set()
+    with use_primary():
+        for model, field, variants in (
+            (DicomFile, 'file', recorded_names),
+            (ConsentFile, 'file', lambda name: [name, f"media/{name}"]),
+            (ExportJob, 'archive', lambda name: [name, f"media/{name}"]),
+        ):
+            candidates = {recorded: name for name in names for recorded in variants(name)}
+            candidates.update((name, name) for name in names)
+            for recorded in model.objects.filter(**{f'{field}__in': candidates}).values_list(field, flat=True):
+                found.add(candidates[recorded])
+    return found
+
+def delete_unreferenced(names, storage=None, limiter=None, cutoff=None):
+    """
+    Deletes the files among names that no row uses and, given a cutoff,
+    that were not modified after it. Returns their names.
+
+    Each name is checked on its own after limiter.wait(), right before its
+    delete: a check made for the whole batch goes stale while it sleeps.
+    """
+    storage = storage or default_storage
+    deleted = []
+    for name in sorted(set(names)):
+        if limiter:
+            limiter.wait()
+        if referenced_names([name]):
+            continue
+        if cutoff is not None:
+            try:
+                if storage.get_modified_time(name) > cutoff:
+                    continue
+            except FileNotFoundError:
+                # Deleting a missing file again is a no-op
+                pass
+        storage.delete(name)
+        deleted.append(name)
+    return deleted
+
+def reclaim_deleted(batch_size=RECLAIM_BATCH_SIZE, grace=None, rate=None):
+    """
+    Processes up to batch_size tombstones older than grace seconds (default
+    BLOB_GC_GRACE_SECONDS), deleting at most rate files per second (default
+    BLOB_GC_RATE, 0 = unlimited). Returns (files deleted, tombstones done).
+    """
+    grace = settings.BLOB_GC_GRACE_SECONDS if grace is None else grace
+    rate = settings.BLOB_GC_RATE if rate is None else rate
+    cutoff = timezone.now() - timedelta(seconds=grace)
+    with use_primary():
+        tombstones = list(DeletedBlob.objects.filter(created_at__lte=cutoff).order_by('id')[:batch_size])
+    if not tombstones:
+        return 0, 0
+    deleted = delete_unreferenced([t.name for t in tombstones], limiter=RateLimiter(rate), cutoff=cutoff)
+    # Files still referenced or reused are live again: their tombstones go
+    # as well
+    DeletedBlob.objects.filter(pk__in=[t.pk for t in tombstones]).delete()
+    return len(deleted), len(tombstones)
+
+def _list_directory(storage, directory):
+    # (subdirectories, files) of a storage directory, files as full names
+    try:
+        dirs, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return [], []
+    return [f"{directory}/{d}" for d in dirs], [f"{directory}/{f}" for f in files]
+
+def iter_stored_files(pool, storage=None, roots=SWEEP_ROOTS):
+    """
+    Yields the names of every file under roots, listing directories in
+    parallel on pool (a ThreadPoolExecutor).
+    """
+    storage = storage or default_storage
+    pending = {pool.submit(_list_directory, storage, root) for root in roots}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            dirs, files = future.result()
+            pending.update(pool.submit(_list_directory, storage, d) for d in dirs)
+            yield from files
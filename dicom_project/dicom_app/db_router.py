@@ -0,0 +1,109 @@
+"""
+Read-replica routing.
+
+Reads go to one of the DATABASE_REPLICAS and writes to the primary
+('default'). A replica may lag behind the primary, so reads stay on the
+primary when they could observe that lag:
+
+* for the rest of a request once it has written anything;
+* for every request of a client during REPLICA_STICKY_SECONDS after it
+  wrote (ReplicaStickinessMiddleware pins it with a cookie), so a user's
+  own upload or edit is visible on the next page;
+* inside transactions and use_primary() blocks (e.g. when filling the
+  application cache, which would otherwise keep a stale result);
+* outside requests: management commands and workers (export worker, mirror
+  sync, stats reconciliation, storage GC) act on what they read, so they
+  only ever read from the primary.
+
+Without replicas configured the router sends everything to 'default'.
+"""
+import contextlib
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+STICKY_COOKIE = 'db_primary_until'
+
+_pinned = contextvars.ContextVar('db_pinned', default=False)
+# None outside requests, which always read from the primary
+_wrote = contextvars.ContextVar('db_wrote', default=None)
+_replica = contextvars.ContextVar('db_replica', default=None)
+
+
+def replicas():
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+@contextlib.contextmanager
+def use_primary():
+    """
+    Routes the reads made inside the block to the primary.
+    """
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            # Related objects are read from where the instance came from
+            return instance._state.db
+        aliases = replicas()
+        if not aliases or _pinned.get() or _wrote.get() is not False or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # One replica per request, so its pages are consistent
+        alias = _replica.get()
+        if alias is None:
+            alias = random.choice(aliases)
+            _replica.set(alias)
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if _wrote.get() is False:
+            _wrote.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema through replication
+        return db not in replicas()
+
+
+class ReplicaStickinessMiddleware:
+    """
+    Keeps a client on the primary for REPLICA_STICKY_SECONDS after a request
+    of it wrote to the database. Must come before the middleware that may
+    write while processing the response (sessions).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(STICKY_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        pinned = request.method not in ('GET', 'HEAD', 'OPTIONS') or pinned_until > time.time()
+
+        tokens = (_pinned.set(pinned), _wrote.set(False), _replica.set(None))
+        try:
+            response = self.get_response(request)
+            if _wrote.get() and replicas():
+                seconds = settings.REPLICA_STICKY_SECONDS
+                response.set_cookie(STICKY_COOKIE, str(time.time() + seconds), max_age=seconds, httponly=True, samesite='Lax')
+            return response
+        finally:
+            for var, token in zip((_pinned, _wrote, _replica), tokens):
+                var.reset(token)
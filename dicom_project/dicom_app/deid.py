@@ -0,0 +1,433 @@
+"""
+De-identification following the DICOM PS3.15 Basic Application Level
+Confidentiality Profile (Annex E, table E.1-1).
+
+The profile is compiled once, at import, into a table of tag -> action, so
+de-identifying a dataset is a set intersection between its tags and the
+table instead of a Python walk over every element. UIDs are replaced by a
+keyed, deterministic mapping (HMAC-SHA256 of the original UID under a secret
+key, rendered as a 2.25 UID): every instance of a study or series gets the
+same new UID, so study/series relationships survive de-identification
+while the original UIDs cannot be recovered without the key.
+
+Like bids_utils this module does not import Django: the key is passed in
+by the caller, and deidentify_files() runs the work on a process pool.
+"""
+import hashlib
+import hmac
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+from pydicom.datadict import DicomDictionary, tag_for_keyword
+
+from .dicom_splice import encode_header, read_header, write_spliced
+
+# Bump whenever the table or the replacement values change the output
+PROFILE_VERSION = 1
+
+# Files per task sent to the worker pool
+BATCH_SIZE = 32
+
+# Action codes of table E.1-1
+DUMMY = 'D'      # replace with a non-zero length dummy value
+ZERO = 'Z'       # replace with a zero length value
+REMOVE = 'X'     # remove
+KEEP = 'K'       # keep
+UID = 'U'        # replace with a consistently remapped UID
+
+# Composite codes ("X/Z", "X/D", ...) let the implementation choose as long
+# as the IOD stays valid; we pick the least destructive option, which keeps
+# Type 1/2 attributes present (dummy or empty) instead of removing them.
+_COMPOSITE = {
+    'Z/D': ZERO,
+    'X/Z': ZERO,
+    'X/D': DUMMY,
+    'X/Z/D': ZERO,
+    'X/Z/U*': UID,
+}
+
+BASIC_PROFILE = {
+    # Patient
+    'PatientName': 'Z',
+    'PatientID': 'Z',
+    'PatientBirthDate': 'Z',
+    'PatientSex': 'Z',
+    'PatientBirthTime': 'X',
+    'PatientAge': 'X',
+    'PatientSize': 'X',
+    'PatientWeight': 'X',
+    'PatientAddress': 'X',
+    'PatientTelephoneNumbers': 'X',
+    'PatientBirthName': 'X',
+    'PatientMotherBirthName': 'X',
+    'OtherPatientIDs': 'X',
+    'OtherPatientIDsSequence': 'X',
+    'OtherPatientNames': 'X',
+    'IssuerOfPatientID': 'X',
+    'PatientInsurancePlanCodeSequence': 'X',
+    'PatientPrimaryLanguageCodeSequence': 'X',
+    'PatientReligiousPreference': 'X',
+    'PatientComments': 'X',
+    'PatientState': 'X',
+    'PatientSexNeutered': 'X/Z',
+    'MilitaryRank': 'X',
+    'BranchOfService': 'X',
+    'EthnicGroup': 'X',
+    'Occupation': 'X',
+    'CountryOfResidence': 'X',
+    'RegionOfResidence': 'X',
+    'MedicalRecordLocator': 'X',
+    'MedicalAlerts': 'X',
+    'Allergies': 'X',
+    'SmokingStatus': 'X',
+    'PregnancyStatus': 'X',
+    'LastMenstrualDate': 'X',
+    'AdditionalPatientHistory': 'X',
+    'ResponsiblePerson': 'X',
+    'ResponsibleOrganization': 'X',
+    'ReferencedPatientSequence': 'X',
+    'ReferencedPatientAliasSequence': 'X',
+    # Study / visit
+    'StudyDate': 'Z',
+    'StudyTime': 'Z',
+    'StudyID': 'Z',
+    'AccessionNumber': 'Z',
+    'StudyDescription': 'X',
+    'ReferringPhysicianName': 'Z',
+    'ReferringPhysicianAddress': 'X',
+    'ReferringPhysicianTelephoneNumbers': 'X',
+    'ReferringPhysicianIdentificationSequence': 'X',
+    'PhysiciansOfRecord': 'X',
+    'PhysiciansOfRecordIdentificationSequence': 'X',
+    'NameOfPhysiciansReadingStudy': 'X',
+    'PhysiciansReadingStudyIdentificationSequence': 'X',
+    'RequestingPhysician': 'X',
+    'RequestingService': 'X',
+    'AdmittingDiagnosesDescription': 'X',
+    'AdmittingDiagnosesCodeSequence': 'X',
+    'AdmissionID': 'X',
+    'ReferencedStudySequence': 'X/Z',
+    'RequestAttributesSequence': 'X',
+    'RequestedProcedureDescription': 'X/Z',
+    'RequestedProcedureID': 'X',
+    'ScheduledProcedureStepDescription': 'X',
+    'ScheduledProcedureStepID': 'X',
+    'PerformedProcedureStepDescription': 'X',
+    'PerformedProcedureStepID': 'X',
+    'PerformedProcedureStepStartDate': 'X',
+    'PerformedProcedureStepStartTime': 'X',
+    'PerformedProcedureStepEndDate': 'X',
+    'PerformedProcedureStepEndTime': 'X',
+    'ReferencedPerformedProcedureStepSequence': 'X/Z/D',
+    'OrderCallbackPhoneNumber': 'X',
+    'OrderEnteredBy': 'X',
+    'OrderEntererLocation': 'X',
+    'ReasonForTheRequestedProcedure': 'X',
+    # Series / equipment
+    'SeriesDate': 'X',
+    'SeriesTime': 'X',
+    'SeriesDescription': 'X',
+    'AcquisitionDate': 'X/Z',
+    'AcquisitionTime': 'X/Z',
+    'AcquisitionDateTime': 'X/Z',
+    'ContentDate': 'Z/D',
+    'ContentTime': 'Z/D',
+    'OverlayDate': 'X',
+    'OverlayTime': 'X',
+    'CurveDate': 'X',
+    'CurveTime': 'X',
+    'InstitutionName': 'X/Z/D',
+    'InstitutionAddress': 'X',
+    'InstitutionalDepartmentName': 'X',
+    'InstitutionCodeSequence': 'X/Z/D',
+    'StationName': 'X/Z/D',
+    'DeviceSerialNumber': 'X/Z/D',
+    'PlateID': 'X',
+    'DetectorID': 'X/D',
+    'GantryID': 'X',
+    'GeneratorID': 'X',
+    'CassetteID': 'X',
+    'OperatorsName': 'X/Z/D',
+    'OperatorIdentificationSequence': 'X',
+    'PerformingPhysicianName': 'X',
+    'PerformingPhysicianIdentificationSequence': 'X',
+    'ProtocolName': 'X/D',
+    'PerformedStationName': 'X/Z',
+    'PerformedLocation': 'X/Z',
+    'ImageComments': 'X',
+    'FrameComments': 'X',
+    'DerivationDescription': 'X',
+    'ContentCreatorName': 'Z',
+    'VerifyingObserverName': 'D',
+    'VerifyingObserverIdentificationCodeSequence': 'Z',
+    'PersonName': 'D',
+    'TextComments': 'X',
+    'TextString': 'X',
+    'AdmittingDate': 'X',
+    'AdmittingTime': 'X',
+    'DischargeDiagnosisDescription': 'X',
+    'ServiceEpisodeID': 'X',
+    'ServiceEpisodeDescription': 'X',
+    'VisitComments': 'X',
+    'CurrentPatientLocation': 'X',
+    'PatientInstitutionResidence': 'X',
+    'ScheduledPatientInstitutionResidence': 'X',
+    'DigitalSignaturesSequence': 'X',
+    'ModifiedAttributesSequence': 'X',
+    'OriginalAttributesSequence': 'X',
+    # UIDs
+    'StudyInstanceUID': 'U',
+    'SeriesInstanceUID': 'U',
+    'SOPInstanceUID': 'U',
+    'FrameOfReferenceUID': 'U',
+    'SynchronizationFrameOfReferenceUID': 'U',
+    'ReferencedFrameOfReferenceUID': 'U',
+    'RelatedFrameOfReferenceUID': 'U',
+    'ReferencedSOPInstanceUID': 'U',
+    'ReferencedSOPInstanceUIDInFile': 'U',
+    'DimensionOrganizationUID': 'U',
+    'IrradiationEventUID': 'U',
+    'ConcatenationUID': 'U',
+    'CreatorVersionUID': 'U',
+    'DeviceUID': 'U',
+    'DoseReferenceUID': 'U',
+    'FiducialUID': 'U',
+    'InstanceCreatorUID': 'U',
+    'PaletteColorLookupTableUID': 'U',
+    'LargePaletteColorLookupTableUID': 'U',
+    'StorageMediaFileSetUID': 'U',
+    'TemplateExtensionCreatorUID': 'U',
+    'TemplateExtensionOrganizationUID': 'U',
+    'TransactionUID': 'U',
+    'UID': 'U',
+    'MediaStorageSOPInstanceUID': 'U',
+}
+
+# Dummy values by VR, for D actions
+_DUMMY_VALUES = {
+    'PN': 'ANONYMOUS',
+    'LO': 'ANONYMIZED',
+    'SH': 'ANONYMIZED',
+    'LT': 'ANONYMIZED',
+    'ST': 'ANONYMIZED',
+    'UT': 'ANONYMIZED',
+    'CS': 'ANONYMIZED',
+    'DA': '19000101',
+    'TM': '000000.00',
+    'DT': '19000101000000.00',
+    'AS': '000Y',
+    'IS': '0',
+    'DS': '0',
+}
+
+
+def _compile(profile):
+    table = {}
+    for keyword, code in profile.items():
+        tag = tag_for_keyword(keyword)
+        if tag is None:
+            raise ValueError(f"Unknown DICOM keyword in profile: {keyword}")
+        table[tag] = _COMPOSITE.get(code, code)
+    return table
+
+ACTION_TABLE = _compile(BASIC_PROFILE)
+_ACTION_TAGS = frozenset(ACTION_TABLE)
+
+# Elements that need a look even when the profile does not list them:
+# sequences are recursed into, and person names not covered by the table
+# are emptied (names hide in many attributes the table cannot enumerate).
+_SEQUENCE_TAGS = frozenset(tag for tag, entry in DicomDictionary.items() if entry[0] == 'SQ')
+_PERSON_NAME_TAGS = frozenset(tag for tag, entry in DicomDictionary.items() if entry[0] == 'PN') - _ACTION_TAGS
+
+
+def make_uid_key(secret):
+    """
+    Derives the UID remapping key from a secret (str or bytes).
+    """
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return hashlib.sha256(b"dicomhub-deid-uid:" + secret).digest()
+
+def remap_uid(uid, key):
+    """
+    Maps a UID to a new 2.25 UID. Same (uid, key) -> same result.
+    """
+    digest = hmac.new(key, str(uid).strip().encode(), hashlib.sha256).digest()
+    # 2.25 UIDs carry a 128-bit integer: at most 44 characters, well under 64
+    return "2.25." + str(int.from_bytes(digest[:16], 'big'))
+
+
+class Deidentifier:
+    """
+    Applies the compiled profile to datasets. One instance can be reused
+    for any number of datasets; remapped UIDs are memoized, which matters
+    since every instance of a series repeats the same study/series UIDs.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._uids = {}
+
+    def uid(self, value):
+        mapped = self._uids.get(value)
+        if mapped is None:
+            mapped = self._uids[value] = remap_uid(value, self.key)
+        return mapped
+
+    def _remap_value(self, value):
+        if isinstance(value, (list, pydicom.multival.MultiValue)):
+            return [self.uid(v) for v in value]
+        return self.uid(value) if value else value
+
+    def _apply(self, ds, tag, action):
+        if action == KEEP:
+            return
+        if action == REMOVE:
+            del ds[tag]
+            return
+
+        elem = ds[tag]
+        if action == UID:
+            if elem.VR == 'SQ':
+                # X/Z/U* sequences: keep the structure, remap UIDs inside
+                return
+            elem.value = self._remap_value(elem.value)
+        elif action == ZERO or elem.VR == 'SQ':
+            elem.value = [] if elem.VR == 'SQ' else None
+        else:
+            dummy = _DUMMY_VALUES.get(elem.VR)
+            elem.value = dummy if dummy is not None else None
+
+    def _clean(self, ds):
+        tags = set(ds.keys())
+
+        for tag in [t for t in tags if t.is_private or 0x5000 <= t.group <= 0x50FF
+                    or (0x6000 <= t.group <= 0x60FF and t.element in (0x3000, 0x4000))]:
+            # Private elements, curves and overlay data/comments: X
+            del ds[tag]
+            tags.discard(tag)
+
+        for tag in tags & _ACTION_TAGS:
+            self._apply(ds, tag, ACTION_TABLE[tag])
+
+        for tag in tags & _PERSON_NAME_TAGS:
+            ds[tag].value = None
+
+        for tag in tags & _SEQUENCE_TAGS:
+            if tag in ds:
+                for item in ds[tag].value or ():
+                    self._clean(item)
+
+    def deidentify(self, ds):
+        """
+        De-identifies ds in place (file meta included) and returns it.
+        """
+        self._clean(ds)
+
+        file_meta = getattr(ds, 'file_meta', None)
+        if file_meta is not None and 'SOPInstanceUID' in ds:
+            file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+        ds.PatientIdentityRemoved = 'YES'
+        ds.DeidentificationMethod = f"DICOM PS3.15 Basic Profile (DICOM HUB v{PROFILE_VERSION})"
+        return ds
+
+
+def _uids(ds):
+    return (ds.get('StudyInstanceUID', ''), ds.get('SeriesInstanceUID', ''), ds.get('SOPInstanceUID', ''))
+
+def _write_deidentified(deidentifier, source, dest):
+    # Only the header is parsed and rewritten; Pixel Data is spliced from source
+    ds, span = read_header(source)
+    deidentifier.deidentify(ds)
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    write_spliced(ds, source, dest, span)
+    return _uids(ds)
+
+def deidentify_file(source, dest, key):
+    """
+    Reads source, de-identifies it and writes it to dest.
+    Returns the de-identified (StudyInstanceUID, SeriesInstanceUID,
+    SOPInstanceUID) so callers can lay the output out by study and series.
+    """
+    return _write_deidentified(Deidentifier(key), source, dest)
+
+def _deidentify_header(deidentifier, source):
+    ds, span = read_header(source)
+    deidentifier.deidentify(ds)
+    return encode_header(ds), span, _uids(ds)
+
+def _files_batch(batch, key):
+    results = []
+    deidentifier = Deidentifier(key)
+    for source, dest in batch:
+        try:
+            results.append((source, dest, _write_deidentified(deidentifier, source, dest), None))
+        except Exception as e:
+            results.append((source, dest, None, str(e)))
+    return results
+
+def _headers_batch(batch, key):
+    results = []
+    deidentifier = Deidentifier(key)
+    for source in batch:
+        try:
+            header, span, uids = _deidentify_header(deidentifier, source)
+            results.append((source, header, span, uids, None))
+        except Exception as e:
+            results.append((source, None, None, None, str(e)))
+    return results
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _run_batches(batch_func, items, key, workers, batch_size):
+    # At most two batches per worker in flight, results in input order
+    if workers <= 1:
+        for batch in _batches(items, batch_size):
+            yield from batch_func(batch, key)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        in_flight = deque()
+        for batch in _batches(items, batch_size):
+            in_flight.append(executor.submit(batch_func, batch, key))
+            if len(in_flight) >= workers * 2:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+def deidentify_files(items, key, workers=1, batch_size=BATCH_SIZE):
+    """
+    De-identifies (source, dest) pairs, yielding (source, dest, uids, error)
+    per file in input order; error is None on success and uids as returned
+    by deidentify_file.
+
+    items may be a lazy iterable: files are read in batches of batch_size
+    and at most two batches per worker are in flight, so memory stays
+    bounded however many files there are. With a single worker everything
+    runs in-process.
+    """
+    return _run_batches(_files_batch, items, key, workers, batch_size)
+
+def deidentify_headers(sources, key, workers=1, batch_size=BATCH_SIZE):
+    """
+    Like deidentify_files, but nothing is written: yields
+    (source, header, span, uids, error) where header is the encoded
+    de-identified header and span the Pixel Data byte range of source
+    (see dicom_splice). Header + source[span] is the de-identified file,
+    which lets archives stream it without any copy on disk.
+    """
+    return _run_batches(_headers_batch, sources, key, workers, batch_size)
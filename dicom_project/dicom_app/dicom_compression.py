@@ -0,0 +1,72 @@
+"""
+Lossless compression of stored DICOM files.
+
+Uncompressed Pixel Data is transcoded to RLE Lossless, a standard transfer
+syntax: the result is still a valid DICOM file that every reader decodes
+(pydicom decodes it for the viewer, bids_utils decompresses it before
+dicom2nifti) and the pixel values are bit-for-bit the same. pydicom encodes
+it with GDCM when available, otherwise with its own encoder, so no extra
+dependency is needed. A file is only transcoded if that makes it smaller:
+noisy images can grow under RLE.
+
+Django-free, like deid: used from the recompression worker processes.
+"""
+import pydicom
+from pydicom.encaps import encapsulate
+from pydicom.encoders import get_encoder
+from pydicom.uid import RLELossless
+
+RLE = 'rle'
+MODES = {RLE: RLELossless}
+
+# Above this the basic offset table overflows; such files are left as they are
+_MAX_ENCAPSULATED = 2 ** 32 - 1
+
+
+def compress_dataset(ds, mode=RLE):
+    """
+    Transcodes ds in place to the lossless transfer syntax of mode.
+    Returns True if it did; False leaves ds untouched (no Pixel Data,
+    already compressed, a layout the encoder does not support, or no gain).
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown DICOM compression mode: {mode!r}")
+    transfer_syntax = getattr(ds, 'file_meta', None) and ds.file_meta.get('TransferSyntaxUID')
+    if 'PixelData' not in ds or not transfer_syntax or transfer_syntax.is_compressed:
+        return False
+
+    encoder = get_encoder(MODES[mode])
+    try:
+        encoded = encapsulate(list(encoder.iter_encode(ds)))
+    except Exception:
+        return False
+    if len(encoded) >= len(ds.PixelData) or len(encoded) > _MAX_ENCAPSULATED:
+        return False
+
+    # As Dataset.compress, which cannot back out when there is no gain
+    ds.PixelData = encoded
+    ds['PixelData'].VR = 'OB'
+    ds['PixelData'].is_undefined_length = True
+    ds.is_implicit_VR = False
+    ds.is_little_endian = True
+    ds.file_meta.TransferSyntaxUID = MODES[mode]
+    if ds.get('SamplesPerPixel', 1) > 1:
+        ds.PlanarConfiguration = 1
+    return True
+
+def compress_file(source, dest, mode=RLE):
+    """
+    Writes a compressed copy of the DICOM file source to dest.
+    Returns True if it did, False (nothing written) when compress_dataset
+    declines the file.
+    """
+    header = pydicom.dcmread(source, stop_before_pixels=True)
+    transfer_syntax = header.file_meta.get('TransferSyntaxUID')
+    if not transfer_syntax or transfer_syntax.is_compressed:
+        # Skipped without reading the Pixel Data
+        return False
+    ds = pydicom.dcmread(source)
+    if not compress_dataset(ds, mode):
+        return False
+    ds.save_as(dest, write_like_original=False)
+    return True
@@ -0,0 +1,86 @@
+"""
+Experiment-level export of the de-identified DICOM files themselves.
+
+The archive is laid out as <subject>/<StudyInstanceUID>/<SeriesInstanceUID>/
+<SOPInstanceUID>.dcm, with subject labels as in the BIDS export and the
+remapped UIDs of deid. Headers are de-identified in the worker pool; each
+entry is then streamed as the new header followed by the original Pixel
+Data read straight from the stored file, so nothing is written to disk.
+On storages without local paths each source is staged (copied) just before
+its header is de-identified and removed once its entry is streamed.
+"""
+import os
+import shutil
+import tempfile
+import traceback
+from itertools import chain
+
+from .bids_export import get_export_workers, get_uid_key, plan_experiment_export
+from .deid import deidentify_headers
+from .dicom_storage import stage
+from .dicom_splice import iter_pixel_data
+from .zip_stream import ZipStream
+
+ARCHIVE_DIRNAME = "dicom"
+
+
+def _arcname(subject_id, uids, used):
+    study, series, sop = (uid or 'unknown' for uid in uids)
+    arcname = f"{ARCHIVE_DIRNAME}/{subject_id}/{study}/{series}/{sop}.dcm"
+    # The same instance uploaded twice must not produce duplicate entries
+    base, n = arcname[:-len('.dcm')], 1
+    while arcname in used:
+        n += 1
+        arcname = f"{base}_{n}.dcm"
+    used.add(arcname)
+    return arcname
+
+def stream_experiment_dicom(experiment, workers=None, filters=None, progress=None):
+    """
+    Generator of ZIP bytes with the experiment's de-identified DICOM files.
+    filters select a subset exactly as for the BIDS export; progress, if
+    given, is called as progress(done, total).
+    """
+    if workers is None:
+        workers = get_export_workers()
+    _, tasks = plan_experiment_export(experiment, filters=filters)
+    archive = ZipStream()
+    used = set()
+
+    staging = tempfile.mkdtemp()
+    copies = set()
+
+    def sources():
+        # Lazy: only the batches in flight are staged at any time
+        for task in tasks:
+            path, is_copy = stage(task['dicom_name'], staging)
+            if is_copy:
+                copies.add(path)
+            yield path
+
+    results = deidentify_headers(sources(), get_uid_key(), workers)
+    try:
+        for done, (task, (source, header, span, uids, error)) in enumerate(zip(tasks, results), start=1):
+            if progress:
+                progress(done, len(tasks))
+            if error:
+                print(f"⚠️ De-identification failed for DICOM {task['dicom_id']}: {error}, skipping...")
+            else:
+                size = len(header) + (span[1] if span else 0)
+                yield from archive.write_chunks(
+                    _arcname(task['subject_id'], uids, used),
+                    chain([header], iter_pixel_data(source, span)),
+                    size=size
+                )
+            if source in copies:
+                copies.discard(source)
+                os.remove(source)
+        yield from archive.close()
+    except Exception:
+        # Headers are already sent: the client gets a truncated archive
+        traceback.print_exc()
+        raise
+    finally:
+        # Stops the worker pool if the consumer went away early
+        results.close()
+        shutil.rmtree(staging, ignore_errors=True)
@@ -0,0 +1,150 @@
+"""
+Header-only rewriting of DICOM files.
+
+De-identification only touches header elements, yet dcmread + save_as
+loads and rewrites the whole Pixel Data blob, which for multi-frame or
+enhanced objects is almost all of the file. Here the header is read with
+stop_before_pixels, modified and encoded on its own, and the original Pixel
+Data element (native or encapsulated, exactly as stored) is copied from the
+source file with os.sendfile, so it never passes through Python memory.
+
+Django-free, like deid: used from the de-identification worker processes.
+"""
+import io
+import os
+import struct
+
+import pydicom
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+# Explicit VR elements whose length is stored in 4 bytes (after 2 reserved)
+_LONG_LENGTH_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_ITEM_TAG = (0xFFFE, 0xE000)
+_SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+
+SENDFILE_CHUNK = 1024 ** 3
+
+
+def _element_span(fp, is_little_endian, is_implicit_VR):
+    """
+    Size in bytes of the element starting at fp's position, header included.
+    Encapsulated (undefined length) values are measured by hopping over the
+    item headers, without reading the fragments.
+    """
+    endian = '<' if is_little_endian else '>'
+    start = fp.tell()
+
+    header = fp.read(8)
+    if len(header) < 8:
+        raise ValueError("Truncated element header")
+    if is_implicit_VR:
+        length = struct.unpack(endian + 'L', header[4:8])[0]
+    elif header[4:6] in _LONG_LENGTH_VRS:
+        length = struct.unpack(endian + 'L', fp.read(4))[0]
+    else:
+        length = struct.unpack(endian + 'H', header[6:8])[0]
+
+    if length != _UNDEFINED_LENGTH:
+        return fp.tell() - start + length
+
+    while True:
+        item = fp.read(8)
+        if len(item) < 8:
+            raise ValueError("Encapsulated Pixel Data has no sequence delimiter")
+        group, element, item_length = struct.unpack(endian + 'HHL', item)
+        if (group, element) == _SEQUENCE_DELIMITER:
+            return fp.tell() - start
+        if (group, element) != _ITEM_TAG:
+            raise ValueError(f"Unexpected tag ({group:04X},{element:04X}) in encapsulated Pixel Data")
+        fp.seek(item_length, os.SEEK_CUR)
+
+def read_header(path):
+    """
+    Reads a DICOM file up to its Pixel Data.
+    Returns (dataset, span): span is the (offset, length) of the Pixel Data
+    element in the file, or None if there is none. Deflated files cannot be
+    spliced (offsets in the file mean nothing): they are read whole and
+    returned with span None, so write_spliced still writes them correctly.
+    Elements after Pixel Data (trailing padding, digital signatures) are
+    not part of the dataset and are dropped on write.
+    """
+    with open(path, 'rb') as fp:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+        if ds.file_meta.get('TransferSyntaxUID') == DeflatedExplicitVRLittleEndian:
+            fp.seek(0)
+            return pydicom.dcmread(fp), None
+
+        # dcmread rewinds to the start of the element it stopped at
+        offset = fp.tell()
+        if not fp.read(1):
+            return ds, None
+        fp.seek(offset)
+        return ds, (offset, _element_span(fp, ds.is_little_endian, ds.is_implicit_VR))
+
+def encode_header(ds):
+    """
+    Preamble, file meta and dataset (everything before Pixel Data) as bytes,
+    in the dataset's original encoding so the spliced element matches it.
+    """
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, ds, write_like_original=False)
+    return buffer.getvalue()
+
+def copy_range(src, dst, offset, count):
+    """
+    Copies count bytes at offset of the open file src to the current
+    position of the open file dst, with sendfile when the platform has it.
+    """
+    dst.flush()
+    if hasattr(os, 'sendfile'):
+        try:
+            while count > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, min(count, SENDFILE_CHUNK))
+                if sent == 0:
+                    raise ValueError("Source file ended before the Pixel Data did")
+                offset += sent
+                count -= sent
+            dst.seek(0, os.SEEK_END)
+            return
+        except OSError:
+            # e.g. filesystems without sendfile support; continue by hand
+            dst.seek(0, os.SEEK_END)
+
+    src.seek(offset)
+    while count > 0:
+        chunk = src.read(min(count, 1024 * 1024))
+        if not chunk:
+            raise ValueError("Source file ended before the Pixel Data did")
+        dst.write(chunk)
+        count -= len(chunk)
+
+def write_spliced(ds, source, dest, span):
+    """
+    Writes ds (a header read by read_header, possibly modified) to dest,
+    followed by the Pixel Data bytes of source at span.
+    """
+    header = encode_header(ds)
+    with open(dest, 'wb') as out:
+        out.write(header)
+        if span is not None:
+            offset, length = span
+            with open(source, 'rb') as src:
+                copy_range(src, out, offset, length)
+
+def iter_pixel_data(source, span, chunk_size=1024 * 1024):
+    """
+    The Pixel Data element of source at span, as a generator of chunks.
+    """
+    if span is None:
+        return
+    offset, length = span
+    with open(source, 'rb') as src:
+        src.seek(offset)
+        while length > 0:
+            chunk = src.read(min(length, chunk_size))
+            if not chunk:
+                raise ValueError("Source file ended before the Pixel Data did")
+            yield chunk
+            length -= len(chunk)
@@ -0,0 +1,202 @@
+"""
+Storage layout of uploaded DICOM files.
+
+Files are stored through the Django storage API (MEDIA_ROOT by default)
+under a name derived from their SHA-256, sharded by its first two bytes:
+
+    dicoms/raw/3f/a2/3fa2...e1.dcm
+
+so no directory grows beyond a few hundred entries however many files are
+uploaded, and identical uploads share one stored file. Older files live in
+the flat dicoms/raw/ directory (sometimes recorded with a stray 'media/'
+prefix); manage.py shard_dicom_storage moves them into this layout.
+
+Every read and write goes through the storage, so an object store works as
+well as a local MEDIA_ROOT. Code that needs a local path (the conversion and
+de-identification process pools, dicom2nifti) asks for stage(): on local
+storage that is the stored file itself, otherwise a copy streamed in chunks.
+"""
+import hashlib
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, default_storage
+
+from .dicom_compression import compress_dataset
+
+RAW_DIR = 'dicoms/raw'
+# Datasets larger than this are spooled to disk while they are hashed
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+SHARDED_NAME_PATTERN = r'^dicoms/raw/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.dcm$'
+_SHARDED_NAME = re.compile(SHARDED_NAME_PATTERN)
+
+
+def sharded_name(content_hash):
+    return f"{RAW_DIR}/{content_hash[:2]}/{content_hash[2:4]}/{content_hash}.dcm"
+
+def is_sharded(name):
+    return bool(_SHARDED_NAME.match(name or ''))
+
+def get_compression():
+    """
+    Compression mode for newly stored datasets ('' stores them as they are).
+    """
+    return getattr(settings, 'DICOM_STORAGE_COMPRESSION', '')
+
+def _store(fileobj, storage):
+    # Hashes fileobj from its start and stores it under its sharded name
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    content_hash = digest.hexdigest()
+    name = sharded_name(content_hash)
+    if not (storage.exists(name) and _touch(storage, name)):
+        fileobj.seek(0)
+        # A concurrent upload of the same content may win the race; the
+        # storage then picks another name, which is still valid
+        name = storage.save(name, File(fileobj, name=name))
+    return name, content_hash, size
+
+def _touch(storage, name):
+    # A reused file gets a fresh modification time: the collector (blob_gc)
+    # leaves recently modified files alone, which covers the moment before
+    # the row that reuses it is saved. False asks the caller to write it
+    # again: when it is gone, or on storages that overwrite in place
+    # (django-storages' file_overwrite), where that refreshes it too
+    path = local_path(name, storage)
+    if path is None:
+        return not getattr(storage, 'file_overwrite', False)
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def save_dataset(ds, storage=None, compression=None):
+    """
+    Writes a pydicom Dataset to the storage in the sharded layout. Returns
+    (name, content_hash, size); an identical file already stored is reused.
+    The encoded file is hashed from a spooled temporary file and handed to
+    the storage as a file object, which backends upload in chunks.
+
+    compression (default get_compression()) transcodes ds in place first
+    when that makes it smaller.
+    """
+    compression = get_compression() if compression is None else compression
+    if compression:
+        compress_dataset(ds, compression)
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as buffer:
+        ds.save_as(buffer)
+        return _store(buffer, storage or default_storage)
+
+def save_file(path, storage=None):
+    """
+    Like save_dataset for a DICOM file already encoded at path.
+    """
+    with open(path, 'rb') as f:
+        return _store(f, storage or default_storage)
+
+def local_path(name, storage=None):
+    """
+    Filesystem path of a stored file, or None when the storage has none.
+    Only a FileSystemStorage has real paths: object stores raise
+    NotImplementedError and InMemoryStorage returns paths that do not exist.
+    """
+    storage = storage or default_storage
+    if not isinstance(storage, FileSystemStorage):
+        return None
+    return storage.path(name)
+
+def resolve_name(name, storage=None):
+    """
+    Name under which a recorded file actually exists in the storage:
+    name itself or, for old rows, without a stray 'media/' prefix or in the
+    flat raw directory. None when the file is missing.
+    """
+    storage = storage or default_storage
+    candidates = [name]
+    if name.startswith('media/'):
+        candidates.append(name[len('media/'):])
+    candidates.append(f"{RAW_DIR}/{os.path.basename(name)}")
+    for candidate in dict.fromkeys(candidates):
+        if storage.exists(candidate):
+            return candidate
+    return None
+
+def stored_sha256(name, storage=None):
+    """
+    SHA-256 of a stored file, streamed in chunks.
+    """
+    digest = hashlib.sha256()
+    with (storage or default_storage).open(name, 'rb') as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def stage(name, directory, storage=None):
+    """
+    Local path of a stored file for code that needs one. Returns
+    (path, is_copy): the stored file itself on local storage, otherwise a
+    copy streamed in chunks into directory, which the caller removes.
+    """
+    storage = storage or default_storage
+    path = local_path(name, storage)
+    if path is not None:
+        return path, False
+    fd, path = tempfile.mkstemp(suffix='.dcm', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as out, storage.open(name, 'rb') as src:
+            for chunk in src.chunks():
+                out.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, True
+
+def legacy_paths(name):
+    """
+    Local paths where a file recorded under name may be, in the order they
+    are tried: the storage path, MEDIA_ROOT without a stray 'media/' prefix,
+    the name relative to the working directory (old uploads were written
+    there) and the flat raw directory.
+    """
+    paths = []
+    try:
+        paths.append(default_storage.path(name))
+    except NotImplementedError:
+        pass
+    if name.startswith('media/'):
+        paths.append(os.path.join(settings.MEDIA_ROOT, name[len('media/'):]))
+    paths.append(os.path.abspath(name))
+    paths.append(os.path.join(settings.MEDIA_ROOT, RAW_DIR, os.path.basename(name)))
+    return list(dict.fromkeys(paths))
+
+def recorded_names(name):
+    """
+    Names a DicomFile row may have recorded for the stored file name, as
+    resolve_name and legacy_paths lead back to it: name itself, with a stray
+    'media/' prefix and, in the flat raw directory, the local path old
+    uploads wrote (absolute or relative to the working directory). Rows that
+    only share its basename are not included; shard_dicom_storage repoints
+    those.
+    """
+    names = [name, f"media/{name}"]
+    if os.path.dirname(name) == RAW_DIR:
+        path = os.path.join(settings.MEDIA_ROOT, name)
+        names += [path, os.path.relpath(path)]
+    return list(dict.fromkeys(names))
+
+def find_local_file(name):
+    """
+    First existing path among legacy_paths(name), or None.
+    """
+    for path in legacy_paths(name):
+        if os.path.isfile(path):
+            return path
+    return None
@@ -0,0 +1,77 @@
+"""
+Display view of a DICOM file's tags.
+
+Enhanced multi-frame files carry thousands of tags, so the detail page no
+longer renders or inlines all of them: the cleaned list (binary values
+blanked, keyword resolved) is built once per file, kept in the application
+cache under the file's scope, and served in filtered pages by the tag API.
+"""
+from pydicom.datadict import keyword_for_tag
+
+from . import app_cache
+from .models import DicomTag
+
+BINARY_VRS = {"OB", "OW", "OF", "OL", "OD", "OV", "UN"}
+MAX_VALUE_LENGTH = 400
+OMITTED_VALUE = "[Valor binario omitido]"
+
+# Bump when the cleaned format changes
+FORMAT_VERSION = 1
+
+
+def _parse_tag(tag):
+    """
+    (group, element) ints of a tag stored as str(BaseTag), e.g.
+    '(0010, 0010)'; None for anything else.
+    """
+    try:
+        group, element = tag.strip('()').split(',')
+        return int(group, 16), int(element, 16)
+    except ValueError:
+        return None
+
+def clean_tag(tag, description, vr, value):
+    parsed = _parse_tag(tag)
+    if (vr in BINARY_VRS or parsed == (0x7FE0, 0x0010) or len(value) > MAX_VALUE_LENGTH):
+        value = OMITTED_VALUE
+    return {
+        'tag': tag,
+        'group': f"{parsed[0]:04X}" if parsed else '',
+        'keyword': keyword_for_tag((parsed[0] << 16) | parsed[1]) if parsed else '',
+        'description': description,
+        'vr': vr,
+        'value': value,
+    }
+
+def cleaned_tags(dicom_file_id):
+    """
+    Cleaned tags of a file in dataset order, from the cache when possible.
+    """
+    def build():
+        rows = DicomTag.objects.filter(dicom_file_id=dicom_file_id).order_by('id').values_list('tag', 'description', 'vr', 'value')
+        return [clean_tag(*row) for row in rows]
+
+    return app_cache.cached('dicom_tags', [app_cache.dicom_scope(dicom_file_id)], build, FORMAT_VERSION, dicom_file_id)
+
+def filter_tags(tags, group=None, keyword=None, vr=None, text=None):
+    """
+    Tags matching every given criterion: group (hex, e.g. '0010'), keyword
+    (case-insensitive substring), vr (exact) and text (substring of the tag,
+    keyword, description or value).
+    """
+    if group:
+        group = group.upper().zfill(4)
+        tags = [t for t in tags if t['group'] == group]
+    if keyword:
+        keyword = keyword.lower()
+        tags = [t for t in tags if keyword in t['keyword'].lower()]
+    if vr:
+        vr = vr.upper()
+        tags = [t for t in tags if t['vr'] == vr]
+    if text:
+        text = text.lower()
+        tags = [
+            t for t in tags
+            if any(text in t[field].lower() for field in ('tag', 'keyword', 'description', 'value'))
+        ]
+    return tags
@@ -0,0 +1,110 @@
+"""
+Per-experiment statistics (ExperimentStats).
+
+The counters are adjusted in place by the signal handlers on every DICOM
+upload/delete and membership change, so listing experiments with their
+size is a single join. reconcile() recomputes everything from the source
+tables and fixes any drift (run it periodically with
+manage.py reconcile_experiment_stats).
+"""
+from django.db.models import Count, F, Max, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import app_cache
+from .models import DicomFile, Experiment, ExperimentStats, Participant
+
+
+def _aggregate(queryset, group_by, expression):
+    values = queryset.order_by().values(group_by).annotate(value=expression).values('value')
+    return Subquery(values[:1])
+
+def computed_stats(experiments):
+    """
+    Annotates a queryset of experiments with stats computed from scratch
+    (participant_total, dicom_total, bytes_total, last_upload), in one query.
+    """
+    dicom_files = DicomFile.objects.filter(experiment=OuterRef('pk'))
+    memberships = Participant.experiments.through.objects.filter(experiment=OuterRef('pk'))
+    return experiments.annotate(
+        participant_total=Coalesce(_aggregate(memberships, 'experiment', Count('*')), 0),
+        dicom_total=Coalesce(_aggregate(dicom_files, 'experiment', Count('*')), 0),
+        bytes_total=Coalesce(_aggregate(dicom_files, 'experiment', Sum('file_size')), 0),
+        last_upload=_aggregate(dicom_files, 'experiment', Max('upload_date')),
+    )
+
+def reconcile(experiment_ids=None):
+    """
+    Recomputes the stats of the given experiments (all by default), creating
+    missing rows. Returns the number of rows that were wrong or missing.
+    """
+    experiments = Experiment.objects.all()
+    if experiment_ids is not None:
+        experiments = experiments.filter(pk__in=experiment_ids)
+    current = {
+        stats.pk: stats
+        for stats in ExperimentStats.objects.filter(experiment__in=experiments)
+    }
+
+    fixed = 0
+    for experiment in computed_stats(experiments).iterator(chunk_size=1000):
+        stats = current.get(experiment.pk)
+        values = {
+            'participant_count': experiment.participant_total,
+            'dicom_count': experiment.dicom_total,
+            'total_bytes': experiment.bytes_total,
+        }
+        if stats is None:
+            ExperimentStats.objects.update_or_create(
+                experiment_id=experiment.pk,
+                defaults=dict(values, last_activity=experiment.last_upload)
+            )
+            fixed += 1
+            continue
+        last_activity = stats.last_activity
+        if experiment.last_upload and (last_activity is None or experiment.last_upload > last_activity):
+            last_activity = experiment.last_upload
+        if any(getattr(stats, field) != value for field, value in values.items()) or last_activity != stats.last_activity:
+            ExperimentStats.objects.filter(pk=stats.pk).update(last_activity=last_activity, **values)
+            fixed += 1
+    if fixed:
+        # Stats are shown from the application cache
+        app_cache.bump(app_cache.EXPERIMENTS)
+    return fixed
+
+def _adjust(experiment_id, **deltas):
+    """
+    Adds deltas to the counters of an experiment and bumps last_activity,
+    as a single UPDATE. A missing row is created by a full recount instead.
+    """
+    if not experiment_id:
+        return
+    now = timezone.now()
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    updated = ExperimentStats.objects.filter(pk=experiment_id).update(last_activity=now, updated_at=now, **updates)
+    if not updated:
+        reconcile([experiment_id])
+
+def file_added(dicom_file):
+    _adjust(dicom_file.experiment_id, dicom_count=1, total_bytes=dicom_file.file_size or 0)
+
+def file_removed(dicom_file):
+    _adjust(dicom_file.experiment_id, dicom_count=-1, total_bytes=-(dicom_file.file_size or 0))
+
+def membership_changed(experiment_ids):
+    """
+    Participant counts are recounted (one indexed COUNT per experiment)
+    rather than adjusted: add()/remove() may be given pks that were
+    already (or never) members.
+    """
+    now = timezone.now()
+    memberships = Participant.experiments.through.objects
+    for experiment_id in set(experiment_ids):
+        if not experiment_id:
+            continue
+        updated = ExperimentStats.objects.filter(pk=experiment_id).update(
+            participant_count=memberships.filter(experiment_id=experiment_id).count(),
+            last_activity=now, updated_at=now
+        )
+        if not updated:
+            reconcile([experiment_id])
@@ -0,0 +1,224 @@
+"""
+Background BIDS export jobs.
+
+The web request only creates an ExportJob row; a worker process
+(manage.py run_export_worker) claims pending jobs, writes the archive to
+exports/ in the media storage while recording progress on the row, and keeps
+the archive until EXPORT_JOB_TTL expires.
+"""
+import os
+import tempfile
+import threading
+import traceback
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .bids_export import archive_basename, stream_experiment_bids
+from .bids_validation import DatasetValidator
+from .dicom_storage import local_path
+from .models import ExportJob
+
+# A running job whose heartbeat is older than this is considered abandoned
+STALE_AFTER = timedelta(minutes=10)
+
+# Seconds between heartbeats of a running job, well below STALE_AFTER
+HEARTBEAT_INTERVAL = 30
+
+# Minimum seconds between progress writes to the database
+PROGRESS_INTERVAL = 1.0
+
+
+def create_export_job(experiment, user=None, filters=None):
+    return ExportJob.objects.create(
+        experiment=experiment,
+        requested_by=user if user and user.is_authenticated else None,
+        filters=filters or {},
+    )
+
+def job_progress(job):
+    """
+    JSON-serializable progress of a job, as served by the polling endpoint.
+    """
+    return {
+        'id': job.pk,
+        'experiment_id': job.experiment_id,
+        'status': job.status,
+        'filters': job.filters,
+        'files_done': job.files_done,
+        'files_total': job.files_total,
+        'current_participant': job.current_participant,
+        'eta_seconds': job.eta_seconds(),
+        'error': job.error,
+        'validation': {
+            key: job.validation_report[key] for key in ('valid', 'errors', 'warnings', 'files_checked')
+        } if job.validation_report else None,
+        'created_at': job.created_at.isoformat(),
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None,
+    }
+
+def claim_next_job():
+    """
+    Atomically takes the oldest pending job (or an abandoned running one).
+    skip_locked lets several workers poll the same table.
+    """
+    stale = timezone.now() - STALE_AFTER
+    with transaction.atomic():
+        job = (
+            ExportJob.objects.select_for_update(skip_locked=True)
+            .filter(status=ExportJob.STATUS_PENDING)
+            .order_by('created_at')
+            .first()
+        )
+        if job is None:
+            job = (
+                ExportJob.objects.select_for_update(skip_locked=True)
+                .filter(status=ExportJob.STATUS_RUNNING, updated_at__lt=stale)
+                .order_by('created_at')
+                .first()
+            )
+        if job is None:
+            return None
+        job.status = ExportJob.STATUS_RUNNING
+        job.started_at = timezone.now()
+        job.files_done = 0
+        job.save(update_fields=['status', 'started_at', 'files_done', 'updated_at'])
+    return job
+
+class _Heartbeat:
+    """
+    Refreshes a claimed job's updated_at from a background thread every
+    HEARTBEAT_INTERVAL seconds, independently of progress: a single long
+    conversion must not make the job look abandoned to other workers.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        try:
+            while not self.stopped.wait(HEARTBEAT_INTERVAL):
+                _claimed(self.job).update(updated_at=timezone.now())
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+class _ClaimLost(Exception):
+    """
+    Raised from the progress callback when another worker owns the job.
+    """
+
+def _claimed(job):
+    # The job's row while this worker's claim holds: started_at identifies it
+    return ExportJob.objects.filter(pk=job.pk, status=ExportJob.STATUS_RUNNING, started_at=job.started_at)
+
+def run_export_job(job):
+    """
+    Builds the job's archive, updating progress as files finish. On local
+    storage it is written next to its final name and renamed into place;
+    otherwise it is written to a temporary file and uploaded through the
+    storage. If another worker took the job over meanwhile (this one was
+    considered stale), the run stops at its next progress write or before
+    finishing, and its result is discarded.
+    """
+    experiment = job.experiment
+    relative_path = f"exports/{job.pk}_{archive_basename(experiment)}_bids.zip"
+    storage = job.archive.storage
+    full_path = local_path(relative_path, storage)
+    if full_path is not None:
+        full_path = Path(full_path)
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        # Unique per run, so a worker that took the job over never shares it
+        fd, partial_path = tempfile.mkstemp(dir=full_path.parent, prefix=full_path.name + '.', suffix='.part')
+    else:
+        fd, partial_path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    partial_path = Path(partial_path)
+
+    last_write = [0.0]
+
+    def progress(done, total, task):
+        now = timezone.now().timestamp()
+        if done < total and now - last_write[0] < PROGRESS_INTERVAL:
+            return
+        last_write[0] = now
+        job.files_done = done
+        job.files_total = total
+        if task:
+            job.current_participant = task['subject_id']
+        # Only while the claim holds: never over the progress of a new owner
+        if not _claimed(job).update(files_done=done, files_total=total,
+                                    current_participant=job.current_participant, updated_at=timezone.now()):
+            raise _ClaimLost()
+
+    validator = DatasetValidator() if settings.BIDS_VALIDATE_EXPORTS else None
+
+    try:
+        with _Heartbeat(job):
+            with open(partial_path, 'wb') as archive:
+                for chunk in stream_experiment_bids(experiment, progress=progress, validator=validator, filters=job.filters):
+                    archive.write(chunk)
+
+        with transaction.atomic():
+            # Locked until the archive is in place and the job marked done
+            if not _claimed(job).select_for_update().exists():
+                raise _ClaimLost()
+            if full_path is not None:
+                os.replace(partial_path, full_path)
+            else:
+                # A rerun of an abandoned job replaces its previous upload
+                if storage.exists(relative_path):
+                    storage.delete(relative_path)
+                with open(partial_path, 'rb') as archive:
+                    relative_path = storage.save(relative_path, File(archive))
+                partial_path.unlink()
+
+            job.status = ExportJob.STATUS_DONE
+            job.archive.name = relative_path
+            job.validation_report = validator.report() if validator else None
+            job.finished_at = timezone.now()
+            job.expires_at = job.finished_at + timedelta(seconds=settings.EXPORT_JOB_TTL)
+            job.save(update_fields=['status', 'archive', 'validation_report', 'finished_at', 'expires_at', 'updated_at'])
+    except _ClaimLost:
+        # Stops converting as soon as a progress write finds the job taken over
+        print(f"Export job {job.pk} was taken over by another worker, discarding this run")
+        if partial_path.exists():
+            partial_path.unlink()
+        job.refresh_from_db()
+    except Exception as e:
+        traceback.print_exc()
+        if partial_path.exists():
+            partial_path.unlink()
+        job.status = ExportJob.STATUS_FAILED
+        job.error = str(e)
+        job.finished_at = timezone.now()
+        _claimed(job).update(status=job.status, error=job.error, finished_at=job.finished_at, updated_at=job.finished_at)
+    return job
+
+def purge_expired_jobs():
+    """
+    Deletes the archives of finished jobs past their TTL. Returns how many.
+    """
+    expired = ExportJob.objects.filter(status=ExportJob.STATUS_DONE, expires_at__lt=timezone.now())
+    count = 0
+    for job in expired:
+        if job.archive:
+            job.archive.delete(save=False)
+        job.status = ExportJob.STATUS_EXPIRED
+        job.save(update_fields=['status', 'archive', 'updated_at'])
+        count += 1
+    return count
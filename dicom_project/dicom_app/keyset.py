@@ -0,0 +1,143 @@
+"""
+Keyset (cursor) pagination.
+
+OFFSET pagination makes the database walk and discard every row before the
+requested page, so deep pages get slower as tables grow. Here a page starts
+right after the sort key of the last row seen, e.g.
+
+    WHERE upload_date <= :last_date
+      AND (upload_date < :last_date OR (upload_date = :last_date AND id < :last_id))
+    ORDER BY upload_date DESC, id DESC LIMIT n
+
+The leading upload_date <= :last_date is what the database uses as the
+bound (Index Cond) of a range scan on an index over the same columns, so
+every page costs the same as the first one; the OR only sorts out the
+rows that tie on upload_date. A row-value comparison, (upload_date, id) <
+(:last_date, :last_id), would be tighter but cannot express orderings
+that mix ascending and descending columns.
+
+The ordering must end in a unique, non-null column (normally the primary
+key) so that the key identifies a single position.
+"""
+import base64
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+NEXT = 'n'
+PREVIOUS = 'p'
+
+
+class KeysetPage:
+    """
+    One page of results: object_list plus opaque cursors for the pages
+    around it (None when there is no such page).
+    """
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def has_other_pages(self):
+        return self.has_next or self.has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def _parse_ordering(ordering):
+    return [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+
+def _json_value(value):
+    # Full precision: DjangoJSONEncoder would cut datetimes to milliseconds
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+def encode_cursor(direction, values):
+    raw = json.dumps([direction, values], default=_json_value, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, model, fields):
+    """
+    Returns (direction, values) with values converted back to Python
+    types. Raises ValueError for malformed or foreign cursors.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(raw)
+        if direction not in (NEXT, PREVIOUS) or len(values) != len(fields):
+            raise ValueError
+        return direction, [
+            model._meta.get_field(name).to_python(value)
+            for (name, _), value in zip(fields, values)
+        ]
+    except (TypeError, ValueError, ValidationError, UnicodeDecodeError):
+        raise ValueError("Cursor de paginación inválido.")
+
+def _after(fields, values, backwards):
+    """
+    Rows strictly after values in the given ordering (before, if backwards):
+    a <= x AND ((a < x) OR (a = x AND b < y) OR ...). The OR chain alone is
+    exact but gives the planner no range bound; the leading a <= x does.
+    """
+    condition = Q()
+    for i, (name, descending) in enumerate(fields):
+        lookup = 'lt' if descending != backwards else 'gt'
+        equal = {prefix: value for (prefix, _), value in zip(fields[:i], values[:i])}
+        condition |= Q(**equal, **{f"{name}__{lookup}": values[i]})
+    name, descending = fields[0]
+    bound = Q(**{f"{name}__{'lte' if descending != backwards else 'gte'}": values[0]})
+    return bound & condition
+
+def _key(row, fields):
+    return [row[name] if isinstance(row, dict) else getattr(row, name) for name, _ in fields]
+
+def paginate(queryset, ordering, cursor=None, per_page=25):
+    """
+    Returns the KeysetPage of queryset, sorted by ordering (e.g.
+    ('-upload_date', '-id')), that cursor points to; the first page when
+    cursor is empty. Raises ValueError for an invalid cursor.
+    """
+    fields = _parse_ordering(ordering)
+    direction, values = NEXT, None
+    if cursor:
+        direction, values = decode_cursor(cursor, queryset.model, fields)
+    backwards = direction == PREVIOUS
+
+    if backwards:
+        queryset = queryset.order_by(*[name if descending else f"-{name}" for name, descending in fields])
+    else:
+        queryset = queryset.order_by(*ordering)
+    if values is not None:
+        queryset = queryset.filter(_after(fields, values, backwards))
+
+    rows = list(queryset[:per_page + 1])
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+    if not rows:
+        return KeysetPage(rows)
+
+    # Going back, the page we came from is always after this one
+    more_after = True if backwards else has_more
+    more_before = has_more if backwards else values is not None
+    next_cursor = encode_cursor(NEXT, _key(rows[-1], fields)) if more_after else None
+    previous_cursor = encode_cursor(PREVIOUS, _key(rows[0], fields)) if more_before else None
+    return KeysetPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,117 @@
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from dicom_app.models import ExperimentStats
+
+
+def _small_view():
+    # What the stats API and the dashboard do: one indexed read
+    list(ExperimentStats.objects.filter(experiment__status='Active').select_related('experiment')[:20])
+
+
+class Command(BaseCommand):
+    help = ('Compares opening a database connection per request with reusing '
+            'connections (CONN_MAX_AGE) and, when configured, the connection pool')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per mode')
+        parser.add_argument('--concurrency', type=int, default=4, help='Simultaneous clients (threads)')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Target requests per second over all clients (0 = as fast as possible)')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        alias = options['database']
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests and --concurrency must be positive')
+        settings_dict = connections.settings[alias]
+        pooled = 'pool' in settings_dict.get('OPTIONS', {})
+
+        modes = [('per-request', 0)]
+        if pooled:
+            modes.append(('pool', 0))
+        else:
+            modes.append(('persistent', settings_dict.get('CONN_MAX_AGE') or 600))
+
+        configured = settings_dict.get('CONN_MAX_AGE', 0)
+        options_backup = dict(settings_dict.get('OPTIONS', {}))
+        try:
+            for name, max_age in modes:
+                settings_dict['CONN_MAX_AGE'] = max_age
+                if name == 'per-request' and pooled:
+                    settings_dict['OPTIONS'] = {k: v for k, v in options_backup.items() if k != 'pool'}
+                else:
+                    settings_dict['OPTIONS'] = dict(options_backup)
+                self._report(name, self._run(alias, options))
+        finally:
+            settings_dict['CONN_MAX_AGE'] = configured
+            settings_dict['OPTIONS'] = options_backup
+
+    def _run(self, alias, options):
+        total, concurrency = options['requests'], options['concurrency']
+        interval = concurrency / options['rate'] if options['rate'] else 0
+        latencies = []
+        opened = []
+        lock = threading.Lock()
+
+        def count_connection(sender, connection, **kwargs):
+            if connection.alias == alias:
+                with lock:
+                    opened.append(1)
+
+        def client(n):
+            # Same request cycle as the WSGI handler: close_old_connections
+            # runs on request_started and request_finished
+            try:
+                for _ in range(n):
+                    start = time.perf_counter()
+                    request_started.send(sender=self.__class__)
+                    try:
+                        _small_view()
+                    finally:
+                        request_finished.send(sender=self.__class__)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                    if interval > elapsed:
+                        time.sleep(interval - elapsed)
+            finally:
+                connections[alias].close()
+
+        # Start every mode from a closed connection
+        connections[alias].close()
+        connection_created.connect(count_connection)
+        try:
+            share, extra = divmod(total, concurrency)
+            threads = [
+                threading.Thread(target=client, args=(share + (1 if i < extra else 0),))
+                for i in range(concurrency)
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - start
+        finally:
+            connection_created.disconnect(count_connection)
+        return latencies, len(opened), wall
+
+    def _report(self, name, result):
+        latencies, opened, wall = result
+        if not latencies:
+            raise CommandError('No request completed')
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        self.stdout.write(
+            f"{name:12} {len(latencies) / wall:8.1f} req/s  "
+            f"p50 {statistics.median(latencies) * 1000:7.2f} ms  "
+            f"p95 {p95 * 1000:7.2f} ms  "
+            f"{opened} connect(s)"
+        )
@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_app import app_cache, blob_gc, nifti_cache
+from dicom_app.bids_export import get_cache_dir
+from dicom_app.db_router import use_primary
+from dicom_app.dicom_compression import MODES, RLE, compress_file
+from dicom_app.dicom_storage import get_compression, resolve_name, save_file, stage
+from dicom_app.models import DicomFile
+
+
+def _compress(source, dest, mode):
+    # Runs in a worker process: errors come back as values
+    try:
+        return compress_file(source, dest, mode), None
+    except Exception as e:
+        return False, str(e)
+
+
+class Command(BaseCommand):
+    help = ('Transcodes stored DICOM files to a lossless compressed transfer syntax and '
+            'reports the space saved; compressed files are skipped, so it can be run again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=sorted(MODES), help='Compression (default DICOM_STORAGE_COMPRESSION, else rle)')
+        parser.add_argument('--batch-size', type=int, default=50, help='Files compressed per batch')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Compression processes')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the uncompressed files and their size')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+        mode = options['mode'] or get_compression() or RLE
+        if mode not in MODES:
+            raise CommandError(f'Unknown compression mode: {mode}')
+
+        rows = DicomFile.objects.exclude(file='')
+        if options['dry_run']:
+            self._dry_run(rows)
+            return
+
+        self.compressed = self.skipped = self.failed = 0
+        self.size_before = self.size_after = 0
+        self.cache_dir = get_cache_dir()
+        last_id = 0
+        staging = tempfile.mkdtemp()
+        try:
+            with ProcessPoolExecutor(options['workers']) as pool:
+                while True:
+                    batch = list(rows.filter(id__gt=last_id).order_by('id').only('id', 'file', 'content_hash')[:options['batch_size']])
+                    if not batch:
+                        break
+                    last_id = batch[-1].id
+
+                    # Duplicate uploads share one stored file
+                    files = {}
+                    for dicom_file in batch:
+                        files.setdefault(dicom_file.file.name, dicom_file.content_hash)
+                    jobs = []
+                    for name, content_hash in files.items():
+                        stored = resolve_name(name)
+                        if stored is None:
+                            self.failed += 1
+                            self.stderr.write(f'{name}: not found')
+                            continue
+                        source, is_copy = stage(stored, staging)
+                        fd, dest = tempfile.mkstemp(suffix='.dcm', dir=staging)
+                        os.close(fd)
+                        jobs.append((name, stored, content_hash, source, is_copy, dest,
+                                     pool.submit(_compress, source, dest, mode)))
+
+                    for name, stored, content_hash, source, is_copy, dest, future in jobs:
+                        try:
+                            self._replace(name, stored, content_hash, dest, *future.result())
+                        finally:
+                            os.remove(dest)
+                            if is_copy:
+                                os.remove(source)
+                    self.stdout.write(
+                        f'{self.compressed} compressed, {self.skipped} skipped, {self.failed} failed (up to id {last_id})'
+                    )
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        saved = self.size_before - self.size_after
+        ratio = self.size_after / self.size_before if self.size_before else 1
+        style = self.style.SUCCESS if not self.failed else self.style.WARNING
+        self.stdout.write(style(
+            f'Compressed {self.compressed} file(s): {self.size_before / 1024 ** 2:.1f} MB -> '
+            f'{self.size_after / 1024 ** 2:.1f} MB, {saved / 1024 ** 2:.1f} MB saved ({1 - ratio:.0%}); '
+            f'{self.skipped} skipped (already compressed or no gain), {self.failed} failed'
+        ))
+
+    def _replace(self, name, stored, content_hash, dest, done, error):
+        """
+        Stores the compressed file written at dest and points the rows of
+        name to it.
+        """
+        if error:
+            self.failed += 1
+            self.stderr.write(f'{name}: {error}')
+            return
+        if not done:
+            self.skipped += 1
+            return
+
+        size_before = default_storage.size(stored)
+        new_name, new_hash, size = save_file(dest)
+        with use_primary():
+            # A replica could miss a row just pointed at stored
+            ids = list(DicomFile.objects.filter(file=name).values_list('id', flat=True))
+        DicomFile.objects.filter(id__in=ids).update(file=new_name, content_hash=new_hash)
+        app_cache.bump(*(app_cache.dicom_scope(pk) for pk in ids))
+        if self.cache_dir and content_hash:
+            # Same pixels, same conversion: keep it reachable under the new hash
+            nifti_cache.copy_entry(self.cache_dir, nifti_cache.cache_key(content_hash), nifti_cache.cache_key(new_hash))
+        blob_gc.delete_unreferenced([stored])
+
+        self.compressed += 1
+        self.size_before += size_before
+        self.size_after += size
+
+    def _dry_run(self, rows):
+        count = size = 0
+        names = rows.order_by().values_list('file', flat=True).distinct()
+        for name in names.iterator():
+            stored = resolve_name(name)
+            if stored is None:
+                continue
+            with default_storage.open(stored, 'rb') as f:
+                transfer_syntax = pydicom.dcmread(f, stop_before_pixels=True).file_meta.get('TransferSyntaxUID')
+            if transfer_syntax and not transfer_syntax.is_compressed:
+                count += 1
+                size += default_storage.size(stored)
+        self.stdout.write(f'{count} uncompressed file(s), {size / 1024 ** 2:.1f} MB')
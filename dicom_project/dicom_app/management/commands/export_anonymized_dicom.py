@@ -0,0 +1,54 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_app.bids_export import parse_export_filters
+from dicom_app.dicom_export import stream_experiment_dicom
+from dicom_app.models import Experiment
+
+
+class Command(BaseCommand):
+    help = 'Writes a ZIP with the de-identified DICOM files of an experiment (subject/study/series)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('experiment', type=int, help='Experiment id')
+        parser.add_argument('output', help='Path of the ZIP file to write')
+        parser.add_argument('--workers', type=int, help='De-identification processes (default BIDS_EXPORT_WORKERS)')
+        parser.add_argument('--participant', action='append', default=[], help='Participant id (repeatable)')
+        parser.add_argument('--datatype', action='append', default=[], help='anat, func or dwi (repeatable)')
+        parser.add_argument('--suffix', action='append', default=[], help='T1w, bold, ... (repeatable)')
+        parser.add_argument('--series', help='Regular expression matched against SeriesDescription')
+        parser.add_argument('--date-from', help='First StudyDate, YYYY-MM-DD')
+        parser.add_argument('--date-to', help='Last StudyDate, YYYY-MM-DD')
+
+    def handle(self, *args, **options):
+        try:
+            experiment = Experiment.objects.get(pk=options['experiment'])
+        except Experiment.DoesNotExist:
+            raise CommandError(f"Experiment {options['experiment']} does not exist")
+
+        params = {name: options[name] for name in ('participant', 'datatype', 'suffix')}
+        for name in ('series', 'date_from', 'date_to'):
+            if options[name]:
+                params[name] = [options[name]]
+        try:
+            filters = parse_export_filters(params)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        def progress(done, total):
+            if done == total or done % 100 == 0:
+                self.stdout.write(f"{done}/{total} files")
+
+        output = options['output']
+        partial = output + '.part'
+        try:
+            with open(partial, 'wb') as f:
+                for chunk in stream_experiment_dicom(experiment, options['workers'], filters, progress):
+                    f.write(chunk)
+            os.replace(partial, output)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {output}'))
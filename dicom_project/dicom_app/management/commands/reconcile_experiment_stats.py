@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from dicom_app.experiment_stats import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recomputes ExperimentStats from the source tables, fixing any drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--experiment', type=int, action='append',
+                            help='Only reconcile this experiment (repeatable)')
+
+    def handle(self, *args, **options):
+        fixed = reconcile(options['experiment'])
+        self.stdout.write(self.style.SUCCESS(f'Reconciled experiment stats: {fixed} corrected'))
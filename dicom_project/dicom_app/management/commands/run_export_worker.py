@@ -0,0 +1,42 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from dicom_app.blob_gc import reclaim_deleted
+from dicom_app.export_jobs import claim_next_job, run_export_job, purge_expired_jobs
+
+
+class Command(BaseCommand):
+    help = 'Processes queued BIDS export jobs, removes expired archives and reclaims deleted files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Process the jobs currently queued and exit')
+        parser.add_argument('--poll-interval', type=float, default=settings.EXPORT_JOB_POLL_INTERVAL,
+                            help='Seconds to wait between polls when the queue is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            purged = purge_expired_jobs()
+            if purged:
+                self.stdout.write(f'Removed {purged} expired export archive(s)')
+            deleted, processed = reclaim_deleted()
+            if processed:
+                self.stdout.write(f'Reclaimed {deleted} deleted file(s) ({processed} tombstone(s))')
+
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f'Running export job {job.pk} ({job.experiment})')
+            job = run_export_job(job)
+            if job.status == job.STATUS_DONE:
+                self.stdout.write(self.style.SUCCESS(f'Export job {job.pk} finished: {job.archive.name}'))
+            elif job.status == job.STATUS_RUNNING:
+                self.stdout.write(f'Export job {job.pk} was taken over by another worker')
+            else:
+                self.stdout.write(self.style.ERROR(f'Export job {job.pk} failed: {job.error}'))
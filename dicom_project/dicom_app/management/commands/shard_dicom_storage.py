@@ -0,0 +1,106 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_app import app_cache
+from dicom_app.dicom_storage import SHARDED_NAME_PATTERN, find_local_file, sharded_name
+from dicom_app.models import DicomFile
+from dicom_app.nifti_cache import file_sha256
+
+
+class Command(BaseCommand):
+    help = ('Moves stored DICOM files into the hash-sharded layout '
+            '(dicoms/raw/aa/bb/<sha256>.dcm); safe to interrupt and run again')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200, help='Rows updated per transaction')
+        parser.add_argument('--workers', type=int, default=4, help='Files hashed and moved in parallel')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the files to move')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+
+        pending = DicomFile.objects.exclude(file__regex=SHARDED_NAME_PATTERN).exclude(file='')
+        if options['dry_run']:
+            self.stdout.write(f'{pending.count()} file(s) to move')
+            return
+
+        moved = missing = 0
+        last_id = 0
+        with ThreadPoolExecutor(options['workers']) as pool:
+            while True:
+                # Moved rows leave the queryset, so an interrupted run simply
+                # resumes; last_id skips the ones that could not be moved
+                batch = list(pending.filter(id__gt=last_id).order_by('id').only('id', 'file', 'content_hash')[:options['batch_size']])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                # Hashes are saved before anything moves: a file moved by an
+                # interrupted run is then found again by its hash
+                unhashed = [f for f in batch if not f.content_hash]
+                for dicom_file, content_hash in zip(unhashed, pool.map(self._hash, unhashed)):
+                    dicom_file.content_hash = content_hash
+                hashed = [f for f in unhashed if f.content_hash]
+                if hashed:
+                    DicomFile.objects.bulk_update(hashed, ['content_hash'])
+
+                done = [f for f, ok in zip(batch, pool.map(self._move, batch)) if ok]
+                DicomFile.objects.bulk_update(done, ['file'])
+                app_cache.bump(*(app_cache.dicom_scope(f.pk) for f in done))
+                moved += len(done)
+                missing += len(batch) - len(done)
+                self.stdout.write(f'{moved} moved, {missing} missing (up to id {last_id})')
+
+        style = self.style.SUCCESS if not missing else self.style.WARNING
+        self.stdout.write(style(f'Moved {moved} file(s); {missing} could not be found'))
+
+    def _hash(self, dicom_file):
+        path = find_local_file(dicom_file.file.name)
+        return file_sha256(path) if path else ''
+
+    def _move(self, dicom_file):
+        """
+        Moves the file of a row to its sharded name and sets dicom_file.file.
+        Returns False when the file cannot be found.
+        """
+        if not dicom_file.content_hash:
+            return False
+        dest = sharded_name(dicom_file.content_hash)
+        source = find_local_file(dicom_file.file.name)
+        if source is None:
+            # Moved by an interrupted run before its row was updated
+            if default_storage.exists(dest):
+                dicom_file.file.name = dest
+                return True
+            return False
+
+        if default_storage.exists(dest):
+            # Same content already stored (duplicate upload)
+            os.remove(source)
+        else:
+            try:
+                dest_path = default_storage.path(dest)
+            except NotImplementedError:
+                dest_path = None
+            if dest_path:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                try:
+                    os.replace(source, dest_path)
+                except OSError:
+                    # Another filesystem: copy under a temporary name first,
+                    # so an interrupted copy never looks like a stored file
+                    shutil.copyfile(source, dest_path + '.part')
+                    os.replace(dest_path + '.part', dest_path)
+                    os.remove(source)
+            else:
+                with open(source, 'rb') as f:
+                    dest = default_storage.save(dest, File(f))
+                os.remove(source)
+        dicom_file.file.name = dest
+        return True
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from dicom_app.blob_gc import SWEEP_ROOTS, RateLimiter, delete_unreferenced, iter_stored_files, referenced_names
+
+
+class Command(BaseCommand):
+    help = ('Deletes stored files that no DicomFile, ConsentFile or ExportJob row references '
+            f'(mark and sweep over {", ".join(SWEEP_ROOTS)})')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only list the orphaned files and their size')
+        parser.add_argument('--workers', type=int, default=8, help='Directories listed in parallel')
+        parser.add_argument('--batch-size', type=int, default=500, help='Files checked against the database per query')
+        parser.add_argument('--rate', type=float, default=50, help='Maximum deletions per second (0 = no limit)')
+        parser.add_argument('--min-age', type=float, default=24, help='Hours a file must be old to be deleted')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive')
+        # Uploads and exports in progress store their file before their row
+        cutoff = timezone.now() - timedelta(hours=options['min_age'])
+        limiter = RateLimiter(options['rate'])
+
+        scanned = orphans = young = size = 0
+        with ThreadPoolExecutor(options['workers']) as pool:
+            names = iter_stored_files(pool)
+            while True:
+                batch = list(islice(names, options['batch_size']))
+                if not batch:
+                    break
+                scanned += len(batch)
+                unreferenced = set(batch) - referenced_names(batch)
+
+                # Modification times are fetched in parallel too (a request
+                # per file on object stores)
+                times = dict(zip(unreferenced, pool.map(default_storage.get_modified_time, unreferenced)))
+                candidates = sorted(name for name, modified in times.items() if modified < cutoff)
+                young += len(unreferenced) - len(candidates)
+                orphans += len(candidates)
+                size += sum(pool.map(default_storage.size, candidates))
+
+                if options['dry_run']:
+                    for name in candidates:
+                        self.stdout.write(name)
+                else:
+                    # Each file is checked again (rows and modification
+                    # time) right before it is deleted
+                    delete_unreferenced(candidates, limiter=limiter, cutoff=cutoff)
+                self.stdout.write(f'{scanned} scanned, {orphans} orphaned')
+
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {orphans} orphaned file(s), {size / 1024 ** 2:.1f} MB; '
+            f'{young} newer than {options["min_age"]:g} h kept'
+        ))
@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_app.bids_mirror import sync_experiment, sync_pending_changes
+from dicom_app.models import Experiment
+
+
+class Command(BaseCommand):
+    help = 'Applies pending changes to the persistent BIDS mirror (BIDS_MIRROR_ROOT)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--experiment', type=int, action='append',
+                            help='Fully rebuild the mirror of this experiment (repeatable)')
+        parser.add_argument('--all', action='store_true',
+                            help='Fully rebuild the mirror of every experiment')
+        parser.add_argument('--watch', action='store_true',
+                            help='Keep running, applying changes as they are journaled')
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help='Seconds between journal polls with --watch')
+
+    def handle(self, *args, **options):
+        if not settings.BIDS_MIRROR_ROOT:
+            raise CommandError('BIDS_MIRROR_ROOT is not configured')
+
+        if options['all'] or options['experiment']:
+            experiments = Experiment.objects.all()
+            if options['experiment']:
+                experiments = experiments.filter(pk__in=options['experiment'])
+            for experiment in experiments:
+                result = sync_experiment(experiment, full=True)
+                self.stdout.write(self.style.SUCCESS(
+                    f"Rebuilt mirror of {experiment} ({len(result['updated'])} subjects)"
+                ))
+            return
+
+        while True:
+            for experiment_id, result in sync_pending_changes().items():
+                if result is None:
+                    self.stdout.write(f'Removed mirror of experiment {experiment_id}')
+                else:
+                    self.stdout.write(
+                        f"Experiment {experiment_id}: updated {', '.join(result['updated']) or '-'}; "
+                        f"removed {', '.join(result['removed']) or '-'}"
+                    )
+            if not options['watch']:
+                return
+            time.sleep(options['interval'])
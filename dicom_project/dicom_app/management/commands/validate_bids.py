@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from dicom_app.bids_mirror import mirror_dir
+from dicom_app.bids_validation import validate_directory
+
+
+class Command(BaseCommand):
+    help = 'Validates a BIDS dataset, re-checking only files that changed since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Dataset root to validate')
+        parser.add_argument('--experiment', type=int, help='Validate the BIDS mirror of this experiment')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        if options['experiment']:
+            root = mirror_dir(options['experiment'])
+        elif options['path']:
+            root = options['path']
+        else:
+            raise CommandError('Give a dataset path or --experiment')
+
+        report = validate_directory(root)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        summary = (
+            f"{report['files_checked']} files ({report['files_cached']} cached): "
+            f"{report['errors']} errors, {report['warnings']} warnings"
+        )
+        if report['valid']:
+            self.stdout.write(self.style.SUCCESS(f'Valid BIDS dataset. {summary}'))
+        else:
+            self.stdout.write(self.style.ERROR(f'Invalid BIDS dataset. {summary}'))
+            for issue in report['dataset_issues']:
+                self.stdout.write(f"  {issue['severity']}: {issue['message']}")
+            for entry in report['files']:
+                for issue in entry['issues']:
+                    self.stdout.write(f"  {entry['path']}: {issue['severity']}: {issue['message']}")
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 23:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0014_fix_windows_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dicomfile',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.1 on 2026-10-18 23:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0016_exportjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BidsChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('experiment_id', models.IntegerField(db_index=True)),
+                ('participant_id', models.IntegerField(blank=True, null=True)),
+                ('kind', models.CharField(choices=[('files', 'Archivos'), ('participants', 'Participantes'), ('deleted', 'Experimento eliminado')], max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,87 @@
+# Generated by Django 5.1.1 on 2026-10-18 23:32
+
+import datetime
+
+from django.db import migrations, models
+
+# str(element.tag) as stored in DicomTag.tag by process_dicom_file
+METADATA_TAGS = {
+    '(0008, 0060)': 'modality',
+    '(0008, 103e)': 'series_description',
+    '(0020, 000d)': 'study_instance_uid',
+    '(0020, 000e)': 'series_instance_uid',
+    '(0020, 0011)': 'series_number',
+    '(0008, 0020)': 'study_date',
+}
+
+def backfill_series_metadata(apps, schema_editor):
+    DicomFile = apps.get_model('dicom_app', 'DicomFile')
+    DicomTag = apps.get_model('dicom_app', 'DicomTag')
+    
+    values = {}
+    tags = DicomTag.objects.filter(tag__in=list(METADATA_TAGS)).values_list('dicom_file_id', 'tag', 'value')
+    for dicom_file_id, tag, value in tags.iterator(chunk_size=2000):
+        values.setdefault(dicom_file_id, {})[METADATA_TAGS[tag]] = value
+    
+    batch = []
+    for dicom_file in DicomFile.objects.filter(pk__in=list(values)).iterator(chunk_size=2000):
+        fields = values[dicom_file.pk]
+        dicom_file.modality = fields.get('modality', '')[:16]
+        dicom_file.series_description = fields.get('series_description', '')[:255]
+        dicom_file.study_instance_uid = fields.get('study_instance_uid', '')[:64]
+        dicom_file.series_instance_uid = fields.get('series_instance_uid', '')[:64]
+        try:
+            dicom_file.series_number = int(fields.get('series_number'))
+        except (TypeError, ValueError):
+            dicom_file.series_number = None
+        try:
+            dicom_file.study_date = datetime.datetime.strptime(fields.get('study_date', '')[:8], '%Y%m%d').date()
+        except ValueError:
+            dicom_file.study_date = None
+        batch.append(dicom_file)
+    
+    DicomFile.objects.bulk_update(batch, [
+        'modality', 'series_description', 'study_instance_uid',
+        'series_instance_uid', 'series_number', 'study_date'
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0017_bidschange'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dicomfile',
+            name='modality',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+        migrations.AddField(
+            model_name='dicomfile',
+            name='series_description',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='dicomfile',
+            name='series_instance_uid',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='dicomfile',
+            name='series_number',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dicomfile',
+            name='study_date',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='dicomfile',
+            name='study_instance_uid',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.RunPython(backfill_series_metadata, migrations.RunPython.noop),
+    ]
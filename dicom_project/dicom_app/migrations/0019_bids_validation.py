@@ -0,0 +1,32 @@
+# Generated by Django 5.1.1 on 2026-10-18 23:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0018_dicomfile_series_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='validation_report',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='BidsValidationResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('validator_version', models.CharField(max_length=100)),
+                ('issues', models.JSONField(default=list)),
+                ('checked_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('path', 'content_hash', 'validator_version'), name='unique_bids_validation_result')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 23:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0019_bids_validation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='filters',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
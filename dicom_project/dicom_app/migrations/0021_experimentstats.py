@@ -0,0 +1,54 @@
+# Generated by Django 5.1.1 on 2026-10-19 00:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def backfill_experiment_stats(apps, schema_editor):
+    Experiment = apps.get_model('dicom_app', 'Experiment')
+    ExperimentStats = apps.get_model('dicom_app', 'ExperimentStats')
+    DicomFile = apps.get_model('dicom_app', 'DicomFile')
+    Membership = apps.get_model('dicom_app', 'Participant').experiments.through
+
+    participants = dict(
+        Membership.objects.values('experiment_id').annotate(n=Count('*')).values_list('experiment_id', 'n')
+    )
+    files = {
+        row['experiment_id']: row
+        for row in DicomFile.objects.filter(experiment__isnull=False).values('experiment_id').annotate(
+            n=Count('*'), size=Sum('file_size'), last=Max('upload_date')
+        )
+    }
+    ExperimentStats.objects.bulk_create([
+        ExperimentStats(
+            experiment_id=pk,
+            participant_count=participants.get(pk, 0),
+            dicom_count=files.get(pk, {}).get('n', 0),
+            total_bytes=files.get(pk, {}).get('size') or 0,
+            last_activity=files.get(pk, {}).get('last'),
+        )
+        for pk in Experiment.objects.values_list('pk', flat=True)
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0020_exportjob_filters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExperimentStats',
+            fields=[
+                ('experiment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='dicom_app.experiment')),
+                ('participant_count', models.IntegerField(default=0)),
+                ('dicom_count', models.IntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0)),
+                ('last_activity', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_experiment_stats, migrations.RunPython.noop),
+    ]
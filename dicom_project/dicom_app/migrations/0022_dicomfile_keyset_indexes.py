@@ -0,0 +1,25 @@
+# Generated by Django 5.1.1 on 2026-10-18 23:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0021_experimentstats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dicomfile',
+            index=models.Index(fields=['upload_date', 'id'], name='dicom_upload_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dicomfile',
+            index=models.Index(fields=['participant', 'upload_date', 'id'], name='dicom_participant_upload_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dicomfile',
+            index=models.Index(fields=['experiment', 'upload_date', 'id'], name='dicom_experiment_upload_idx'),
+        ),
+    ]
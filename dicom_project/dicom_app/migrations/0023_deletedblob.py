@@ -0,0 +1,25 @@
+# Generated by Django 5.1.1 on 2026-10-19 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dicom_app', '0022_dicomfile_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=500)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dicomfile',
+            index=models.Index(fields=['file'], name='dicom_file_name_idx'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 ﻿from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 
 class Experiment(models.Model):
     name = models.CharField(max_length=255)
@@ -10,6 +11,21 @@ class Experiment(models.Model):
     def __str__(self):
         return self.name
 
+class ExperimentStats(models.Model):
+    """
+    Contadores de un experimento mantenidos de forma incremental por las
+    señales de subida/borrado de DICOM y de membresía (ver experiment_stats.py).
+    """
+    experiment = models.OneToOneField(Experiment, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    participant_count = models.IntegerField(default=0)
+    dicom_count = models.IntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Stats of {self.experiment}"
+
 class Participant(models.Model):
     subject_id = models.CharField(max_length=100, unique=True)
     first_name = models.CharField(max_length=100)
@@ -75,6 +91,24 @@ class DicomFile(models.Model):
     file_size = models.IntegerField(null=True, blank=True)
     upload_date = models.DateTimeField(auto_now_add=True)
     is_anonymized = models.BooleanField(default=False)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 del archivo guardado
+    # Metadatos de serie copiados del encabezado (planificación BIDS sin abrir el archivo)
+    modality = models.CharField(max_length=16, blank=True)
+    series_description = models.CharField(max_length=255, blank=True)
+    study_instance_uid = models.CharField(max_length=64, blank=True)
+    series_instance_uid = models.CharField(max_length=64, blank=True)
+    series_number = models.IntegerField(null=True, blank=True)
+    study_date = models.DateField(null=True, blank=True)
+
+    class Meta:
+        # Paginación por cursor sobre (upload_date, id), global y por participante/experimento
+        indexes = [
+            models.Index(fields=['upload_date', 'id'], name='dicom_upload_idx'),
+            models.Index(fields=['participant', 'upload_date', 'id'], name='dicom_participant_upload_idx'),
+            models.Index(fields=['experiment', 'upload_date', 'id'], name='dicom_experiment_upload_idx'),
+            # Búsqueda de filas por archivo (recolector de archivos borrados)
+            models.Index(fields=['file'], name='dicom_file_name_idx'),
+        ]
 
     def __str__(self):
         return f"DICOM File for {self.patient_name} uploaded on {self.upload_date}"
@@ -87,4 +121,98 @@ class DicomTag(models.Model):
     value = models.TextField()
 
     def __str__(self):
-        return f"{self.tag}: {self.description}"
\ No newline at end of file
+        return f"{self.tag}: {self.description}"
+
+class ExportJob(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_EXPIRED = 'expired'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pendiente'),
+        (STATUS_RUNNING, 'En curso'),
+        (STATUS_DONE, 'Completado'),
+        (STATUS_FAILED, 'Fallido'),
+        (STATUS_EXPIRED, 'Expirado'),
+    ]
+
+    experiment = models.ForeignKey(Experiment, on_delete=models.CASCADE, related_name='export_jobs')
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='export_jobs')
+    filters = models.JSONField(default=dict, blank=True)  # Exportación parcial (ver parse_export_filters)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+    files_total = models.IntegerField(default=0)
+    files_done = models.IntegerField(default=0)
+    current_participant = models.CharField(max_length=100, blank=True)
+    archive = models.FileField(upload_to='exports/', blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)  # Heartbeat del worker
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    validation_report = models.JSONField(null=True, blank=True)
+
+    def eta_seconds(self):
+        """Segundos restantes estimados según el ritmo actual, o None."""
+        if self.status != self.STATUS_RUNNING or not self.started_at or not self.files_done:
+            return None
+        elapsed = (timezone.now() - self.started_at).total_seconds()
+        remaining = max(self.files_total - self.files_done, 0)
+        return round(elapsed / self.files_done * remaining)
+
+    def __str__(self):
+        return f"Export {self.pk} of {self.experiment} ({self.status})"
+
+class BidsChange(models.Model):
+    """
+    Diario de cambios pendientes de aplicar al espejo BIDS persistente.
+    Guarda ids (no FKs) para sobrevivir al borrado de lo que describe.
+    """
+    KIND_FILES = 'files'                # DICOM subido, modificado o borrado
+    KIND_PARTICIPANTS = 'participants'  # Altas/bajas de participantes
+    KIND_DELETED = 'deleted'            # Experimento eliminado
+    KIND_CHOICES = [
+        (KIND_FILES, 'Archivos'),
+        (KIND_PARTICIPANTS, 'Participantes'),
+        (KIND_DELETED, 'Experimento eliminado'),
+    ]
+
+    experiment_id = models.IntegerField(db_index=True)
+    participant_id = models.IntegerField(null=True, blank=True)
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.kind} change for experiment {self.experiment_id}"
+
+class BidsValidationResult(models.Model):
+    """
+    Resultado de validación BIDS de un archivo, reutilizable mientras no
+    cambien su ruta, su contenido ni la versión del validador.
+    """
+    path = models.CharField(max_length=500)
+    content_hash = models.CharField(max_length=64)
+    validator_version = models.CharField(max_length=100)
+    issues = models.JSONField(default=list)
+    checked_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['path', 'content_hash', 'validator_version'], name='unique_bids_validation_result'),
+        ]
+
+    def __str__(self):
+        return f"{self.path} ({len(self.issues)} issues)"
+
+class DeletedBlob(models.Model):
+    """
+    Lápida de un archivo del almacenamiento cuyo registro se borró (DICOM,
+    nota de consentimiento o exportación). El recolector (blob_gc) lo
+    elimina cuando ninguna fila lo usa: subidas idénticas comparten archivo.
+    """
+    name = models.CharField(max_length=500)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"Deleted blob {self.name}"
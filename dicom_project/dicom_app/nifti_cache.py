@@ -0,0 +1,162 @@
+"""
+Content-keyed cache of DICOM -> NIfTI conversions.
+
+Entries are keyed by the SHA-256 of the source DICOM plus the converter
+version, the de-identification profile version (deid.PROFILE_VERSION) and
+OPTIONS_VERSION, so a repeated export only converts files whose content
+(or conversion settings) changed. Each entry is a directory holding
+image.nii.gz and image.json; hits are hard-linked into the export (copied
+when the cache lives on another filesystem).
+
+Like bids_utils this module does not import Django: it runs inside the
+export worker processes.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from importlib import metadata
+from pathlib import Path
+
+from . import deid
+
+# Bump whenever the conversion options change the output (de-identification
+# changes bump deid.PROFILE_VERSION; the UID key never reaches the NIfTI).
+# 2: in-memory conversion with dicom_array_to_nifti
+OPTIONS_VERSION = 2
+
+NIFTI_NAME = "image.nii.gz"
+JSON_NAME = "image.json"
+
+
+def _converter_version():
+    try:
+        return f"dicom2nifti-{metadata.version('dicom2nifti')}"
+    except metadata.PackageNotFoundError:
+        return "dicom2nifti-unknown"
+
+CONVERTER_VERSION = _converter_version()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 hex digest of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def cache_key(content_hash):
+    """
+    Cache key for a source file: content hash + converter, profile and
+    options versions.
+    """
+    raw = f"{content_hash}:{CONVERTER_VERSION}:deid-{deid.PROFILE_VERSION}:{OPTIONS_VERSION}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _entry_dir(cache_dir, key):
+    return Path(cache_dir) / key[:2] / key
+
+def lookup(cache_dir, key):
+    """
+    Returns the entry directory for key, or None on a miss.
+    A hit refreshes the entry's mtime, which drives eviction.
+    """
+    entry = _entry_dir(cache_dir, key)
+    if not (entry / NIFTI_NAME).exists():
+        return None
+    try:
+        os.utime(entry)
+    except OSError:
+        pass
+    return entry
+
+def _link_or_copy(source, dest):
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+def materialize(entry, output_dir, output_basename):
+    """
+    Places a cached entry in output_dir under output_basename.
+    Returns (nifti_path, json_path) like convert_dicom_to_nifti.
+    """
+    dest_nifti = Path(output_dir) / f"{output_basename}.nii.gz"
+    dest_json = Path(output_dir) / f"{output_basename}.json"
+    _link_or_copy(entry / NIFTI_NAME, dest_nifti)
+    if (entry / JSON_NAME).exists():
+        _link_or_copy(entry / JSON_NAME, dest_json)
+    else:
+        dest_json = None
+    return dest_nifti, dest_json
+
+def store(cache_dir, key, nifti_path, json_path):
+    """
+    Adds a conversion result to the cache. The entry is staged next to its
+    final location and renamed into place, so concurrent workers storing
+    the same key never expose a half-written entry.
+    """
+    entry = _entry_dir(cache_dir, key)
+    if entry.exists():
+        return entry
+    entry.parent.mkdir(parents=True, exist_ok=True)
+
+    staging = Path(tempfile.mkdtemp(dir=entry.parent, prefix=".tmp-"))
+    try:
+        _link_or_copy(nifti_path, staging / NIFTI_NAME)
+        if json_path:
+            _link_or_copy(json_path, staging / JSON_NAME)
+        os.rename(staging, entry)
+    except OSError:
+        # Another worker won the race (or the cache is not writable)
+        shutil.rmtree(staging, ignore_errors=True)
+    return entry
+
+def copy_entry(cache_dir, old_key, new_key):
+    """
+    Makes the entry of old_key available under new_key as well, for a file
+    whose bytes changed but not its pixels (lossless recompression).
+    Returns whether there was an entry to copy.
+    """
+    entry = lookup(cache_dir, old_key)
+    if entry is None:
+        return False
+    json_path = entry / JSON_NAME
+    store(cache_dir, new_key, entry / NIFTI_NAME, json_path if json_path.exists() else None)
+    return True
+
+def evict(cache_dir, max_bytes):
+    """
+    Removes least recently used entries until the cache fits in max_bytes.
+    Returns the number of bytes freed.
+    """
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return 0
+
+    entries = []
+    total = 0
+    for shard in cache_dir.iterdir():
+        if not shard.is_dir():
+            continue
+        for entry in shard.iterdir():
+            if entry.name.startswith(".tmp-"):
+                continue
+            size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+            entries.append((entry.stat().st_mtime, size, entry))
+            total += size
+
+    freed = 0
+    for _, size, entry in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        freed += size
+        try:
+            entry.parent.rmdir()
+        except OSError:
+            pass  # shard still has entries
+    return freed
@@ -0,0 +1,181 @@
+"""
+Model signal handlers.
+
+Every change that affects an experiment's BIDS layout is recorded in the
+BidsChange journal, which sync_bids_mirror consumes to update only the
+affected parts of the persistent mirror. The same events keep the
+ExperimentStats counters current and bump the application cache scopes
+(app_cache.py) of whatever a change is displayed on. Deleted rows leave a
+tombstone for their stored file (blob_gc.py).
+"""
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import app_cache, blob_gc, experiment_stats
+from .models import (
+    BidsChange, ConsentFile, DicomFile, Experiment, ExperimentStats, ExportJob, Member, Participant
+)
+
+
+def mirror_enabled():
+    return bool(getattr(settings, 'BIDS_MIRROR_ROOT', None))
+
+def _journal(kind, experiment_ids, participant_id=None):
+    if not mirror_enabled():
+        return
+    BidsChange.objects.bulk_create([
+        BidsChange(experiment_id=experiment_id, participant_id=participant_id, kind=kind)
+        for experiment_id in set(experiment_ids) if experiment_id
+    ])
+
+
+@receiver(post_save, sender=DicomFile)
+def journal_dicom_saved(sender, instance, update_fields=None, **kwargs):
+    # Backfilling content_hash does not change the exported data
+    if update_fields and set(update_fields) <= {'content_hash'}:
+        return
+    _journal(BidsChange.KIND_FILES, [instance.experiment_id], instance.participant_id)
+
+@receiver(post_delete, sender=DicomFile)
+def journal_dicom_deleted(sender, instance, **kwargs):
+    _journal(BidsChange.KIND_FILES, [instance.experiment_id], instance.participant_id)
+
+@receiver(post_save, sender=DicomFile)
+def count_dicom_saved(sender, instance, created, **kwargs):
+    if created:
+        experiment_stats.file_added(instance)
+
+@receiver(post_delete, sender=DicomFile)
+def count_dicom_deleted(sender, instance, **kwargs):
+    experiment_stats.file_removed(instance)
+
+@receiver(post_save, sender=Experiment)
+def create_experiment_stats(sender, instance, created, **kwargs):
+    if created:
+        ExperimentStats.objects.get_or_create(experiment=instance)
+
+@receiver(m2m_changed, sender=Participant.experiments.through)
+def journal_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # pk_set is not provided for clear(): remember who is being removed
+        if reverse:
+            instance._cleared_experiments = [instance.pk]
+        else:
+            instance._cleared_experiments = list(instance.experiments.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        experiment_ids = getattr(instance, '_cleared_experiments', [])
+    elif action in ('post_add', 'post_remove'):
+        # reverse: instance is an Experiment and pk_set holds participants
+        experiment_ids = [instance.pk] if reverse else (pk_set or [])
+    else:
+        return
+    _journal(BidsChange.KIND_PARTICIPANTS, experiment_ids)
+    experiment_stats.membership_changed(experiment_ids)
+
+@receiver(pre_delete, sender=Participant)
+def journal_participant_deleted(sender, instance, **kwargs):
+    # Memberships are deleted with the participant, without m2m_changed
+    instance._deleted_experiments = list(instance.experiments.values_list('pk', flat=True))
+    _journal(BidsChange.KIND_PARTICIPANTS, instance._deleted_experiments)
+
+@receiver(post_delete, sender=Participant)
+def count_participant_deleted(sender, instance, **kwargs):
+    experiment_stats.membership_changed(getattr(instance, '_deleted_experiments', []))
+
+@receiver(post_delete, sender=Experiment)
+def journal_experiment_deleted(sender, instance, **kwargs):
+    _journal(BidsChange.KIND_DELETED, [instance.pk])
+
+
+# Application cache invalidation. Experiment and participant pages show each
+# other's names, the dashboards show stats and activity, so a change bumps
+# the scopes of the objects it appears on plus the lists it is counted in.
+
+@receiver(post_save, sender=Experiment)
+def bump_experiment_saved(sender, instance, **kwargs):
+    participant_ids = instance.participants.values_list('pk', flat=True)
+    app_cache.bump(app_cache.EXPERIMENTS, app_cache.experiment_scope(instance.pk),
+                   *map(app_cache.participant_scope, participant_ids))
+
+@receiver(pre_delete, sender=Experiment)
+def bump_experiment_deleted(sender, instance, **kwargs):
+    # Before the memberships are gone
+    bump_experiment_saved(sender, instance)
+
+@receiver(post_save, sender=Participant)
+def bump_participant_saved(sender, instance, **kwargs):
+    experiment_ids = getattr(instance, '_deleted_experiments', None)
+    if experiment_ids is None:
+        experiment_ids = instance.experiments.values_list('pk', flat=True)
+    app_cache.bump(app_cache.PARTICIPANTS, app_cache.participant_scope(instance.pk),
+                   *map(app_cache.experiment_scope, experiment_ids))
+
+@receiver(post_delete, sender=Participant)
+def bump_participant_deleted(sender, instance, **kwargs):
+    # _deleted_experiments was saved by journal_participant_deleted
+    bump_participant_saved(sender, instance)
+    app_cache.bump(app_cache.EXPERIMENTS)
+
+@receiver(m2m_changed, sender=Participant.experiments.through)
+def bump_membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # journal_membership_changed keeps the experiments; the participants
+        # of a cleared experiment are needed too
+        if reverse:
+            instance._cleared_participants = list(instance.participants.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        experiment_ids = getattr(instance, '_cleared_experiments', [])
+        participant_ids = getattr(instance, '_cleared_participants', []) if reverse else [instance.pk]
+    elif action in ('post_add', 'post_remove'):
+        experiment_ids = [instance.pk] if reverse else (pk_set or [])
+        participant_ids = (pk_set or []) if reverse else [instance.pk]
+    else:
+        return
+    app_cache.bump(app_cache.EXPERIMENTS,
+                   *map(app_cache.experiment_scope, experiment_ids),
+                   *map(app_cache.participant_scope, participant_ids))
+
+@receiver(m2m_changed, sender=Member.experiments.through)
+def bump_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        instance._cleared_experiments = list(instance.experiments.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            experiment_ids = [instance.pk]
+        elif action == 'post_clear':
+            experiment_ids = getattr(instance, '_cleared_experiments', [])
+        else:
+            experiment_ids = pk_set or []
+        app_cache.bump(*map(app_cache.experiment_scope, experiment_ids))
+
+@receiver(post_save, sender=Member)
+@receiver(pre_delete, sender=Member)
+def bump_member_changed(sender, instance, **kwargs):
+    app_cache.bump(*map(app_cache.experiment_scope, instance.experiments.values_list('pk', flat=True)))
+
+@receiver(post_save, sender=DicomFile)
+@receiver(post_delete, sender=DicomFile)
+def bump_dicom_changed(sender, instance, **kwargs):
+    app_cache.bump(app_cache.EXPERIMENTS, app_cache.PARTICIPANTS,
+                   app_cache.dicom_scope(instance.pk),
+                   app_cache.experiment_scope(instance.experiment_id) if instance.experiment_id else None,
+                   app_cache.participant_scope(instance.participant_id) if instance.participant_id else None)
+
+@receiver(post_save, sender=ConsentFile)
+@receiver(post_delete, sender=ConsentFile)
+def bump_consent_changed(sender, instance, **kwargs):
+    app_cache.bump(app_cache.PARTICIPANTS,
+                   app_cache.experiment_scope(instance.experiment_id),
+                   app_cache.participant_scope(instance.participant_id))
+
+@receiver(post_delete, sender=DicomFile)
+@receiver(post_delete, sender=ConsentFile)
+def tombstone_file(sender, instance, **kwargs):
+    blob_gc.record_deleted([instance.file.name])
+
+@receiver(post_delete, sender=ExportJob)
+def tombstone_archive(sender, instance, **kwargs):
+    blob_gc.record_deleted([instance.archive.name])
@@ -1,3 +1,1271 @@
-from django.test import TestCase
+"""
+Query-count and query-plan regression tests.
 
-# Create your tests here.
+Each view is requested over a seeded dataset and must stay within a fixed
+number of queries, whatever the number of participants and files: an N+1
+loop makes the count grow with the data and fails here. On PostgreSQL the
+key queries are also EXPLAINed with sequential scans discouraged, and fail
+if DicomFile or DicomTag can only be read by a sequential scan (a missing
+or unusable index).
+
+The storage tests run the upload and export paths against an in-memory
+storage, which has no filesystem paths, as an object store would.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zipfile
+from contextlib import ExitStack
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import pydicom
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from pydicom.dataset import FileDataset, FileMetaDataset
+
+from . import app_cache, bids_mirror, bids_validation, blob_gc, deid, dicom_splice, experiment_stats, export_jobs, keyset, nifti_cache
+from .bids_export import DATASET_DIRNAME, plan_experiment_export, run_conversions, stream_experiment_bids
+from .dicom_export import stream_experiment_dicom
+from .db_router import STICKY_COOKIE, ReplicaRouter, ReplicaStickinessMiddleware, use_primary
+from .dicom_compression import compress_dataset
+from .dicom_storage import is_sharded, save_file, sharded_name, stage
+from .management.commands import shard_dicom_storage
+from .models import BidsChange, ConsentFile, DeletedBlob, DicomFile, DicomTag, Experiment, ExportJob, Participant
+from .views import process_dicom_file
+from .zip_stream import ZipStream
+
+
+def seed(participants=30, files_per_participant=4, tags_per_file=60):
+    experiment = Experiment.objects.create(name='Estudio', description='Regresión de consultas')
+    Experiment.objects.create(name='Otro estudio')
+    people = Participant.objects.bulk_create([
+        Participant(subject_id=f'S{i:04d}', first_name=f'Nombre{i}', last_name=f'Apellido{i}')
+        for i in range(participants)
+    ])
+    experiment.participants.add(*people)
+    DicomFile.objects.bulk_create([
+        DicomFile(
+            participant=person, experiment=experiment, patient_name=f'P{person.pk}-{n}',
+            file=f'dicoms/raw/P{person.pk}-{n}.dcm', original_filename=f'{n}.dcm', file_size=1024,
+            modality='MR', series_description='T1w', series_number=n + 1,
+        )
+        for person in people for n in range(files_per_participant)
+    ])
+    files = list(DicomFile.objects.order_by('id'))
+    DicomTag.objects.bulk_create([
+        DicomTag(dicom_file=dicom_file, tag=f'(0010, {t:04X})', description=f'Tag {t}', vr='LO', value=f'valor {t}')
+        for dicom_file in files for t in range(tags_per_file)
+    ])
+    ConsentFile.objects.bulk_create([
+        ConsentFile(participant=person, experiment=experiment, file=f'consent_notes/{person.pk}.pdf',
+                    original_filename='consentimiento.pdf', file_size=10)
+        for person in people[::2]
+    ])
+    # bulk_create skips the signals that keep the counters current
+    experiment_stats.reconcile()
+    return experiment, people, files
+
+
+class QueryCountTests(TestCase):
+    """
+    Maximum queries per view, cache cold. The budget includes the session
+    and user lookups of the authenticated request.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('investigador', password='x', is_staff=True)
+        cls.experiment, cls.people, cls.files = seed()
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+
+    def assertMaxQueries(self, limit, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        self.assertLessEqual(
+            len(queries), limit,
+            f"{url}: {len(queries)} queries\n" + '\n'.join(q['sql'] for q in queries.captured_queries)
+        )
+        return response
+
+    def test_dashboard(self):
+        self.assertMaxQueries(4, reverse('dashboard'))
+
+    def test_participant_dashboard(self):
+        self.assertMaxQueries(5, reverse('participant_dashboard'))
+
+    def test_experiment_detail(self):
+        self.assertMaxQueries(5, reverse('experiment_detail', args=[self.experiment.pk]))
+
+    def test_participant_pages(self):
+        person = self.people[0]
+        self.assertMaxQueries(4, reverse('participant_experiments', args=[person.pk]))
+        self.assertMaxQueries(5, reverse('participant_experiment_dicoms', args=[person.pk, self.experiment.pk]))
+
+    def test_dicom_lists(self):
+        self.assertMaxQueries(4, reverse('dicomfile_list'))
+        self.assertMaxQueries(3, reverse('dicom_file_list_api') + f'?experiment={self.experiment.pk}')
+        self.assertMaxQueries(3, reverse('experiment_stats_api'))
+
+    def test_dicom_detail_and_tags(self):
+        dicom_file = self.files[0]
+        self.assertMaxQueries(4, reverse('dicomfile_detail', args=[dicom_file.pk]))
+        response = self.assertMaxQueries(3, reverse('dicom_tags_api', args=[dicom_file.pk]) + '?q=valor&offset=50')
+        self.assertEqual(response.json()['count'], 60)
+
+    def test_export_plan(self):
+        self.assertMaxQueries(6, reverse('export_experiment_plan', args=[self.experiment.pk]))
+
+    def test_series_filter_is_matched_in_python(self):
+        # Lookbehind and \A are Python syntax the database regex may reject
+        _, tasks = plan_experiment_export(self.experiment, filters={'series': r'(?<![a-z])\At1w'})
+        self.assertEqual(len(tasks), len(self.files))
+        _, tasks = plan_experiment_export(self.experiment, filters={'series': r'\Abold'})
+        self.assertEqual(tasks, [])
+
+    def test_counts_do_not_grow_with_data(self):
+        urls = [
+            reverse('participant_dashboard'),
+            reverse('experiment_detail', args=[self.experiment.pk]),
+            reverse('dicomfile_list'),
+            reverse('export_experiment_plan', args=[self.experiment.pk]),
+        ]
+
+        def counts():
+            cache.clear()
+            result = []
+            for url in urls:
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(url)
+                result.append(len(queries))
+            return result
+
+        before = counts()
+        more = Participant.objects.bulk_create([
+            Participant(subject_id=f'X{i:04d}', first_name='Más', last_name=str(i)) for i in range(40)
+        ])
+        self.experiment.participants.add(*more)
+        DicomFile.objects.bulk_create([
+            DicomFile(participant=person, experiment=self.experiment, patient_name='X', file='dicoms/raw/x.dcm',
+                      modality='MR', series_description='bold', series_number=9)
+            for person in more
+        ])
+        self.assertEqual(counts(), before)
+
+    def test_cached_views_skip_the_database(self):
+        url = reverse('experiment_detail', args=[self.experiment.pk])
+        self.client.get(url)
+        # Session and user only
+        self.assertMaxQueries(2, url)
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', 'EXPLAIN checks need PostgreSQL')
+class QueryPlanTests(TestCase):
+    """
+    The queries a view runs are captured and EXPLAINed with enable_seqscan
+    off: the planner still picks a sequential scan when no index can answer
+    a query, so any Seq Scan left on the big tables means that query would
+    read the whole table in production.
+    """
+    BIG_TABLES = {DicomFile._meta.db_table, DicomTag._meta.db_table}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('investigador', password='x', is_staff=True)
+        cls.experiment, cls.people, cls.files = seed(participants=20, files_per_participant=3, tags_per_file=20)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.user)
+        # Each test runs in a transaction: the setting lasts until its end
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def plan(self, sql, params=None):
+        # Captured SQL comes with its parameters already interpolated
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return list(_plan_nodes(plan[0]['Plan']))
+
+    def seq_scans(self, sql, params=None):
+        return [
+            node['Relation Name'] for node in self.plan(sql, params)
+            if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in self.BIG_TABLES
+        ]
+
+    def assertViewUsesIndexes(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        checked = 0
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or not any(table in sql for table in self.BIG_TABLES):
+                continue
+            checked += 1
+            scans = self.seq_scans(sql)
+            self.assertFalse(scans, f"{url}: sequential scan on {scans}\n{sql}")
+        self.assertTrue(checked, f"{url} did not query DicomFile or DicomTag")
+
+    def test_dicom_lists(self):
+        first = self.client.get(reverse('dicom_file_list_api'), {'limit': 5}).json()
+        self.assertViewUsesIndexes(reverse('dicomfile_list'))
+        self.assertViewUsesIndexes(first['next'])
+        self.assertViewUsesIndexes(reverse('dicom_file_list_api') + f'?experiment={self.experiment.pk}')
+        self.assertViewUsesIndexes(reverse('participant_experiment_dicoms', args=[self.people[0].pk, self.experiment.pk]))
+
+    def test_keyset_cursor_bounds_the_index(self):
+        # With sequential scans allowed, the cursor itself has to give the
+        # planner a range on dicom_upload_idx, not just a filter over it
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = on')
+        ordering = ('-upload_date', '-id')
+        first = keyset.paginate(DicomFile.objects.all(), ordering, per_page=5)
+        second = keyset.paginate(DicomFile.objects.all(), ordering, first.next_cursor, per_page=5)
+        for cursor in (first.next_cursor, second.previous_cursor):
+            with CaptureQueriesContext(connection) as queries:
+                keyset.paginate(DicomFile.objects.all(), ordering, cursor, per_page=5)
+            sql = queries.captured_queries[-1]['sql']
+            bounds = [node.get('Index Cond', '') for node in self.plan(sql)]
+            self.assertTrue(any('upload_date' in bound for bound in bounds), f"no index range on upload_date\n{sql}")
+
+    def test_participant_activity(self):
+        self.assertViewUsesIndexes(reverse('participant_dashboard'))
+        self.assertViewUsesIndexes(reverse('experiment_detail', args=[self.experiment.pk]))
+
+    def test_tags_of_a_file(self):
+        self.assertViewUsesIndexes(reverse('dicom_tags_api', args=[self.files[0].pk]))
+
+    def test_export_plan(self):
+        self.assertViewUsesIndexes(reverse('export_experiment_plan', args=[self.experiment.pk]))
+
+    def test_experiment_stats(self):
+        sql, params = experiment_stats.computed_stats(Experiment.objects.all()).query.sql_with_params()
+        self.assertFalse(self.seq_scans(sql, params))
+
+
+# No filesystem paths, as with an object store
+IN_MEMORY_STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+
+def make_dicom_dataset(description, seed):
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = pydicom.uid.MRImageStorage
+    meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+    ds = FileDataset(description, {}, file_meta=meta, preamble=b'\0' * 128)
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.StudyInstanceUID = pydicom.uid.generate_uid()
+    ds.SeriesInstanceUID = pydicom.uid.generate_uid()
+    ds.PatientName = 'Doe^John'
+    ds.PatientID = 'PID123'
+    ds.Modality = 'MR'
+    ds.SeriesDescription = description
+    ds.SeriesNumber = 1
+    ds.InstanceNumber = 1
+    ds.ImageType = ['ORIGINAL', 'PRIMARY']
+    ds.Rows = ds.Columns = 16
+    ds.BitsAllocated = ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelSpacing = [1, 1]
+    ds.SliceThickness = 1
+    ds.ImagePositionPatient = [0, 0, 0]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    # Flat runs, as in the background of real images, so RLE has something to gain
+    ds.PixelData = (np.arange(256, dtype=np.uint16) // 64 * seed).tobytes()
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    return ds
+
+
+def make_dicom_upload(description, seed):
+    buffer = io.BytesIO()
+    make_dicom_dataset(description, seed).save_as(buffer)
+    return SimpleUploadedFile(f'{description}.dcm', buffer.getvalue())
+
+
+@override_settings(
+    STORAGES=IN_MEMORY_STORAGES,
+    BIDS_CACHE_DIR='',
+    BIDS_EXPORT_WORKERS=1,
+)
+class ObjectStorageTests(TestCase):
+    """
+    Uploads, viewers and exports with a storage that has no local paths.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('investigador', password='x', is_staff=True)
+        self.client.force_login(self.user)
+        self.experiment = Experiment.objects.create(name='Estudio remoto')
+        self.participant = Participant.objects.create(subject_id='S1', first_name='Ana', last_name='Pérez')
+        self.experiment.participants.add(self.participant)
+        self.files = [
+            process_dicom_file(make_dicom_upload(description, seed), self.participant, self.experiment)[0]
+            for seed, description in enumerate(['T1_MPRAGE', 'rest_bold'], start=1)
+        ]
+
+    def test_upload_is_stored_in_the_storage(self):
+        for dicom_file in self.files:
+            self.assertTrue(is_sharded(dicom_file.file.name))
+            with default_storage.open(dicom_file.file.name, 'rb') as f:
+                self.assertEqual(pydicom.dcmread(f).SeriesDescription, dicom_file.series_description)
+        # The same content is stored once
+        upload = make_dicom_upload('T2w', 3).read()
+        first, second = (
+            process_dicom_file(SimpleUploadedFile('t2.dcm', upload), self.participant, self.experiment)[0]
+            for _ in range(2)
+        )
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertNotEqual(first.pk, second.pk)
+        # Different content (new UIDs) gets its own file
+        other = process_dicom_file(make_dicom_upload('T2w', 3), self.participant, self.experiment)[0]
+        self.assertNotEqual(other.file.name, first.file.name)
+
+    def test_upload_bumps_the_file_scope_once(self):
+        with mock.patch.object(app_cache, 'bump', wraps=app_cache.bump) as bump:
+            dicom_file, tags = process_dicom_file(make_dicom_upload('T2w', 5), self.participant, self.experiment)
+        scope = app_cache.dicom_scope(dicom_file.pk)
+        self.assertGreater(len(tags), 20)
+        # Saving the DicomFile and creating its tags, not once per tag
+        self.assertLessEqual(sum(scope in call.args for call in bump.call_args_list), 2)
+
+    def test_image_view(self):
+        response = self.client.get(reverse('dicom_image_view', args=[self.files[0].pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+
+    def test_bids_conversion_stages_remote_files(self):
+        _, tasks = plan_experiment_export(self.experiment)
+        self.assertEqual([task['dicom_id'] for task in tasks], [f.pk for f in self.files])
+        bids_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bids_root, ignore_errors=True)
+        staged = []
+
+        def record_stage(name, directory):
+            staged.append(stage(name, directory))
+            return staged[-1]
+
+        converted = []
+        with mock.patch('dicom_app.bids_export.stage', side_effect=record_stage):
+            for _, nifti, _ in run_conversions(tasks, bids_root, workers=1):
+                # Each file is staged only when its conversion is submitted
+                self.assertEqual(len(staged), len(converted) + 1)
+                converted.append(nifti)
+        self.assertEqual(len(converted), 2)
+        self.assertTrue(all(converted))
+        self.assertTrue(all(is_copy for _, is_copy in staged))
+        self.assertFalse([path for path, _ in staged if os.path.exists(path)])
+
+    def test_failed_conversion_skips_only_that_file(self):
+        _, tasks = plan_experiment_export(self.experiment)
+        bids_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bids_root, ignore_errors=True)
+        with mock.patch('dicom_app.bids_utils.convert_dicom_to_nifti_cached',
+                        side_effect=[RuntimeError('caché desalojada'), ('a.nii.gz', 'a.json')]):
+            results = sorted((task['dicom_id'], nifti) for task, nifti, _ in run_conversions(tasks, bids_root, workers=1))
+        self.assertEqual(results, [(self.files[0].pk, None), (self.files[1].pk, 'a.nii.gz')])
+
+    def test_parallel_export_matches_serial(self):
+        def entries(workers):
+            archive = zipfile.ZipFile(io.BytesIO(b''.join(stream_experiment_bids(self.experiment, workers=workers))))
+            # Completion order differs; .gz members are compared decompressed
+            # (their gzip header carries a timestamp)
+            return {
+                name: gzip.decompress(archive.read(name)) if name.endswith('.gz') else archive.read(name)
+                for name in archive.namelist()
+            }
+
+        serial = entries(1)
+        self.assertEqual(len([name for name in serial if name.endswith('.nii.gz')]), 2)
+        self.assertEqual(entries(2), serial)
+
+    def test_dicom_export(self):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(stream_experiment_dicom(self.experiment, workers=1))))
+        names = archive.namelist()
+        self.assertEqual(len(names), 2)
+        for name in names:
+            ds = pydicom.dcmread(io.BytesIO(archive.read(name)))
+            self.assertNotEqual(str(ds.PatientName), 'Doe^John')
+            self.assertEqual(len(ds.PixelData), 512)
+
+
+@override_settings(
+    STORAGES=IN_MEMORY_STORAGES,
+    BIDS_CACHE_DIR='',
+    BIDS_EXPORT_WORKERS=1,
+)
+class CompressionTests(TestCase):
+    """
+    Lossless compression on upload and of files already stored.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.experiment = Experiment.objects.create(name='Estudio comprimido')
+        self.participant = Participant.objects.create(subject_id='S1', first_name='Ana', last_name='Pérez')
+        self.experiment.participants.add(self.participant)
+
+    def upload(self, description, seed):
+        return process_dicom_file(make_dicom_upload(description, seed), self.participant, self.experiment)[0]
+
+    def stored(self, dicom_file):
+        with default_storage.open(dicom_file.file.name, 'rb') as f:
+            return pydicom.dcmread(f)
+
+    def test_upload_is_compressed(self):
+        original = pydicom.dcmread(make_dicom_upload('T1_MPRAGE', 3))
+        with self.settings(DICOM_STORAGE_COMPRESSION='rle'):
+            dicom_file = self.upload('T1_MPRAGE', 3)
+        ds = self.stored(dicom_file)
+        self.assertEqual(ds.file_meta.TransferSyntaxUID, pydicom.uid.RLELossless)
+        self.assertTrue(np.array_equal(ds.pixel_array, original.pixel_array))
+        self.assertLess(default_storage.size(dicom_file.file.name), dicom_file.file_size)
+
+    def test_command_compresses_stored_files(self):
+        files = [self.upload('T1_MPRAGE', 1), self.upload('rest_bold', 2)]
+        old_names = [f.file.name for f in files]
+        call_command('compress_dicom_storage', workers=1, stdout=io.StringIO(), stderr=io.StringIO())
+
+        for dicom_file, old_name in zip(files, old_names):
+            dicom_file.refresh_from_db()
+            self.assertNotEqual(dicom_file.file.name, old_name)
+            self.assertFalse(default_storage.exists(old_name))
+            self.assertEqual(self.stored(dicom_file).file_meta.TransferSyntaxUID, pydicom.uid.RLELossless)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(stream_experiment_dicom(self.experiment, workers=1))))
+        self.assertEqual(len(archive.namelist()), 2)
+        self.assertEqual(pydicom.dcmread(io.BytesIO(archive.read(archive.namelist()[0]))).pixel_array.shape, (16, 16))
+
+        # A second run finds nothing left to compress
+        out = io.StringIO()
+        call_command('compress_dicom_storage', workers=1, stdout=out)
+        self.assertIn('Compressed 0 file(s)', out.getvalue())
+
+
+class ShardStorageTests(TestCase):
+    """
+    manage.py shard_dicom_storage over flat files in a local MEDIA_ROOT.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media_root, STORAGES={
+            **IN_MEMORY_STORAGES, 'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        }))
+        self.experiment = Experiment.objects.create(name='Estudio plano')
+        self.participant = Participant.objects.create(subject_id='S1', first_name='Ana', last_name='Pérez')
+
+    def legacy_file(self, name, content, recorded_as=None):
+        path = os.path.join(self.media_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return DicomFile.objects.create(
+            participant=self.participant, experiment=self.experiment, patient_name='P',
+            file=recorded_as or name, original_filename=os.path.basename(name), file_size=len(content),
+        )
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.media_root)
+            for directory, _, names in os.walk(self.media_root) for name in names
+        )
+
+    def test_interrupted_run_resumes_and_duplicates_collapse(self):
+        same, other = b'DICM igual', b'DICM distinto'
+        first = self.legacy_file('dicoms/raw/a.dcm', same)
+        second = self.legacy_file('dicoms/raw/b.dcm', same)
+        third = self.legacy_file('dicoms/raw/c.dcm', other, recorded_as='media/dicoms/raw/c.dcm')
+
+        # The second row's file is moved but the run dies before its row is
+        # updated, the worst place to be interrupted
+        move = shard_dicom_storage.Command._move
+
+        def move_then_die(command, dicom_file):
+            moved = move(command, dicom_file)
+            if dicom_file.pk == second.pk:
+                raise OSError('interrumpido')
+            return moved
+
+        with mock.patch.object(shard_dicom_storage.Command, '_move', autospec=True, side_effect=move_then_die):
+            with self.assertRaises(OSError):
+                call_command('shard_dicom_storage', batch_size=1, workers=1, stdout=io.StringIO())
+        second.refresh_from_db()
+        self.assertEqual(second.file.name, 'dicoms/raw/b.dcm')
+        self.assertTrue(second.content_hash)
+
+        out = io.StringIO()
+        call_command('shard_dicom_storage', batch_size=1, workers=1, stdout=out)
+        self.assertIn('Moved 2 file(s); 0 could not be found', out.getvalue())
+
+        for dicom_file in (first, second, third):
+            dicom_file.refresh_from_db()
+        self.assertEqual(first.file.name, sharded_name(hashlib.sha256(same).hexdigest()))
+        self.assertEqual(second.file.name, first.file.name)
+        self.assertEqual(third.file.name, sharded_name(hashlib.sha256(other).hexdigest()))
+        # One blob per distinct content, and nothing left in the flat layout
+        self.assertEqual(self.stored_files(), sorted([first.file.name, third.file.name]))
+        with default_storage.open(second.file.name, 'rb') as f:
+            self.assertEqual(f.read(), same)
+
+        out = io.StringIO()
+        call_command('shard_dicom_storage', dry_run=True, stdout=out)
+        self.assertIn('0 file(s) to move', out.getvalue())
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, BLOB_GC_RATE=0)
+class BlobGCTests(TestCase):
+    """
+    Tombstones of deleted rows and the orphan sweep.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.experiment = Experiment.objects.create(name='Estudio')
+        self.participant = Participant.objects.create(subject_id='S1', first_name='Ana', last_name='Pérez')
+        self.experiment.participants.add(self.participant)
+        self.upload = make_dicom_upload('T1_MPRAGE', 1).read()
+
+    def process(self):
+        return process_dicom_file(SimpleUploadedFile('t1.dcm', self.upload), self.participant, self.experiment)[0]
+
+    def test_shared_file_is_kept_until_its_last_row_is_deleted(self):
+        first, second = self.process(), self.process()
+        self.assertEqual(first.file.name, second.file.name)
+
+        first.delete()
+        self.assertEqual(blob_gc.reclaim_deleted(grace=0), (0, 1))
+        self.assertTrue(default_storage.exists(second.file.name))
+
+        second.delete()
+        self.assertEqual(blob_gc.reclaim_deleted(grace=3600), (0, 0))
+        self.assertEqual(blob_gc.reclaim_deleted(grace=0), (1, 1))
+        self.assertFalse(default_storage.exists(second.file.name))
+        self.assertFalse(DeletedBlob.objects.exists())
+
+    def test_cascades_and_failed_uploads_leave_tombstones(self):
+        consent = ConsentFile.objects.create(participant=self.participant, experiment=self.experiment,
+                                             file=ContentFile(b'%PDF', name='nota.pdf'),
+                                             original_filename='nota.pdf', file_size=4)
+        with mock.patch('dicom_app.views.DicomTag.objects.bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.process()
+        self.assertFalse(DicomFile.objects.exists())
+        failed_upload = DeletedBlob.objects.get().name
+        self.assertTrue(default_storage.exists(failed_upload))
+
+        self.experiment.delete()
+        self.assertEqual(blob_gc.reclaim_deleted(grace=0), (2, 2))
+        self.assertFalse(default_storage.exists(consent.file.name))
+        self.assertFalse(default_storage.exists(failed_upload))
+
+    def test_sweep_deletes_only_orphans(self):
+        kept = self.process()
+        orphan = default_storage.save('dicoms/raw/00/00/huerfano.dcm', ContentFile(b'x'))
+        other = default_storage.save('otros/documento.txt', ContentFile(b'x'))
+
+        out = io.StringIO()
+        call_command('sweep_orphan_blobs', dry_run=True, min_age=0, stdout=out)
+        self.assertIn(orphan, out.getvalue())
+        self.assertTrue(default_storage.exists(orphan))
+
+        call_command('sweep_orphan_blobs', min_age=1, stdout=io.StringIO())
+        self.assertTrue(default_storage.exists(orphan))
+
+        call_command('sweep_orphan_blobs', min_age=0, rate=0, stdout=io.StringIO())
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(default_storage.exists(kept.file.name))
+        self.assertTrue(default_storage.exists(other))
+
+    def test_row_saved_during_the_rate_limit_wait_keeps_the_file(self):
+        reclaimed = default_storage.save('dicoms/raw/00/00/lapida.dcm', ContentFile(b'x'))
+        swept = default_storage.save('dicoms/raw/00/01/barrido.dcm', ContentFile(b'y'))
+        blob_gc.record_deleted([reclaimed])
+        pending = [reclaimed, swept]
+
+        def new_row():
+            # Each file was unreferenced when its batch was checked
+            DicomFile.objects.create(participant=self.participant, experiment=self.experiment, patient_name='P',
+                                     file=pending.pop(0), original_filename='t1.dcm', file_size=1)
+
+        limiter = mock.Mock(**{'wait.side_effect': new_row})
+        with mock.patch.object(blob_gc, 'RateLimiter', return_value=limiter):
+            self.assertEqual(blob_gc.reclaim_deleted(grace=0), (0, 1))
+        with mock.patch('dicom_app.management.commands.sweep_orphan_blobs.RateLimiter', return_value=limiter):
+            call_command('sweep_orphan_blobs', min_age=0, stdout=io.StringIO())
+        self.assertEqual(limiter.wait.call_count, 2)
+        self.assertTrue(default_storage.exists(reclaimed))
+        self.assertTrue(default_storage.exists(swept))
+
+    def test_file_reused_before_its_row_is_saved_is_kept(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        with self.settings(MEDIA_ROOT=media_root, STORAGES={
+            **IN_MEMORY_STORAGES, 'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        }):
+            first = self.process()
+            name = first.file.name
+            path = default_storage.path(name)
+            os.utime(path, (0, 0))
+            first.delete()
+            cutoff = timezone.now() - timedelta(hours=1)
+
+            # Another upload of the same content has stored it, not its row
+            self.assertEqual(save_file(path)[0], name)
+            self.assertEqual(blob_gc.delete_unreferenced([name], cutoff=cutoff), [])
+            self.assertTrue(os.path.exists(path))
+
+            os.utime(path, (0, 0))
+            self.assertEqual(blob_gc.delete_unreferenced([name], cutoff=cutoff), [name])
+            self.assertFalse(os.path.exists(path))
+
+    def test_legacy_names_are_matched_exactly(self):
+        flat = 'dicoms/raw/P1_abc123.dcm'
+        for recorded in (f'media/{flat}', os.path.join(settings.MEDIA_ROOT, flat)):
+            row = DicomFile.objects.create(participant=self.participant, experiment=self.experiment, patient_name='P',
+                                           file=recorded, original_filename='t1.dcm', file_size=1)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(blob_gc.referenced_names([flat, 'dicoms/raw/otro.dcm']), {flat})
+            self.assertFalse([q['sql'] for q in queries.captured_queries if 'LIKE' in q['sql']])
+            row.delete()
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, BLOB_GC_RATE=0)
+class BlobGCRoutingTests(TransactionTestCase):
+    """
+    The reference checks of the collector within a request, where reads
+    would otherwise go to a replica.
+    """
+
+    @override_settings(DATABASE_REPLICAS=['sin_replicar'])
+    def test_referenced_file_is_kept_when_reads_go_to_a_replica(self):
+        experiment = Experiment.objects.create(name='Estudio')
+        participant = Participant.objects.create(subject_id='S1', first_name='Ana', last_name='Pérez')
+        name = process_dicom_file(make_dicom_upload('T1_MPRAGE', 1), participant, experiment)[0].file.name
+        # A stale tombstone for a file that is in use again
+        blob_gc.record_deleted([name])
+
+        def view(request):
+            # 'sin_replicar' is not even a database: any GC read sent there fails
+            self.results = blob_gc.delete_unreferenced([name]), blob_gc.reclaim_deleted(grace=0)
+            return HttpResponse()
+
+        ReplicaStickinessMiddleware(view)(RequestFactory().get('/'))
+        self.assertEqual(self.results, ([], (0, 1)))
+        self.assertTrue(default_storage.exists(name))
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, BIDS_VALIDATE_EXPORTS=False)
+class ExportJobTests(TransactionTestCase):
+    """
+    Claims of background export jobs. Transactional, so the heartbeat
+    thread sees the job row.
+    """
+
+    def setUp(self):
+        experiment = Experiment.objects.create(name='Estudio: T1/T2 ñ')
+        export_jobs.create_export_job(experiment)
+        self.job = export_jobs.claim_next_job()
+
+    def run_job(self, chunks):
+        with mock.patch.object(export_jobs, 'stream_experiment_bids', lambda *args, **kwargs: chunks()):
+            return export_jobs.run_export_job(self.job)
+
+    def test_archive_name_is_slugified(self):
+        job = self.run_job(lambda: iter([b'zip']))
+        self.assertEqual(job.status, ExportJob.STATUS_DONE)
+        self.assertEqual(job.archive.name, f'exports/{job.pk}_estudio_t1t2_n_bids.zip')
+
+    def test_heartbeat_runs_without_progress(self):
+        before = ExportJob.objects.get(pk=self.job.pk).updated_at
+
+        def slow():
+            time.sleep(0.5)
+            yield b'zip'
+
+        with mock.patch.object(export_jobs, 'HEARTBEAT_INTERVAL', 0.05):
+            self.run_job(slow)
+        # The heartbeat runs while the stream is still sleeping
+        beats = ExportJob.objects.filter(pk=self.job.pk, updated_at__gt=before)
+        self.assertTrue(beats.exists())
+
+    def test_job_taken_over_is_discarded(self):
+        def taken_over():
+            # Another worker reclaims the job as stale in the middle of the run
+            ExportJob.objects.filter(pk=self.job.pk).update(started_at=timezone.now() + timedelta(seconds=1))
+            yield b'zip'
+
+        job = self.run_job(taken_over)
+        self.assertEqual(job.status, ExportJob.STATUS_RUNNING)
+        self.assertFalse(job.archive)
+        self.assertFalse(default_storage.exists(f'exports/{job.pk}_estudio_t1t2_n_bids.zip'))
+
+    def test_progress_stops_once_taken_over(self):
+        reached_end = []
+
+        def stream(experiment, progress=None, **kwargs):
+            progress(0, 3, None)
+            yield b'zip'
+            # The new owner has made its own progress
+            ExportJob.objects.filter(pk=self.job.pk).update(started_at=timezone.now() + timedelta(seconds=1), files_done=2)
+            progress(3, 3, {'subject_id': 'sub-01'})
+            reached_end.append(True)
+            yield b'zip'
+
+        with mock.patch.object(export_jobs, 'stream_experiment_bids', stream):
+            job = export_jobs.run_export_job(self.job)
+        self.assertEqual(reached_end, [])
+        self.assertEqual(job.status, ExportJob.STATUS_RUNNING)
+        self.assertEqual(job.files_done, 2)
+        self.assertEqual(job.current_participant, '')
+
+
+class DeidTests(SimpleTestCase):
+    """
+    PS3.15 Basic Profile de-identification (deid).
+    """
+
+    def setUp(self):
+        self.key = deid.make_uid_key('secreto')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def make_dataset(self):
+        ds = make_dicom_dataset('T1w', 1)
+        ds.PatientBirthDate = '19700101'
+        ds.PatientAge = '054Y'
+        ds.OtherPatientNames = 'Roe^Jane'
+        ds.InstitutionName = 'Hospital Central'
+        ds.ReferringPhysicianName = 'House^Gregory'
+        ds.StudyDate = '20240101'
+        ds.private_block(0x0009, 'ACME', create=True).add_new(0x01, 'LO', 'secreto')
+        item = pydicom.Dataset()
+        item.private_block(0x0011, 'ACME', create=True).add_new(0x01, 'LO', 'secreto')
+        item.CodeValue = '1'
+        ds.ReferencedImageSequence = [item]
+        return ds
+
+    def test_phi_is_removed_or_replaced(self):
+        ds = deid.Deidentifier(self.key).deidentify(self.make_dataset())
+        for keyword in ('PatientName', 'PatientID', 'PatientBirthDate', 'ReferringPhysicianName', 'StudyDate'):
+            self.assertFalse(ds[keyword].value, keyword)
+        self.assertNotIn('PatientAge', ds)
+        self.assertNotIn('OtherPatientNames', ds)
+        self.assertNotEqual(ds.get('InstitutionName'), 'Hospital Central')
+        self.assertEqual(ds.PatientIdentityRemoved, 'YES')
+        self.assertEqual(ds.file_meta.MediaStorageSOPInstanceUID, ds.SOPInstanceUID)
+        # Non-identifying attributes survive
+        self.assertEqual(ds.Modality, 'MR')
+        self.assertEqual(ds.Rows, 16)
+
+    def test_private_tags_are_stripped(self):
+        ds = deid.Deidentifier(self.key).deidentify(self.make_dataset())
+        self.assertFalse([elem for elem in ds if elem.tag.is_private])
+        for item in ds.get('ReferencedImageSequence') or ():
+            self.assertFalse([elem for elem in item if elem.tag.is_private])
+
+    def test_uids_are_remapped_deterministically(self):
+        ds = self.make_dataset()
+        original = ds.StudyInstanceUID
+        buffer = io.BytesIO()
+        ds.save_as(buffer)
+
+        def deidentify(key):
+            return deid.Deidentifier(key).deidentify(pydicom.dcmread(io.BytesIO(buffer.getvalue())))
+
+        first = deidentify(self.key)
+        second = deidentify(deid.make_uid_key('secreto'))
+        other = deidentify(deid.make_uid_key('otro'))
+        self.assertNotEqual(first.StudyInstanceUID, original)
+        self.assertTrue(first.StudyInstanceUID.startswith('2.25.'))
+        self.assertEqual(first.StudyInstanceUID, second.StudyInstanceUID)
+        self.assertEqual(first.SOPInstanceUID, second.SOPInstanceUID)
+        self.assertNotEqual(first.StudyInstanceUID, other.StudyInstanceUID)
+
+    def test_uids_match_across_processes(self):
+        study = pydicom.uid.generate_uid()
+        paths = []
+        for n in range(4):
+            ds = self.make_dataset()
+            ds.StudyInstanceUID = study
+            paths.append(f'{self.directory}/{n}.dcm')
+            ds.save_as(paths[-1])
+        expected = deid.Deidentifier(self.key).uid(study)
+
+        # One file per batch, so the batches land on different processes
+        results = list(deid.deidentify_headers(paths, self.key, workers=2, batch_size=1))
+        self.assertEqual([error for *_, error in results], [None] * 4)
+        self.assertEqual({uids[0] for _, _, _, uids, _ in results}, {expected})
+        self.assertEqual(len({uids[2] for _, _, _, uids, _ in results}), 4)
+
+
+class DicomSpliceTests(SimpleTestCase):
+    """
+    A header edited after read_header and spliced onto the original Pixel
+    Data must read back with the edits and the exact same pixel bytes.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def round_trip(self, ds):
+        source = f'{self.directory}/source.dcm'
+        dest = f'{self.directory}/dest.dcm'
+        ds.save_as(source, write_like_original=False)
+        original = pydicom.dcmread(source)
+
+        header, span = dicom_splice.read_header(source)
+        header.PatientName = 'Anonimo'
+        header.InstitutionName = 'Sin institución'
+        dicom_splice.write_spliced(header, source, dest, span)
+
+        spliced = pydicom.dcmread(dest)
+        self.assertEqual(spliced.file_meta.TransferSyntaxUID, original.file_meta.TransferSyntaxUID)
+        self.assertEqual(spliced.PatientName, 'Anonimo')
+        self.assertEqual(spliced.InstitutionName, 'Sin institución')
+        self.assertEqual(spliced.SOPInstanceUID, original.SOPInstanceUID)
+        self.assertEqual(spliced.PixelData, original.PixelData)
+        np.testing.assert_array_equal(spliced.pixel_array, original.pixel_array)
+
+        # What archives stream: the encoded header followed by the source span
+        streamed = dicom_splice.encode_header(header) + b''.join(dicom_splice.iter_pixel_data(source, span))
+        with open(dest, 'rb') as f:
+            self.assertEqual(streamed, f.read())
+        return span
+
+    def test_explicit_little_endian(self):
+        self.assertIsNotNone(self.round_trip(make_dicom_dataset('T1w', 1)))
+
+    def test_implicit_little_endian(self):
+        ds = make_dicom_dataset('T1w', 2)
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.ImplicitVRLittleEndian
+        ds.is_implicit_VR = True
+        self.assertIsNotNone(self.round_trip(ds))
+
+    def test_encapsulated(self):
+        ds = make_dicom_dataset('T1w', 3)
+        self.assertTrue(compress_dataset(ds))
+        self.assertIsNotNone(self.round_trip(ds))
+
+    def test_deflated(self):
+        ds = make_dicom_dataset('T1w', 4)
+        ds.file_meta.TransferSyntaxUID = pydicom.uid.DeflatedExplicitVRLittleEndian
+        # Read whole: nothing to splice
+        self.assertIsNone(self.round_trip(ds))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTests(TransactionTestCase):
+    """
+    Where ReplicaRouter sends reads. Transactional, since TestCase would
+    keep every read inside an atomic block.
+    """
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.reads = []
+
+    def read(self):
+        self.reads.append(self.router.db_for_read(DicomFile))
+
+    def serve(self, view, method='get', cookies=None):
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        return ReplicaStickinessMiddleware(view)(request)
+
+    def reading_view(self, request):
+        self.read()
+        return HttpResponse()
+
+    def test_reads_outside_requests_use_the_primary(self):
+        self.read()
+        self.assertEqual(self.reads, ['default'])
+
+    def test_a_write_pins_the_rest_of_the_request(self):
+        def view(request):
+            self.read()
+            self.router.db_for_write(DicomFile)
+            self.read()
+            return HttpResponse()
+
+        response = self.serve(view)
+        self.assertEqual(self.reads, ['replica', 'default'])
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        self.assertEqual(response.cookies[STICKY_COOKIE]['max-age'], settings.REPLICA_STICKY_SECONDS)
+
+    def test_cookie_pins_the_client_for_a_while(self):
+        response = self.serve(self.reading_view)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.serve(self.reading_view, cookies={STICKY_COOKIE: str(time.time() + 60)})
+        self.serve(self.reading_view, cookies={STICKY_COOKIE: str(time.time() - 1)})
+        self.serve(self.reading_view, cookies={STICKY_COOKIE: 'no es un número'})
+        self.assertEqual(self.reads, ['replica', 'default', 'replica', 'replica'])
+
+    def test_unsafe_methods_use_the_primary(self):
+        self.serve(self.reading_view, method='post')
+        self.assertEqual(self.reads, ['default'])
+
+    def test_atomic_and_use_primary_blocks(self):
+        def view(request):
+            with transaction.atomic():
+                self.read()
+            with use_primary():
+                self.read()
+            self.read()
+            return HttpResponse()
+
+        self.serve(view)
+        self.assertEqual(self.reads, ['default', 'default', 'replica'])
+
+    def test_instances_are_read_where_they_came_from(self):
+        dicom_file = DicomFile(patient_name='P')
+        dicom_file._state.db = 'replica'
+        self.assertEqual(self.router.db_for_read(Participant, instance=dicom_file), 'replica')
+
+
+@unittest.skipUnless(settings.DATABASE_REPLICAS, 'needs DB_REPLICA_HOSTS or DB_REPLICA_MIRRORS')
+class ReplicaStickinessTests(TransactionTestCase):
+    """
+    Requests through the whole middleware stack against the configured
+    replicas (DB_REPLICA_MIRRORS=1 makes one out of the test database).
+    Transactional, like ReplicaRouterTests.
+    """
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        self.user = User.objects.create_user('investigador', password='x', is_staff=True)
+        self.client.force_login(self.user)
+        self.experiment = Experiment.objects.create(name='Estudio')
+
+    def replica_queries(self, method, url, **kwargs):
+        with ExitStack() as stack:
+            captured = [stack.enter_context(CaptureQueriesContext(connections[alias]))
+                        for alias in settings.DATABASE_REPLICAS]
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400, url)
+        return sum(len(queries) for queries in captured)
+
+    def test_client_reads_its_own_writes(self):
+        dashboard = reverse('dashboard')
+        self.assertGreater(self.replica_queries('get', dashboard), 0)
+        self.assertNotIn(STICKY_COOKIE, self.client.cookies)
+
+        url = reverse('update_experiment_description', args=[self.experiment.pk])
+        self.assertEqual(self.replica_queries('post', url, data='{"description": "nueva"}',
+                                              content_type='application/json'), 0)
+        self.assertIn(STICKY_COOKIE, self.client.cookies)
+        self.assertEqual(self.replica_queries('get', dashboard), 0)
+
+        del self.client.cookies[STICKY_COOKIE]
+        self.assertGreater(self.replica_queries('get', dashboard), 0)
+
+
+class ZipStreamTests(SimpleTestCase):
+    """
+    Archives written by ZipStream to a non-seekable stream.
+    """
+
+    def test_streamed_archive_round_trips(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        nifti = os.path.join(directory, 'sub-01_T1w.nii.gz')
+        with open(nifti, 'wb') as f:
+            f.write(gzip.compress(os.urandom(300_000)))
+        big = b'0123456789' * 250_000
+
+        stream = ZipStream()
+        parts = [
+            *stream.write_bytes('dataset_description.json', b'{"Name": "Dataset"}' * 100),
+            *stream.write_file(nifti, 'sub-01/anat/sub-01_T1w.nii.gz'),
+            *stream.write_chunks('dicom/1.dcm', (big[i:i + 65536] for i in range(0, len(big), 65536)), size=len(big)),
+            *stream.close(),
+        ]
+        # Bytes come out as entries are written, not all at the end
+        self.assertGreater(len(parts), 3)
+
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(parts)))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ['dataset_description.json', 'sub-01/anat/sub-01_T1w.nii.gz', 'dicom/1.dcm'])
+        compression = {info.filename: info.compress_type for info in archive.infolist()}
+        self.assertEqual(compression['sub-01/anat/sub-01_T1w.nii.gz'], zipfile.ZIP_STORED)
+        self.assertEqual(compression['dataset_description.json'], zipfile.ZIP_DEFLATED)
+        self.assertEqual(compression['dicom/1.dcm'], zipfile.ZIP_DEFLATED)
+        with open(nifti, 'rb') as f:
+            self.assertEqual(archive.read('sub-01/anat/sub-01_T1w.nii.gz'), f.read())
+        self.assertEqual(archive.read('dicom/1.dcm'), big)
+        self.assertLess(archive.getinfo('dicom/1.dcm').compress_size, len(big) // 10)
+
+
+class NiftiCacheTests(TestCase):
+    """
+    The content-keyed conversion cache (nifti_cache), directly and through
+    run_conversions.
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        self.output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output, ignore_errors=True)
+
+    def converted(self, name, data):
+        nifti = os.path.join(self.output, f'{name}.nii.gz')
+        json_path = os.path.join(self.output, f'{name}.json')
+        with open(nifti, 'wb') as f:
+            f.write(data)
+        with open(json_path, 'w') as f:
+            f.write('{}')
+        return nifti, json_path
+
+    def entries(self):
+        return sorted(path.name for path in Path(self.cache_dir).glob('*/*'))
+
+    def test_key_follows_converter_and_profile_versions(self):
+        key = nifti_cache.cache_key('abc')
+        self.assertEqual(nifti_cache.cache_key('abc'), key)
+        self.assertNotEqual(nifti_cache.cache_key('abd'), key)
+        with mock.patch.object(deid, 'PROFILE_VERSION', deid.PROFILE_VERSION + 1):
+            self.assertNotEqual(nifti_cache.cache_key('abc'), key)
+        with mock.patch.object(nifti_cache, 'OPTIONS_VERSION', nifti_cache.OPTIONS_VERSION + 1):
+            self.assertNotEqual(nifti_cache.cache_key('abc'), key)
+
+    def test_hit_materializes_the_stored_conversion(self):
+        key = nifti_cache.cache_key('abc')
+        self.assertIsNone(nifti_cache.lookup(self.cache_dir, key))
+        nifti_cache.store(self.cache_dir, key, *self.converted('original', b'nifti'))
+
+        entry = nifti_cache.lookup(self.cache_dir, key)
+        destination = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, destination)
+        nifti, json_path = nifti_cache.materialize(entry, destination, 'sub-01_T1w')
+        self.assertEqual(nifti, destination / 'sub-01_T1w.nii.gz')
+        self.assertEqual(nifti.read_bytes(), b'nifti')
+        self.assertEqual(json_path.read_text(), '{}')
+
+    def test_store_race_keeps_the_winner(self):
+        key = nifti_cache.cache_key('abc')
+        mkdtemp = tempfile.mkdtemp
+
+        def winner_first(**kwargs):
+            # Another worker renames its entry in place right before ours
+            entry = Path(self.cache_dir) / key[:2] / key
+            entry.mkdir()
+            (entry / nifti_cache.NIFTI_NAME).write_bytes(b'winner')
+            return mkdtemp(**kwargs)
+
+        with mock.patch.object(nifti_cache.tempfile, 'mkdtemp', side_effect=winner_first):
+            entry = nifti_cache.store(self.cache_dir, key, *self.converted('loser', b'loser'))
+        self.assertEqual((entry / nifti_cache.NIFTI_NAME).read_bytes(), b'winner')
+        # No staging directory left behind
+        self.assertEqual(self.entries(), [key])
+
+    def test_eviction_removes_least_recently_used_entries(self):
+        keys = [nifti_cache.cache_key(str(n)) for n in range(3)]
+        for age, key in zip((300, 200, 100), keys):
+            entry = nifti_cache.store(self.cache_dir, key, *self.converted(key, b'x' * 1000))
+            os.utime(entry, (time.time() - age, time.time() - age))
+        # A hit makes the oldest entry the most recently used
+        nifti_cache.lookup(self.cache_dir, keys[0])
+
+        self.assertEqual(nifti_cache.evict(self.cache_dir, 2100), 1002)
+        self.assertEqual(self.entries(), sorted([keys[0], keys[2]]))
+
+    @override_settings(STORAGES=IN_MEMORY_STORAGES, BIDS_CACHE_MAX_BYTES=10 * 1024 ** 2)
+    def test_repeated_conversion_is_served_from_the_cache(self):
+        experiment = Experiment.objects.create(name='Estudio')
+        participant = Participant.objects.create(subject_id='S1', first_name='Ana', last_name='Pérez')
+        experiment.participants.add(participant)
+        process_dicom_file(make_dicom_upload('T1_MPRAGE', 1), participant, experiment)
+        _, tasks = plan_experiment_export(experiment)
+
+        def convert(bids_root):
+            return [nifti for _, nifti, _ in run_conversions(tasks, bids_root, workers=1)]
+
+        with override_settings(BIDS_CACHE_DIR=self.cache_dir):
+            first = convert(tempfile.mkdtemp(dir=self.output))
+            self.assertEqual(len(self.entries()), 1)
+            with mock.patch('dicom_app.bids_utils.convert_dicom_to_nifti') as converter:
+                second = convert(tempfile.mkdtemp(dir=self.output))
+            converter.assert_not_called()
+            self.assertEqual(Path(second[0]).read_bytes(), Path(first[0]).read_bytes())
+
+            # Trimmed to BIDS_CACHE_MAX_BYTES after every run
+            with override_settings(BIDS_CACHE_MAX_BYTES=0):
+                convert(tempfile.mkdtemp(dir=self.output))
+            self.assertEqual(self.entries(), [])
+
+
+def _file_contents(name, data):
+    # NIfTI members are compared decompressed (the gzip header has a timestamp)
+    return gzip.decompress(data) if name.endswith('.gz') else data
+
+
+@override_settings(STORAGES=IN_MEMORY_STORAGES, BIDS_CACHE_DIR='', BIDS_EXPORT_WORKERS=1)
+class BidsMirrorTests(TestCase):
+    """
+    The BidsChange journal and its incremental replay into the mirror.
+    """
+
+    def setUp(self):
+        mirror_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, mirror_root, ignore_errors=True)
+        self.enterContext(override_settings(BIDS_MIRROR_ROOT=mirror_root))
+
+        self.experiment = Experiment.objects.create(name='Estudio')
+        self.people = [
+            Participant.objects.create(subject_id=f'S{n}', first_name='Ana', last_name=str(n)) for n in range(3)
+        ]
+        self.experiment.participants.add(*self.people)
+        self.files = [
+            process_dicom_file(make_dicom_upload(description, seed), person, self.experiment)[0]
+            for seed, (person, description) in enumerate(
+                [(self.people[0], 'T1_MPRAGE'), (self.people[1], 'T1_MPRAGE'),
+                 (self.people[1], 'rest_bold'), (self.people[2], 'T1_MPRAGE')], start=1)
+        ]
+
+    def mirror(self):
+        root = bids_mirror.mirror_dir(self.experiment.pk)
+        return {
+            str(path.relative_to(root)): _file_contents(path.name, path.read_bytes())
+            for path in root.rglob('*') if path.is_file() and path.name != bids_mirror.STATE_FILENAME
+        }
+
+    def full_export(self):
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(stream_experiment_bids(self.experiment))))
+        prefix = f'{DATASET_DIRNAME}/'
+        return {name[len(prefix):]: _file_contents(name, archive.read(name)) for name in archive.namelist()}
+
+    def sync(self):
+        self.assertTrue(BidsChange.objects.exists())
+        results = bids_mirror.sync_pending_changes()
+        self.assertFalse(BidsChange.objects.exists())
+        self.assertEqual(self.mirror(), self.full_export())
+        return results[self.experiment.pk]
+
+    def test_changes_are_replayed_incrementally(self):
+        result = self.sync()
+        self.assertEqual(result, {'updated': ['sub-01', 'sub-02', 'sub-03'], 'removed': []})
+        self.assertIn('sub-02/func/sub-02_task-rest_run-01_bold.nii.gz', self.mirror())
+
+        # Delete a file and relabel another: only their subjects are rebuilt
+        self.files[2].delete()
+        self.files[3].series_description = 'rest_bold'
+        self.files[3].save()
+        result = self.sync()
+        self.assertEqual(result, {'updated': ['sub-02', 'sub-03'], 'removed': []})
+        self.assertNotIn('sub-02/func/sub-02_task-rest_run-01_bold.nii.gz', self.mirror())
+        self.assertIn('sub-03/func/sub-03_task-rest_run-01_bold.nii.gz', self.mirror())
+
+        # Removing the first participant renumbers the others
+        self.experiment.participants.remove(self.people[0])
+        result = self.sync()
+        self.assertEqual(result, {'updated': ['sub-01', 'sub-02'], 'removed': ['sub-03']})
+
+    def test_deleted_experiment_removes_its_mirror(self):
+        bids_mirror.sync_pending_changes()
+        root = bids_mirror.mirror_dir(self.experiment.pk)
+        self.assertTrue(root.exists())
+        experiment_id = self.experiment.pk
+        self.experiment.delete()
+        self.assertEqual(bids_mirror.sync_pending_changes(), {experiment_id: None})
+        self.assertFalse(root.exists())
+        self.assertFalse(BidsChange.objects.exists())
+
+
+class BidsValidationCacheTests(TestCase):
+    """
+    Per-file validation results are reused until the file's content or
+    the validator version changes. check_file is stubbed.
+    """
+
+    def setUp(self):
+        self.root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.root)
+        self.write('participants.tsv', 'participant_id\nsub-01\n')
+        self.write('dataset_description.json', '{"Name": "Dataset", "BIDSVersion": "1.8.0"}')
+        patcher = mock.patch.object(bids_validation, 'check_file', return_value=[])
+        self.check_file = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name, text):
+        (self.root / name).write_text(text)
+
+    def validate(self):
+        self.check_file.reset_mock()
+        report = bids_validation.validate_directory(self.root)
+        return report, sorted(call.args[0] for call in self.check_file.call_args_list)
+
+    def test_unchanged_files_are_not_checked_again(self):
+        report, checked = self.validate()
+        self.assertEqual(checked, ['dataset_description.json', 'participants.tsv'])
+        self.assertEqual(report['files_cached'], 0)
+
+        report, checked = self.validate()
+        self.assertEqual(checked, [])
+        self.assertEqual(report['files_cached'], 2)
+        self.assertTrue(report['valid'])
+
+    def test_changed_content_is_checked_again(self):
+        self.validate()
+        self.write('participants.tsv', 'participant_id\nsub-01\nsub-02\n')
+        report, checked = self.validate()
+        self.assertEqual(checked, ['participants.tsv'])
+        self.assertEqual(report['files_cached'], 1)
+
+    def test_new_validator_version_checks_everything(self):
+        self.validate()
+        with mock.patch.object(bids_validation, 'VALIDATOR_VERSION', bids_validation.VALIDATOR_VERSION + '-next'):
+            report, checked = self.validate()
+        self.assertEqual(checked, ['dataset_description.json', 'participants.tsv'])
+        self.assertEqual(report['files_cached'], 0)
+
+    def test_cached_issues_are_reported(self):
+        self.check_file.return_value = [{'severity': 'error', 'code': 'X', 'message': 'mal'}]
+        self.validate()
+        self.check_file.return_value = []
+        report, checked = self.validate()
+        self.assertEqual(checked, [])
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['errors'], 2)
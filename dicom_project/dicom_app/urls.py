@@ -8,7 +8,16 @@ from .views import (
     upload_dicom,
     export_dicom_to_bids,
     export_experiment_to_bids,
+    export_experiment_plan,
+    export_experiment_dicom,
+    start_export_job,
+    export_job_status,
+    export_job_download,
+    export_job_validation,
     dashboard,
+    experiment_stats_api,
+    dicom_file_list_api,
+    dicom_tags_api,
     participant_dashboard,
     experiment_success,
     ExperimentCreateView,
@@ -37,12 +46,20 @@ urlpatterns = [
     path('login/', auth_views.LoginView.as_view(), name='login'),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('dashboard/', dashboard, name='dashboard'),
+    path('api/experiments/stats/', experiment_stats_api, name='experiment_stats_api'),
+    path('api/dicoms/', dicom_file_list_api, name='dicom_file_list_api'),
     path('participant-dashboard/', participant_dashboard, name='participant_dashboard'),
     path('experiment/new/', ExperimentCreateView.as_view(), name='experiment_create'),
     path('experiment/success/', experiment_success, name='experiment_success'),
     path('experiment/<int:pk>/', ExperimentDetailView.as_view(), name='experiment_detail'),
     path('experiment/<int:pk>/delete/', ExperimentDeleteView.as_view(), name='experiment_delete'),
     path('experiment/<int:experiment_id>/export_bids/', export_experiment_to_bids, name='export_experiment_to_bids'),
+    path('experiment/<int:experiment_id>/export_bids/plan/', export_experiment_plan, name='export_experiment_plan'),
+    path('experiment/<int:experiment_id>/export_dicom/', export_experiment_dicom, name='export_experiment_dicom'),
+    path('experiment/<int:experiment_id>/export_jobs/', start_export_job, name='start_export_job'),
+    path('export_jobs/<int:job_id>/', export_job_status, name='export_job_status'),
+    path('export_jobs/<int:job_id>/download/', export_job_download, name='export_job_download'),
+    path('export_jobs/<int:job_id>/validation/', export_job_validation, name='export_job_validation'),
     path('experiment/<int:experiment_id>/participant/new/', ParticipantCreateView.as_view(), name='participant_create'),
     path('participant/<int:pk>/', ParticipantDetailView.as_view(), name='participant_detail'),
     path('participants/', participant_dashboard, name='participant_list'),
@@ -57,6 +74,7 @@ urlpatterns = [
 
     path('dicomfile_list/', DicomFileListView.as_view(), name='dicomfile_list'),
     path('<int:pk>/', DicomFileDetailView.as_view(), name='dicomfile_detail'),
+    path('<int:pk>/tags/', dicom_tags_api, name='dicom_tags_api'),
     path('<int:dicom_id>/image/', dicom_image_view, name='dicom_image_view'),
     path('dicomfile/new/', DicomFileCreateView.as_view(), name='dicomfile_create'),
     path('dicomfile/<int:pk>/edit/', DicomFileUpdateView.as_view(), name='dicomfile_edit'),
@@ -1,12 +1,15 @@
 import pydicom
 from django.shortcuts import render, get_object_or_404, redirect
-from django.db.models import Q
-from django.urls import reverse_lazy
+from django.db import transaction
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.urls import reverse, reverse_lazy
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
-from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_POST
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.files.storage import default_storage
 import os
 import traceback
 import shutil
@@ -15,16 +18,26 @@ from pathlib import Path
 from dicom2nifti import convert_directory
 import json
 import zipfile
-from .models import DicomFile, DicomTag, Experiment, Participant, ConsentFile, Member
+from .models import DicomFile, DicomTag, Experiment, ExperimentStats, Participant, ConsentFile, Member, ExportJob
 from .forms import DicomFileForm, DicomTagForm, DicomUploadForm, ExperimentForm
 import uuid
 import numpy as np
 import nibabel as nib
 import uuid
 from .bids_utils import (
-    normalize_subject_id, detect_modality, convert_dicom_to_nifti,
-    create_dataset_description, create_participants_tsv
+    normalize_subject_id, detect_modality, convert_dicom_to_nifti_cached,
+    create_dataset_description, create_participants_tsv, extract_series_metadata
 )
+from .bids_export import (
+    archive_basename, stream_experiment_bids, ensure_content_hash, get_cache_dir, get_uid_key, plan_experiment_export,
+    build_manifest, parse_export_filters
+)
+from . import app_cache, blob_gc, dicom_tags
+from .dicom_export import stream_experiment_dicom
+from .keyset import paginate
+from .zip_stream import ZipStream
+from .dicom_storage import resolve_name, save_dataset
+from .export_jobs import create_export_job, job_progress
 
 def generate_pacient_code():
     # Genera un UUID4 y toma los primeros 8 caracteres en mayúsculas
@@ -53,45 +66,53 @@ def process_dicom_file(dicom_file_upload, participant=None, experiment=None):
     # Generar código de paciente
     pacient_code = generate_pacient_code()
     
-    # Crear directorio y nombre de archivo para RAW
-    # El path debe ser relativo a MEDIA_ROOT (sin incluir 'media/')
-    save_dir = Path("media/dicoms/raw/")
-    save_dir.mkdir(parents=True, exist_ok=True)
-    filename = f"{pacient_code}_{uuid.uuid4().hex[:6]}.dcm"
-    full_path = save_dir / filename
-    
-    # Guardar el archivo ORIGINAL
-    ds.save_as(str(full_path))
-    
-    # Path relativo a MEDIA_ROOT para Django FileField
-    relative_path = f"dicoms/raw/{filename}"
-    
-    # Crear instancia DicomFile
-    dicom_instance = DicomFile.objects.create(
-        participant=participant,
-        experiment=experiment,
-        patient_name=pacient_code,
-        file=relative_path,  # Usar path relativo a MEDIA_ROOT
-        original_filename=dicom_file_upload.name,
-        file_size=dicom_file_upload.size
-    )
+    # Guardar el archivo ORIGINAL en el almacenamiento de medios, con un
+    # nombre derivado de su contenido: dicoms/raw/aa/bb/<sha256>.dcm. El hash
+    # es también la clave de la caché de conversiones NIfTI
+    relative_path, content_hash, _ = save_dataset(ds)
     
-    # Guardar los tags en la base de datos
-    dicom_data = []
-    for element in ds:
-        dicom_entry = DicomTag.objects.create(
-            dicom_file=dicom_instance,
-            tag=str(element.tag),
-            description=element.description(),
-            vr=element.VR,
-            value=str(element.value)
-        )
-        dicom_data.append({
-            'tag': dicom_entry.tag,
-            'description': dicom_entry.description,
-            'vr': dicom_entry.vr,
-            'value': dicom_entry.value,
-        })
+    # Crear el DicomFile y sus tags en una transacción: si algo falla no
+    # queda ninguna fila, y el archivo ya guardado se registra para que el
+    # recolector lo elimine (blob_gc) si ninguna otra subida lo comparte
+    try:
+        with transaction.atomic():
+            dicom_instance = DicomFile.objects.create(
+                participant=participant,
+                experiment=experiment,
+                patient_name=pacient_code,
+                file=relative_path,  # Nombre dentro del almacenamiento
+                original_filename=dicom_file_upload.name,
+                file_size=dicom_file_upload.size,
+                content_hash=content_hash,
+                **extract_series_metadata(ds)
+            )
+
+            # Guardar los tags en la base de datos, en una sola inserción
+            dicom_entries = DicomTag.objects.bulk_create([
+                DicomTag(
+                    dicom_file=dicom_instance,
+                    tag=str(element.tag),
+                    description=element.description(),
+                    vr=element.VR,
+                    value=str(element.value)
+                )
+                for element in ds
+            ])
+            dicom_data = [
+                {
+                    'tag': dicom_entry.tag,
+                    'description': dicom_entry.description,
+                    'vr': dicom_entry.vr,
+                    'value': dicom_entry.value,
+                }
+                for dicom_entry in dicom_entries
+            ]
+    except Exception:
+        blob_gc.record_deleted([relative_path])
+        raise
+    # bulk_create no emite señales: una sola invalidación por archivo, ya
+    # confirmados sus tags
+    app_cache.bump(app_cache.dicom_scope(dicom_instance.pk))
     
     return dicom_instance, dicom_data
 
@@ -118,11 +139,18 @@ def upload_dicom(request):
 
     return render(request, 'upload.html', {'form': form})
 
+def cached_dicom_file(pk):
+    """
+    DicomFile pk (o 404) desde la caché de la aplicación.
+    """
+    return app_cache.cached('dicom_file', [app_cache.dicom_scope(pk)], lambda: get_object_or_404(DicomFile, pk=pk), pk)
+
 class DicomFileListView(LoginRequiredMixin, ListView):
     model = DicomFile
     template_name = 'dicomfile_list.html'  # Nombre de tu plantilla
     context_object_name = 'dicom_files'
     paginate_by = 10  # Número de resultados por página
+    ordering = ('-upload_date', '-id')
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -131,48 +159,31 @@ class DicomFileListView(LoginRequiredMixin, ListView):
             queryset = queryset.filter(Q(patient_name__icontains=query))
         return queryset
 
+    def paginate_queryset(self, queryset, page_size):
+        # Paginación por cursor sobre (upload_date, id) en lugar de OFFSET
+        page = keyset_page(self.request, queryset, self.ordering, page_size)
+        return None, page, page.object_list, page.has_other_pages
+
 class DicomFileDetailView(LoginRequiredMixin, DetailView):
     model = DicomFile
     template_name = 'dicom_app/dicomfile_detail.html'  # Plantilla corregida
     context_object_name = 'dicom_file'  # Nombre del contexto en la plantilla
+
+    def get_object(self, queryset=None):
+        return cached_dicom_file(self.kwargs['pk'])
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         # Add participant_id to context for the back button
-        if self.object.participant:
-            context['participant_id'] = self.object.participant.id
-            
-        # Optimization: Fetch all tags efficiently
-        # We fetch all tags in one query to avoid N+1 issues and multiple hits
-        all_tags = list(self.object.tags.all())
-        
-        # Filter and clean tags for display
-        cleaned_tags = []
-        binary_vrs = ["OB", "OW", "OF", "OL", "UN"]
-        
-        for tag in all_tags:
-            display_value = tag.value
-            
-            # Check for binary VRs, PixelData, or excessive length
-            if (tag.vr in binary_vrs or 
-                "PixelData" in tag.tag or 
-                "7FE0,0010" in tag.tag or 
-                len(tag.value) > 400):
-                display_value = "[Valor binario omitido]"
+        if self.object.participant_id:
+            context['participant_id'] = self.object.participant_id
             
-            cleaned_tags.append({
-                'tag': tag.tag,
-                'description': tag.description,
-                'vr': tag.vr,
-                'value': display_value
-            })
-        
-        # Split into initial (server-side rendered) and remaining (client-side rendered)
-        initial_count = 50
-        context['initial_tags'] = cleaned_tags[:initial_count]
-        
-        # Serialize remaining tags for JavaScript
-        context['remaining_tags_json'] = json.dumps(cleaned_tags[initial_count:])
+        # Solo la primera página de tags va en el HTML; el resto se pide a
+        # dicom_tags_api a medida que se desplaza la tabla o se filtra
+        tags = dicom_tags.cleaned_tags(self.object.pk)
+        context['initial_tags'] = tags[:TAGS_PER_PAGE]
+        context['tag_count'] = len(tags)
+        context['tags_per_page'] = TAGS_PER_PAGE
         return context
 
 class DicomFileCreateView(LoginRequiredMixin, CreateView):
@@ -215,9 +226,9 @@ def convert_single_dicom_to_nifti(dicom_path, output_path):
 @login_required
 def export_dicom_to_bids(request, pk):
     dicom_instance = get_object_or_404(DicomFile, pk=pk)
-    dicom_path = dicom_instance.file.path
+    dicom_name = resolve_name(dicom_instance.file.name)
 
-    if not os.path.exists(dicom_path):
+    if not dicom_name:
         raise Http404("Archivo DICOM no encontrado")
 
     temp_dir = tempfile.mkdtemp()
@@ -226,8 +237,9 @@ def export_dicom_to_bids(request, pk):
         subject_id = normalize_subject_id(1) # Single file export gets sub-01
         session_id = "ses-01"
         
-        # Detect modality
-        ds = pydicom.dcmread(dicom_path)
+        # Detect modality (el dataset leído se reutiliza en la conversión)
+        with default_storage.open(dicom_name, 'rb') as f:
+            ds = pydicom.dcmread(f)
         modality_folder, suffix = detect_modality(ds)
         
         output_dir = Path(temp_dir) / subject_id / session_id / modality_folder
@@ -235,10 +247,17 @@ def export_dicom_to_bids(request, pk):
         
         output_basename = f"{subject_id}_{suffix}"
         
-        # Convert
-        nifti_path, json_path = convert_dicom_to_nifti(dicom_path, output_dir, output_basename)
+        # Convert (reusa la caché si este contenido ya fue convertido)
+        nifti_path, json_path = convert_dicom_to_nifti_cached(
+            dicom_name, output_dir, output_basename,
+            content_hash=ensure_content_hash(dicom_instance),
+            cache_dir=get_cache_dir(),
+            ds=ds,
+            uid_key=get_uid_key()
+        )
         
         if not nifti_path:
+             shutil.rmtree(temp_dir, ignore_errors=True)
              return HttpResponse("❌ La conversión falló: no se generó ningún archivo .nii.gz", status=500)
 
         # Create dataset_description.json
@@ -252,22 +271,33 @@ def export_dicom_to_bids(request, pk):
             'group': 'control'
         }])
 
-        # Zip
-        zip_path = tempfile.NamedTemporaryFile(delete=False, suffix=".zip").name
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    full_path = os.path.join(root, file)
-                    arcname = os.path.relpath(full_path, temp_dir)
-                    zipf.write(full_path, arcname=arcname)
-
-        return FileResponse(open(zip_path, 'rb'), as_attachment=True, filename=f"{subject_id}_bids.zip")
+        # Zip en streaming; el directorio temporal se elimina al terminar el envío
+        response = StreamingHttpResponse(
+            stream_directory_zip(temp_dir),
+            content_type="application/zip"
+        )
+        response['Content-Disposition'] = f'attachment; filename="{subject_id}_bids.zip"'
+        return response
         
     except Exception as e:
         traceback.print_exc()
+        shutil.rmtree(temp_dir, ignore_errors=True)
         return HttpResponse(f"Error exportando a BIDS: {e}", status=500)
+
+def stream_directory_zip(directory):
+    """
+    Genera el ZIP de un directorio en streaming y lo elimina al finalizar.
+    """
+    archive = ZipStream()
+    try:
+        for root, _, files in os.walk(directory):
+            for file in files:
+                full_path = os.path.join(root, file)
+                arcname = os.path.relpath(full_path, directory).replace(os.sep, '/')
+                yield from archive.write_file(full_path, arcname)
+        yield from archive.close()
     finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        shutil.rmtree(directory, ignore_errors=True)
 
 @login_required
 def export_experiment_to_bids(request, experiment_id):
@@ -277,137 +307,116 @@ def export_experiment_to_bids(request, experiment_id):
     """
     experiment = get_object_or_404(Experiment, pk=experiment_id)
     
-    # Crear directorio temporal para la estructura BIDS
-    temp_dir = tempfile.mkdtemp()
-    bids_root = Path(temp_dir) / "my_dataset"
-    bids_root.mkdir(parents=True, exist_ok=True)
+    if not experiment.participants.exists():
+        return HttpResponse("No hay participantes asociados a este experimento.", status=404)
     
+    # Filtros opcionales para exportar solo una parte (participantes, tipo de dato, serie, fechas)
     try:
-        # Obtener todos los participantes del experimento
-        participants = experiment.participants.all()
-        
-        if not participants.exists():
-            return HttpResponse("No hay participantes asociados a este experimento.", status=404)
-        
-        participants_data = []
-        
-        # Procesar cada participante
-        for idx, participant in enumerate(participants, start=1):
-            # Normalizar ID: sub-01, sub-02...
-            subject_id = normalize_subject_id(idx)
-            
-            participants_data.append({
-                'participant_id': subject_id,
-                'age': 'n/a', # Podríamos sacar esto de metadatos si existieran
-                'sex': 'n/a',
-                'group': 'control' # Default
-            })
-            
-            subject_dir = bids_root / subject_id
-            
-            # Obtener todos los archivos DICOM del participante en este experimento
-            dicom_files = DicomFile.objects.filter(
-                participant=participant,
-                experiment=experiment
-            )
-            
-            # Procesar cada archivo DICOM
-            for dicom_file in dicom_files:
-                try:
-                    dicom_path = dicom_file.file.path
-                    
-                    if not os.path.exists(dicom_path):
-                        print(f"⚠️ Archivo DICOM no encontrado: {dicom_path}")
-                        continue
-                    
-                    # Detectar modalidad
-                    ds = pydicom.dcmread(dicom_path)
-                    modality_folder, suffix = detect_modality(ds)
-                    
-                    # Estructura: sub-XX/modality/
-                    # Nota: BIDS a veces usa ses-XX. El usuario pidió sub-01/anat/...
-                    # Si quisiéramos sesiones: sub-01/ses-01/anat/...
-                    # El prompt dice: sub-01/anat/ (sin sesión explícita en el ejemplo principal, 
-                    # pero luego dice "sub-01/anat/"). Seguiré el ejemplo del prompt.
-                    
-                    output_dir = subject_dir / modality_folder
-                    output_dir.mkdir(parents=True, exist_ok=True)
-                    
-                    # Logic to detect existing files and increment index
-                    if modality_folder == 'func':
-                        # Pattern: sub-01_task-rest_run-XX_bold
-                        # We glob for *task-rest*bold.nii.gz to count existing runs
-                        # Or if suffix is just 'task-rest_bold', we can split it or look for the unique part
-                        
-                        # In detect_modality for func we return suffix="task-rest_bold"
-                        # We want: sub-XX_task-rest_run-XX_bold
-                        
-                        # Count existing .nii.gz files in this folder that match pattern
-                        existing_files = list(output_dir.glob("*_bold.nii.gz"))
-                        run_index = len(existing_files) + 1
-                        run_entity = f"run-{run_index:02d}"
-                        
-                        # Construct basename
-                        # suffix is 'task-rest_bold', we want to insert run-XX
-                        if "task-rest" in suffix:
-                            # format: sub-XX_task-rest_run-XX_bold
-                            output_basename = f"{subject_id}_task-rest_{run_entity}_bold"
-                        else:
-                            # fallback if suffix changes
-                            output_basename = f"{subject_id}_{run_entity}_{suffix}"
-                            
-                    else:
-                        # For anat and dwi use 'acq'
-                        # sub-XX_acq-XX_T1w or sub-XX_acq-XX_dwi
-                        
-                        # Count files with same suffix
-                        existing_files = list(output_dir.glob(f"*{suffix}.nii.gz"))
-                        acq_index = len(existing_files) + 1
-                        acq_entity = f"acq-{acq_index:02d}"
-                        
-                        output_basename = f"{subject_id}_{acq_entity}_{suffix}"
-                    
-                    # Convertir
-                    print(f"📦 Processing DICOM {dicom_file.id} for {subject_id}/{modality_folder}")
-                    nifti_path, json_path = convert_dicom_to_nifti(dicom_path, output_dir, output_basename)
-                    
-                    if not nifti_path:
-                        print(f"⚠️ Conversion failed for DICOM {dicom_file.id}, skipping...")
-                        continue
-                    
-                except Exception as e:
-                    print(f"⚠️ Error procesando archivo DICOM {dicom_file.id}: {str(e)}")
-                    traceback.print_exc()
-                    continue
-        
-        # Crear participants.tsv
-        create_participants_tsv(bids_root, participants_data)
-        
-        # Crear dataset_description.json
-        create_dataset_description(bids_root)
-        
-        # Comprimir todo en un ZIP
-        zip_path = tempfile.NamedTemporaryFile(delete=False, suffix=".zip").name
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(bids_root):
-                for file in files:
-                    full_path = os.path.join(root, file)
-                    arcname = os.path.relpath(full_path, temp_dir) # relative to temp_dir so my_dataset is root
-                    zipf.write(full_path, arcname=arcname)
-        
-        # Retornar el archivo ZIP
-        experiment_name_safe = experiment.name.replace(" ", "_").lower()
-        return FileResponse(
-            open(zip_path, 'rb'), 
-            as_attachment=True, 
-            filename=f"{experiment_name_safe}_bids.zip"
-        )
-        
-    except Exception as e:
-        traceback.print_exc()
-        return HttpResponse(f"Error exportando experimento: {e}", status=500)
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        filters = parse_export_filters(request.GET)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    
+    # El ZIP se genera mientras se descarga: cada archivo se envía en cuanto
+    # termina su conversión, sin construir el archivo completo en disco
+    experiment_name_safe = archive_basename(experiment)
+    response = StreamingHttpResponse(stream_experiment_bids(experiment, filters=filters), content_type="application/zip")
+    response['Content-Disposition'] = f'attachment; filename="{experiment_name_safe}_bids.zip"'
+    return response
+
+@login_required
+def export_experiment_dicom(request, experiment_id):
+    """
+    Exporta los DICOM originales del experimento, anonimizados, en un ZIP
+    organizado por sujeto/estudio/serie. Acepta los mismos filtros que la
+    exportación BIDS.
+    """
+    experiment = get_object_or_404(Experiment, pk=experiment_id)
+    
+    try:
+        filters = parse_export_filters(request.GET)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    
+    experiment_name_safe = archive_basename(experiment)
+    response = StreamingHttpResponse(stream_experiment_dicom(experiment, filters=filters), content_type="application/zip")
+    response['Content-Disposition'] = f'attachment; filename="{experiment_name_safe}_dicom_anon.zip"'
+    return response
+
+@login_required
+def export_experiment_plan(request, experiment_id):
+    """
+    Vista previa (dry-run) de la exportación BIDS: devuelve en JSON los
+    sujetos y archivos que se generarían, calculados solo desde la base de datos.
+    """
+    experiment = get_object_or_404(Experiment, pk=experiment_id)
+    
+    try:
+        filters = parse_export_filters(request.GET)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    participants_data, tasks = plan_experiment_export(experiment, filters=filters)
+    return JsonResponse(build_manifest(experiment, participants_data, tasks, filters))
+
+@login_required
+@require_POST
+def start_export_job(request, experiment_id):
+    """
+    Encola la exportación BIDS de un experimento para el worker en segundo plano.
+    Devuelve las URLs para consultar el progreso y descargar el resultado.
+    """
+    experiment = get_object_or_404(Experiment, pk=experiment_id)
+    
+    if not experiment.participants.exists():
+        return JsonResponse({'status': 'error', 'message': 'No hay participantes asociados a este experimento.'}, status=404)
+    
+    try:
+        filters = parse_export_filters(request.POST)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    job = create_export_job(experiment, request.user, filters)
+    return JsonResponse({
+        'status': 'success',
+        'id': job.pk,
+        'status_url': reverse('export_job_status', kwargs={'job_id': job.pk}),
+        'download_url': reverse('export_job_download', kwargs={'job_id': job.pk}),
+        'validation_url': reverse('export_job_validation', kwargs={'job_id': job.pk}),
+    }, status=202)
+
+@login_required
+def export_job_status(request, job_id):
+    """Progreso de un trabajo de exportación (consultado periódicamente por la UI)"""
+    job = get_object_or_404(ExportJob, pk=job_id)
+    return JsonResponse(job_progress(job))
+
+@login_required
+def export_job_download(request, job_id):
+    """Descarga el ZIP de un trabajo de exportación terminado y no expirado"""
+    job = get_object_or_404(ExportJob, pk=job_id)
+    
+    if job.status == ExportJob.STATUS_EXPIRED:
+        return HttpResponse("La exportación expiró. Vuelva a solicitarla.", status=410)
+    if job.status != ExportJob.STATUS_DONE or not job.archive:
+        return HttpResponse("La exportación todavía no está lista.", status=409)
+    
+    try:
+        archive = job.archive.open('rb')
+    except FileNotFoundError:
+        raise Http404("Archivo de exportación no encontrado")
+    return FileResponse(archive, as_attachment=True, filename=os.path.basename(job.archive.name).split('_', 1)[-1])
+
+@login_required
+def export_job_validation(request, job_id):
+    """Descarga el reporte de validación BIDS de un trabajo de exportación"""
+    job = get_object_or_404(ExportJob, pk=job_id)
+    
+    if job.validation_report is None:
+        raise Http404("Este trabajo no tiene reporte de validación")
+    
+    response = JsonResponse(job.validation_report, json_dumps_params={'indent': 2})
+    response['Content-Disposition'] = f'attachment; filename="export_{job.pk}_validation.json"'
+    return response
 
 def zip_bids_folder(bids_dir):
     zip_path = bids_dir + '.zip'
@@ -433,15 +442,155 @@ def dashboard(request):
     if request.user.groups.filter(name='Participante').exists():
         return redirect('participant_dashboard')
         
-    experiments = Experiment.objects.filter(status='Active')
-    
     # Search functionality
     query = request.GET.get('q')
-    if query:
-        experiments = experiments.filter(name__icontains=query)
-        
+
+    def build():
+        # Las estadísticas (ExperimentStats) llegan en la misma consulta
+        experiments = Experiment.objects.filter(status='Active').select_related('stats')
+        if query:
+            experiments = experiments.filter(name__icontains=query)
+        return list(experiments)
+
+    experiments = app_cache.cached('dashboard', [app_cache.EXPERIMENTS], build, query or '')
     return render(request, 'dicom_app/dashboard.html', {'experiments': experiments})
 
+def _stats_json(stats):
+    return {
+        'participants': stats.participant_count,
+        'dicom_files': stats.dicom_count,
+        'total_bytes': stats.total_bytes,
+        'last_activity': stats.last_activity.isoformat() if stats.last_activity else None,
+    }
+
+def _dicom_file_json(dicom_file):
+    return {
+        'id': dicom_file.id,
+        'patient_name': dicom_file.patient_name,
+        'original_filename': dicom_file.original_filename,
+        'file_size': dicom_file.file_size,
+        'upload_date': dicom_file.upload_date.isoformat(),
+        'participant_id': dicom_file.participant_id,
+        'experiment_id': dicom_file.experiment_id,
+        'modality': dicom_file.modality,
+        'series_description': dicom_file.series_description,
+        'detail_url': reverse('dicomfile_detail', args=[dicom_file.pk]),
+    }
+
+@login_required
+def dicom_file_list_api(request):
+    """
+    Lista de archivos DICOM en JSON, del más reciente al más antiguo,
+    paginada por cursor (?cursor=...). Filtros: participant, experiment,
+    q (nombre del paciente) y limit (máx. 100).
+    """
+    dicom_files = DicomFile.objects.all()
+    try:
+        if request.GET.get('participant'):
+            dicom_files = dicom_files.filter(participant_id=int(request.GET['participant']))
+        if request.GET.get('experiment'):
+            dicom_files = dicom_files.filter(experiment_id=int(request.GET['experiment']))
+        limit = min(max(int(request.GET.get('limit', DICOM_FILES_PER_PAGE)), 1), 100)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Parámetros inválidos.'}, status=400)
+    if request.GET.get('q'):
+        dicom_files = dicom_files.filter(patient_name__icontains=request.GET['q'])
+
+    try:
+        page = paginate(dicom_files, ('-upload_date', '-id'), request.GET.get('cursor'), limit)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+
+    def page_url(cursor):
+        if cursor is None:
+            return None
+        params = request.GET.copy()
+        params['cursor'] = cursor
+        return f"{request.path}?{params.urlencode()}"
+
+    return JsonResponse({
+        'results': [_dicom_file_json(f) for f in page.object_list],
+        'next': page_url(page.next_cursor),
+        'previous': page_url(page.previous_cursor),
+    })
+
+@login_required
+def dicom_tags_api(request, pk):
+    """
+    Tags de un archivo DICOM en JSON, por páginas (?offset=&limit=, máx. 500).
+    Filtros: group (hex, p. ej. 0010), keyword, vr y q (texto libre).
+    """
+    dicom_file = cached_dicom_file(pk)
+    try:
+        offset = max(int(request.GET.get('offset', 0)), 0)
+        limit = min(max(int(request.GET.get('limit', TAGS_PER_PAGE)), 1), 500)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': 'Parámetros inválidos.'}, status=400)
+
+    tags = dicom_tags.filter_tags(
+        dicom_tags.cleaned_tags(dicom_file.pk),
+        group=request.GET.get('group'),
+        keyword=request.GET.get('keyword'),
+        vr=request.GET.get('vr'),
+        text=request.GET.get('q'),
+    )
+    next_offset = offset + limit
+    return JsonResponse({
+        'count': len(tags),
+        'results': tags[offset:next_offset],
+        'next_offset': next_offset if next_offset < len(tags) else None,
+    })
+
+@login_required
+def experiment_stats_api(request):
+    """
+    Estadísticas de los experimentos activos en JSON, en una sola consulta.
+    """
+    stats = ExperimentStats.objects.filter(experiment__status='Active').select_related('experiment').order_by('experiment_id')
+    return JsonResponse({'experiments': [
+        dict(_stats_json(s), id=s.experiment_id, name=s.experiment.name)
+        for s in stats
+    ]})
+
+PARTICIPANTS_PER_PAGE = 25
+DICOM_FILES_PER_PAGE = 25
+TAGS_PER_PAGE = 50
+
+def keyset_page(request, queryset, ordering, per_page):
+    """
+    Página por cursor (?cursor=...) de queryset; ver keyset.py.
+    """
+    try:
+        return paginate(queryset, ordering, request.GET.get('cursor'), per_page)
+    except ValueError as e:
+        raise Http404(str(e))
+
+def _count_subquery(queryset, group_by):
+    """
+    COUNT(*) of a queryset correlated on group_by, as a subquery (0 when
+    empty). Correlated subqueries avoid the row multiplication of joining
+    several reverse relations in one query.
+    """
+    counts = queryset.order_by().values(group_by).annotate(n=Count('*')).values('n')
+    return Coalesce(Subquery(counts[:1]), 0)
+
+def annotate_participant_activity(participants, experiment=None):
+    """
+    Annotates last_participation (latest DICOM upload), dicom_count and
+    consent_count on a Participant queryset, computed in the same query.
+    With experiment, only that experiment's files and consents count.
+    """
+    dicom_files = DicomFile.objects.filter(participant=OuterRef('pk'))
+    consent_files = ConsentFile.objects.filter(participant=OuterRef('pk'))
+    if experiment is not None:
+        dicom_files = dicom_files.filter(experiment=experiment)
+        consent_files = consent_files.filter(experiment=experiment)
+    return participants.annotate(
+        last_participation=Subquery(dicom_files.order_by('-upload_date').values('upload_date')[:1]),
+        dicom_count=_count_subquery(dicom_files, 'participant'),
+        consent_count=_count_subquery(consent_files, 'participant'),
+    )
+
 @login_required
 def participant_dashboard(request):
     # Only allow participants or admins
@@ -457,15 +606,16 @@ def participant_dashboard(request):
             Q(last_name__icontains=query)
         )
     
-    # Calcular la última participación para cada participante desde DICOM uploads
-    participants_with_last_date = []
-    for participant in participants:
-        latest_dicom = DicomFile.objects.filter(participant=participant).order_by('-upload_date').first()
-        participant.last_participation = latest_dicom.upload_date if latest_dicom else None
-        participants_with_last_date.append(participant)
+    # Última participación y conteos en la misma consulta, paginado por cursor
+    page_obj = app_cache.cached(
+        'participant_dashboard', [app_cache.PARTICIPANTS],
+        lambda: keyset_page(request, annotate_participant_activity(participants), ('id',), PARTICIPANTS_PER_PAGE),
+        query or '', request.GET.get('cursor', '')
+    )
         
     return render(request, 'dicom_app/participant_dashboard.html', {
-        'participants': participants_with_last_date
+        'participants': page_obj.object_list,
+        'page_obj': page_obj,
     })
 
 class ExperimentCreateView(LoginRequiredMixin, CreateView):
@@ -495,6 +645,29 @@ class ExperimentDetailView(LoginRequiredMixin, DetailView):
     template_name = 'dicom_app/experiment_detail.html'
     context_object_name = 'experiment'
 
+    def get_object(self, queryset=None):
+        pk = self.kwargs['pk']
+        return app_cache.cached('experiment', [app_cache.experiment_scope(pk)], lambda: super(ExperimentDetailView, self).get_object(queryset), pk)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        experiment = self.object
+
+        def build():
+            # Matriz de estado (consentimiento, DICOM, última subida) de los
+            # participantes de la página: una sola consulta sea cual sea la cohorte
+            participants = annotate_participant_activity(experiment.participants.all(), experiment)
+            return (
+                keyset_page(self.request, participants, ('id',), PARTICIPANTS_PER_PAGE),
+                list(experiment.members.all()),
+            )
+
+        context['participants_page'], context['members'] = app_cache.cached(
+            'experiment_detail', [app_cache.experiment_scope(experiment.pk)], build,
+            experiment.pk, self.request.GET.get('cursor', '')
+        )
+        return context
+
 class ExperimentDeleteView(LoginRequiredMixin, DeleteView):
     model = Experiment
     template_name = 'dicom_app/experiment_confirm_delete.html'
@@ -567,10 +740,10 @@ def view_consent_note(request, participant_id, experiment_id):
             content_type="text/plain; charset=utf-8"
         )
     
-    # Verificar que el archivo existe en el sistema de archivos
+    # Verificar que el archivo existe en el almacenamiento
     try:
-        file_path = consent_file.file.path
-        if not os.path.exists(file_path):
+        file_path = consent_file.file.name
+        if not consent_file.file.storage.exists(file_path):
             return HttpResponse(
                 "El archivo de consentimiento no se encuentra en el servidor.",
                 content_type="text/plain; charset=utf-8"
@@ -592,9 +765,9 @@ def view_consent_note(request, participant_id, experiment_id):
     }
     content_type = content_type_map.get(file_extension, 'application/pdf')
     
-    # Servir el archivo directamente usando FileResponse con context manager
+    # Servir el archivo en streaming desde el almacenamiento
     try:
-        file_handle = open(file_path, 'rb')
+        file_handle = consent_file.file.storage.open(file_path, 'rb')
         response = FileResponse(
             file_handle,
             content_type=content_type
@@ -654,10 +827,14 @@ def upload_success(request, upload_type):
 @login_required
 def participant_experiments(request, participant_id):
     """Vista para mostrar todos los experimentos de un participante"""
-    participant = get_object_or_404(Participant, pk=participant_id)
-    
-    # Obtener todos los experimentos del participante usando la relación ManyToMany
-    experiments = participant.experiments.all().order_by('-created_at')
+    def build():
+        participant = get_object_or_404(Participant, pk=participant_id)
+        # Obtener todos los experimentos del participante usando la relación ManyToMany
+        return participant, list(participant.experiments.all().order_by('-created_at'))
+
+    participant, experiments = app_cache.cached(
+        'participant_experiments', [app_cache.participant_scope(participant_id)], build, participant_id
+    )
     
     return render(request, 'dicom_app/participant_experiments.html', {
         'participant': participant,
@@ -669,19 +846,27 @@ def participant_experiment_dicoms(request, participant_id, experiment_id):
     """
     Muestra todos los archivos DICOM de un participante para un experimento específico
     """
-    participant = get_object_or_404(Participant, pk=participant_id)
-    experiment = get_object_or_404(Experiment, pk=experiment_id)
-    
-    # Obtener todos los DICOM files del participante para este experimento
-    dicom_files = DicomFile.objects.filter(
-        participant=participant,
-        experiment=experiment
-    ).order_by('-upload_date')
+    def build():
+        participant = get_object_or_404(Participant, pk=participant_id)
+        experiment = get_object_or_404(Experiment, pk=experiment_id)
+        # DICOM files del participante para este experimento, paginados por cursor
+        dicom_files = DicomFile.objects.filter(
+            participant=participant,
+            experiment=experiment
+        )
+        return participant, experiment, keyset_page(request, dicom_files, ('-upload_date', '-id'), DICOM_FILES_PER_PAGE)
+
+    participant, experiment, page_obj = app_cache.cached(
+        'participant_experiment_dicoms',
+        [app_cache.participant_scope(participant_id), app_cache.experiment_scope(experiment_id)],
+        build, participant_id, experiment_id, request.GET.get('cursor', '')
+    )
     
     return render(request, 'dicom_app/participant_experiment_dicoms.html', {
         'participant': participant,
         'experiment': experiment,
-        'dicom_files': dicom_files
+        'dicom_files': page_obj.object_list,
+        'page_obj': page_obj,
     })
 
 @login_required
@@ -692,47 +877,19 @@ def dicom_image_view(request, dicom_id):
     """
     import io
     from PIL import Image
-    from django.conf import settings
     
     dicom_file = get_object_or_404(DicomFile, pk=dicom_id)
     
-    # 1. Resolución robusta de la ruta del archivo
-    possible_paths = []
-    
-    # Ruta estándar de Django
-    try:
-        possible_paths.append(dicom_file.file.path)
-    except:
-        pass
-        
-    # Ruta corrigiendo posible duplicación de 'media/'
-    if dicom_file.file.name.startswith('media/'):
-        clean_name = dicom_file.file.name.replace('media/', '', 1)
-        possible_paths.append(os.path.join(settings.MEDIA_ROOT, clean_name))
-        
-    # Ruta asumiendo que el nombre ya es relativo a MEDIA_ROOT
-    possible_paths.append(os.path.join(settings.MEDIA_ROOT, dicom_file.file.name))
-    
-    # Ruta absoluta hardcodeada para debug
-    try:
-        fname = os.path.basename(dicom_file.file.name)
-        manual_path = os.path.join(settings.MEDIA_ROOT, 'dicoms', 'raw', fname)
-        possible_paths.append(manual_path)
-    except:
-        pass
-    
-    dicom_path = None
-    for path in possible_paths:
-        if os.path.exists(path):
-            dicom_path = path
-            break
-            
-    if not dicom_path:
+    # 1. Nombre del archivo en el almacenamiento (también filas antiguas
+    # con prefijo 'media/' o en el directorio plano dicoms/raw/)
+    dicom_name = resolve_name(dicom_file.file.name)
+    if not dicom_name:
         return HttpResponse("Archivo DICOM no encontrado en el servidor.", status=404)
     
     try:
-        # 2. Leer archivo DICOM
-        ds = pydicom.dcmread(dicom_path)
+        # 2. Leer archivo DICOM en streaming desde el almacenamiento
+        with default_storage.open(dicom_name, 'rb') as f:
+            ds = pydicom.dcmread(f)
         
         # 3. Verificar PixelData
         if "PixelData" not in ds:
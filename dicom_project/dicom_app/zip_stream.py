@@ -0,0 +1,102 @@
+"""
+Streaming ZIP writer.
+
+zipfile.ZipFile can write to a non-seekable stream (it falls back to data
+descriptors), so instead of building the archive in a temporary file we
+point it at a small buffer and hand out whatever it wrote after every
+chunk. The result is a generator of bytes suitable for StreamingHttpResponse.
+"""
+import time
+import zipfile
+
+CHUNK_SIZE = 1024 * 1024
+
+# Entries that are already compressed gain nothing from DEFLATE
+STORED_EXTENSIONS = ('.gz', '.zip', '.png', '.jpg', '.jpeg')
+
+
+class _StreamBuffer:
+    """
+    Write-only, non-seekable sink for ZipFile. Keeps the bytes written since
+    the last drain() and the total offset ZipFile needs for its headers.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ZipStream:
+    """
+    Builds a ZIP archive incrementally. Every write_* method is a generator
+    that yields the archive bytes produced so far, so entries can be emitted
+    as soon as they exist instead of once the whole archive is done.
+    """
+
+    def __init__(self):
+        self._buffer = _StreamBuffer()
+        self._zip = zipfile.ZipFile(self._buffer, 'w', zipfile.ZIP_DEFLATED)
+
+    @staticmethod
+    def compress_type_for(arcname):
+        if arcname.lower().endswith(STORED_EXTENSIONS):
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def _drain(self):
+        data = self._buffer.drain()
+        if data:
+            yield data
+
+    def write_file(self, path, arcname):
+        """Adds the file at path as arcname, reading it in chunks."""
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = self.compress_type_for(arcname)
+        with open(path, 'rb') as src, self._zip.open(zinfo, 'w') as dest:
+            while True:
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dest.write(chunk)
+                yield from self._drain()
+        yield from self._drain()
+
+    def write_chunks(self, arcname, chunks, size=None):
+        """
+        Adds an entry whose content is produced by an iterable of bytes.
+        size, when known, lets ZipFile switch to ZIP64 for entries over 2 GiB.
+        """
+        zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+        zinfo.file_size = size or 0
+        zinfo.compress_type = self.compress_type_for(arcname)
+        with self._zip.open(zinfo, 'w') as dest:
+            for chunk in chunks:
+                dest.write(chunk)
+                yield from self._drain()
+        yield from self._drain()
+
+    def write_bytes(self, arcname, data):
+        """Adds an in-memory entry (small generated files such as sidecars)."""
+        self._zip.writestr(arcname, data, compress_type=self.compress_type_for(arcname))
+        yield from self._drain()
+
+    def close(self):
+        """Writes the central directory."""
+        self._zip.close()
+        yield from self._drain()
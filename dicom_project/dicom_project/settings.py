@@ -10,8 +10,13 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import json
+import os
+from importlib.util import find_spec
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -42,6 +47,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'dicom_app.db_router.ReplicaStickinessMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -74,16 +80,70 @@ WSGI_APPLICATION = 'dicom_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Connections are reused between requests (DB_CONN_MAX_AGE seconds, checked
+# with DB_CONN_HEALTH_CHECKS before each reuse) instead of opening one per
+# request. DB_POOL_MAX_SIZE > 0 switches to a process-wide connection pool
+# instead; it needs psycopg 3 with psycopg_pool (pip install "psycopg[pool]"),
+# not psycopg2, and ignores DB_CONN_MAX_AGE. Without them startup fails here
+# rather than on the first connection.
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '0'))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'HOST': 'localhost',
-        'PORT': '5432',
-        'NAME': 'postgres',
-        'USER': 'postgres',
-        'PASSWORD': 'garcia2012',
+        'HOST': os.environ.get('DB_HOST', 'localhost'),
+        'PORT': os.environ.get('DB_PORT', '5432'),
+        'NAME': os.environ.get('DB_NAME', 'postgres'),
+        'USER': os.environ.get('DB_USER', 'postgres'),
+        'PASSWORD': os.environ.get('DB_PASSWORD', 'garcia2012'),
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+        'CONN_HEALTH_CHECKS': os.environ.get('DB_CONN_HEALTH_CHECKS', '1') == '1',
+        'OPTIONS': {
+            'connect_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', '10')),
+        },
     }
 }
+if DB_POOL_MAX_SIZE > 0:
+    if not (find_spec('psycopg') and find_spec('psycopg_pool')):
+        raise ImproperlyConfigured(
+            'DB_POOL_MAX_SIZE requires psycopg 3 with psycopg_pool (pip install "psycopg[pool]"); '
+            'psycopg2 has no connection pool. Unset DB_POOL_MAX_SIZE or install it.'
+        )
+    # Pooled connections go back to the pool at the end of each request
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': min(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE),
+        'max_size': DB_POOL_MAX_SIZE,
+        'timeout': int(os.environ.get('DB_POOL_TIMEOUT', '10')),
+    }
+
+# Read replicas (DB_REPLICA_HOSTS=host[:port],...): dicom_app.db_router sends
+# reads to them and writes to 'default'. A client stays on 'default' for
+# DB_REPLICA_STICKY_SECONDS after writing, so it reads its own changes. In
+# tests the replicas mirror 'default'.
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), 1):
+    _host, _, _port = _host.strip().partition(':')
+    DATABASES[f'replica{_index}'] = dict(
+        DATABASES['default'],
+        HOST=_host,
+        PORT=_port or DATABASES['default']['PORT'],
+        OPTIONS=dict(DATABASES['default']['OPTIONS']),
+        TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(f'replica{_index}')
+# DB_REPLICA_MIRRORS=n adds n replicas that are plain extra connections to
+# the primary: the routing can be exercised (and tested) without replication
+for _index in range(1, int(os.environ.get('DB_REPLICA_MIRRORS', '0')) + 1):
+    DATABASES[f'mirror{_index}'] = dict(
+        DATABASES['default'],
+        OPTIONS=dict(DATABASES['default']['OPTIONS']),
+        TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(f'mirror{_index}')
+DATABASE_ROUTERS = ['dicom_app.db_router.ReplicaRouter']
+REPLICA_STICKY_SECONDS = int(os.environ.get('DB_REPLICA_STICKY_SECONDS', '15'))
 
 
 # Password validation
@@ -127,6 +187,71 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Storage of uploads and export archives. Every read and write goes through
+# the storage API, so an object store can replace MEDIA_ROOT, e.g. with
+# django-storages against S3 or MinIO:
+#   MEDIA_STORAGE_BACKEND=storages.backends.s3.S3Storage
+#   MEDIA_STORAGE_OPTIONS='{"bucket_name": "dicomhub", "endpoint_url": "http://minio:9000"}'
+STORAGES = {
+    'default': {
+        'BACKEND': os.environ.get('MEDIA_STORAGE_BACKEND', 'django.core.files.storage.FileSystemStorage'),
+        'OPTIONS': json.loads(os.environ.get('MEDIA_STORAGE_OPTIONS', '{}')),
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+# Lossless compression of newly stored DICOM files: '' (off) or 'rle'
+# (RLE Lossless). manage.py compress_dicom_storage converts existing files
+DICOM_STORAGE_COMPRESSION = os.environ.get('DICOM_STORAGE_COMPRESSION', '')
+# Stored files of deleted rows are reclaimed by the export worker (blob_gc)
+# once their tombstone is this old, at most BLOB_GC_RATE deletions/s (0 = no limit)
+BLOB_GC_GRACE_SECONDS = int(os.environ.get('BLOB_GC_GRACE_SECONDS', '600'))
+BLOB_GC_RATE = float(os.environ.get('BLOB_GC_RATE', '50'))
+
+# BIDS export
+# Number of processes used to convert DICOM to NIfTI (0 = one per CPU)
+BIDS_EXPORT_WORKERS = int(os.environ.get('BIDS_EXPORT_WORKERS', '0'))
+# Content-keyed cache of NIfTI conversions (empty BIDS_CACHE_DIR disables it)
+BIDS_CACHE_DIR = os.environ.get('BIDS_CACHE_DIR', str(BASE_DIR / 'cache' / 'nifti'))
+BIDS_CACHE_MAX_BYTES = int(os.environ.get('BIDS_CACHE_MAX_BYTES', str(10 * 1024 ** 3)))
+# Background export jobs (manage.py run_export_worker): archive retention in seconds
+EXPORT_JOB_TTL = int(os.environ.get('EXPORT_JOB_TTL', str(24 * 3600)))
+EXPORT_JOB_POLL_INTERVAL = float(os.environ.get('EXPORT_JOB_POLL_INTERVAL', '2'))
+# Validate export jobs' output (results cached per file in BidsValidationResult)
+BIDS_VALIDATE_EXPORTS = os.environ.get('BIDS_VALIDATE_EXPORTS', '1') == '1'
+# Persistent BIDS tree per experiment, kept current by manage.py sync_bids_mirror (empty = disabled)
+BIDS_MIRROR_ROOT = os.environ.get('BIDS_MIRROR_ROOT', '')
+
+# Application cache (dicom_app/app_cache.py). Versions and values share the
+# backend, so every server process must see the same cache: Redis with
+# CACHE_REDIS_URL (shared between hosts), otherwise files under CACHE_DIR
+# (shared between the processes of one host). An empty CACHE_DIR falls back
+# to local memory, valid only for a single process (runserver).
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', '')
+CACHE_DIR = os.environ.get('CACHE_DIR', str(BASE_DIR / 'cache' / 'django'))
+if CACHE_REDIS_URL:
+    _cache_backend = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CACHE_REDIS_URL,
+    }
+elif CACHE_DIR:
+    _cache_backend = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+else:
+    _cache_backend = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+CACHES = {'default': dict(_cache_backend, KEY_PREFIX='dicomhub')}
+# Lifetime in seconds of cached pages and query results
+APP_CACHE_TIMEOUT = int(os.environ.get('APP_CACHE_TIMEOUT', '600'))
+
+# De-identification (PS3.15 Basic Profile, see dicom_app/deid.py)
+# Secret behind the UID remapping: the same secret maps a UID to the same
+# new UID in every export. Keep it private; defaults to SECRET_KEY.
+DEID_UID_SECRET = os.environ.get('DEID_UID_SECRET', SECRET_KEY)
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
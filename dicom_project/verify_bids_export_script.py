@@ -16,6 +16,7 @@ from dicom_app.bids_utils import (
     normalize_subject_id, detect_modality, convert_dicom_to_nifti,
     create_dataset_description, create_participants_tsv
 )
+from dicom_app.bids_export import get_uid_key
 
 def create_dummy_dicom(filename):
     """Creates a minimal valid DICOM file for testing."""
@@ -73,7 +74,7 @@ def test_bids_export():
         output_dir.mkdir(parents=True)
         
         output_basename = f"{subject_id}_{suffix}"
-        nifti, json_sidecar = convert_dicom_to_nifti(dicom_path, output_dir, output_basename)
+        nifti, json_sidecar = convert_dicom_to_nifti(dicom_path, output_dir, output_basename, uid_key=get_uid_key())
         
         if nifti and json_sidecar:
             assert nifti.exists()